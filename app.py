@@ -2,11 +2,24 @@
 Flask application for Ocean Waste Detection ML Service.
 Provides REST API for waste classification.
 """
+import atexit
 import logging
+import os
 import base64
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+import numpy as np
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 from waste_classifier import WasteClassifier
+from embedding_index import EmbeddingIndex
+from result_store import ResultStore, ResultSinks
+from drift import DEFAULT_HOURS, predict_drift
+from weather_cache import WeatherCache, KINDS, open_provider
+from drift_ensemble import field_from_cache, simulate_ensemble
 from config import Config
 
 # Configure logging
@@ -16,6 +29,13 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+try:
+    from firebase import FirebaseWriteBuffer
+    FIREBASE_AVAILABLE = True
+except ImportError:
+    FIREBASE_AVAILABLE = False
+    logger.warning("pyrebase not available. Firebase pushes disabled.")
+
 # Instantiate Flask
 app = Flask(__name__)
 # Enable CORS with specific settings for development and production
@@ -26,6 +46,34 @@ CORS(app,
              "methods": ["POST", "OPTIONS"],
              "allow_headers": ["Content-Type", "Authorization"]
          },
+         r"/report": {
+             "origins": "*",
+             "methods": ["POST", "OPTIONS"],
+             "allow_headers": ["Content-Type", "Authorization"]
+         },
+         r"/keepalive": {
+             "origins": "*",
+             "methods": ["POST", "OPTIONS"],
+             "allow_headers": ["Content-Type", "Authorization"]
+         },
+         r"/history": {
+             "origins": "*",
+             "methods": ["GET", "OPTIONS"]
+         },
+         r"/stats": {
+             "origins": "*",
+             "methods": ["GET", "OPTIONS"]
+         },
+         r"/drift": {
+             "origins": "*",
+             "methods": ["POST", "OPTIONS"],
+             "allow_headers": ["Content-Type", "Authorization"]
+         },
+         r"/similar": {
+             "origins": ["http://localhost:3000", "http://127.0.0.1:3000", "*"],
+             "methods": ["GET", "POST", "OPTIONS"],
+             "allow_headers": ["Content-Type", "Authorization"]
+         },
          r"/status": {
              "origins": "*",
              "methods": ["GET", "OPTIONS"]
@@ -41,6 +89,120 @@ except Exception as e:
     logger.error(f"Failed to initialize classifier: {e}")
     classifier = None
 
+# Index of past detections for similar-image search
+embedding_index = EmbeddingIndex.load_or_create(Config.EMBEDDING_INDEX_DIR)
+_index_lock = threading.Lock()
+_unsaved_additions = 0
+
+
+def save_embedding_index() -> None:
+    """Append the embeddings added since the last save to the index folder."""
+    if not Config.EMBEDDING_INDEX_DIR:
+        return
+    try:
+        embedding_index.flush(Config.EMBEDDING_INDEX_DIR)
+    except Exception as e:
+        logger.error(f"Failed to save embedding index: {e}")
+
+
+def index_detection(image_id: str, embedding, label: str, confidence: float) -> None:
+    """Add a classified image to the embedding index, saving it periodically."""
+    global _unsaved_additions
+    embedding_index.add(image_id, embedding, {
+        "label": label,
+        "confidence": confidence,
+        "timestamp": time.time()
+    })
+    with _index_lock:
+        _unsaved_additions += 1
+        due = _unsaved_additions >= Config.EMBEDDING_INDEX_SAVE_INTERVAL
+        if due:
+            _unsaved_additions = 0
+    if due:
+        save_embedding_index()
+
+
+atexit.register(save_embedding_index)
+
+# Every result goes to each sink: the local history, and Firebase, where
+# pushes are written in the background, coalesced per bin
+result_sinks = ResultSinks()
+result_store = None
+if Config.RESULT_STORE_PATH:
+    result_store = ResultStore(
+        Config.RESULT_STORE_PATH,
+        batch_size=Config.RESULT_STORE_BATCH_SIZE,
+        flush_interval=Config.RESULT_STORE_FLUSH_INTERVAL
+    )
+    result_sinks.add(result_store)
+if Config.FIREBASE_PUSH_RESULTS:
+    if FIREBASE_AVAILABLE:
+        result_sinks.add(FirebaseWriteBuffer())
+    else:
+        logger.error("FIREBASE_PUSH_RESULTS is set but pyrebase is not installed")
+atexit.register(result_sinks.close)
+
+
+def push_result(result: dict) -> None:
+    """Pass a result to the result sinks under the sending camera's bin id."""
+    result_sinks.push(result, request.headers.get('X-Camera-Id') or None)
+
+
+def decode_image_data(img_bytes: bytes) -> bytes:
+    """
+    Decode a request body into image bytes.
+    
+    Accepts raw bytes, base64, or a base64 data URI.
+    
+    Args:
+        img_bytes: Raw request body
+        
+    Returns:
+        Image data as bytes
+    """
+    try:
+        # Handle data URI scheme if present
+        if img_bytes.startswith(b'data:image'):
+            if b',' in img_bytes:
+                img_bytes = img_bytes.split(b',')[1]
+            return base64.b64decode(img_bytes)
+        # Try base64 decode if it looks like base64
+        elif len(img_bytes) % 4 == 0:
+            try:
+                return base64.b64decode(img_bytes, validate=True)
+            except Exception:
+                return img_bytes
+        return img_bytes
+    except Exception as e:
+        logger.warning(f"Base64 decode failed, using raw bytes: {e}")
+        return img_bytes
+
+
+def read_image_body() -> bytes:
+    """
+    Read the image from the request body.
+    
+    Bodies sent with an image/* Content-Type are taken as raw image bytes.
+    Anything else goes through decode_image_data, which has to guess the
+    encoding.
+    
+    Returns:
+        Image data as bytes
+    """
+    body = request.get_data()
+    if request.mimetype.startswith('image/'):
+        return body
+    return decode_image_data(body)
+
+
+def validate_image_data(img_data: bytes) -> Optional[str]:
+    """Return an error message if the decoded image is unusable, else None."""
+    if len(img_data) == 0:
+        return "Empty image data"
+    if len(img_data) > 10 * 1024 * 1024:  # 10MB limit
+        return "Image too large (max 10MB)"
+    return None
+
 
 @app.route('/status', methods=['GET'])
 def health_check():
@@ -65,7 +227,8 @@ def detect():
     
     Expected request:
         - POST body: Image data (raw bytes or base64 encoded)
-        - Content-Type: application/octet-stream or image/*
+        - Content-Type: image/* for raw bytes, which skips guessing the
+          encoding, or application/octet-stream
     
     Returns:
         JSON response with classification results
@@ -84,57 +247,43 @@ def detect():
                 "error": "No image data provided"
             }), 400
 
-        img_bytes = request.data
-        
-        # Decode base64 if sent as string, or use raw bytes
-        try:
-            # Handle data URI scheme if present
-            if img_bytes.startswith(b'data:image'):
-                if b',' in img_bytes:
-                    img_bytes = img_bytes.split(b',')[1]
-                img_data = base64.b64decode(img_bytes)
-            # Try base64 decode if it looks like base64
-            elif len(img_bytes) % 4 == 0:
-                try:
-                    img_data = base64.b64decode(img_bytes, validate=True)
-                except Exception:
-                    img_data = img_bytes
-            else:
-                img_data = img_bytes
-        except Exception as e:
-            logger.warning(f"Base64 decode failed, using raw bytes: {e}")
-            img_data = img_bytes
+        img_data = read_image_body()
 
         # Validate image data size
-        if len(img_data) == 0:
-            return jsonify({
-                "success": False,
-                "error": "Empty image data"
-            }), 400
-        
-        if len(img_data) > 10 * 1024 * 1024:  # 10MB limit
+        error = validate_image_data(img_data)
+        if error:
             return jsonify({
                 "success": False,
-                "error": "Image too large (max 10MB)"
+                "error": error
             }), 400
 
-        logger.info(f"Received image for classification ({len(img_data)} bytes)")
+        camera_id = request.headers.get('X-Camera-Id', '')
+        logger.info(f"Received image for classification ({len(img_data)} bytes"
+                    f"{', camera ' + camera_id if camera_id else ''})")
         
-        # Classify image
-        results = classifier.classify(img_data)
+        # Classify image, keeping its embedding for similar-image search
+        results, embedding = classifier.classify_with_embedding(img_data)
         
         # Get top prediction
         top_label, top_score = max(results.items(), key=lambda x: x[1])
 
-        # Return results
-        return jsonify({
+        image_id = request.args.get('image_id') or uuid.uuid4().hex
+        if embedding is not None:
+            index_detection(image_id, embedding, top_label, top_score)
+
+        response = {
             "success": True,
+            "image_id": image_id,
             "predictions": results,
             "top_prediction": {
                 "label": top_label,
                 "confidence": top_score
             }
-        }), 200
+        }
+        push_result(response)
+
+        # Return results
+        return jsonify(response), 200
 
     except ValueError as e:
         logger.error(f"Validation error: {e}")
@@ -151,6 +300,464 @@ def detect():
         }), 500
 
 
+@app.route('/report', methods=['POST'])
+def report():
+    """
+    Accept a classification made on a camera node.
+    
+    Camera nodes in local inference mode classify images themselves and
+    only send the result here; uncertain images still go to /detect.
+    
+    Expected request:
+        - POST body: JSON with "top_prediction" ({"label", "confidence"}),
+          and optionally "predictions" and "source"
+    
+    Returns:
+        JSON response acknowledging the result
+    """
+    result = request.get_json(silent=True)
+    if not isinstance(result, dict):
+        return jsonify({
+            "success": False,
+            "error": "Expected a JSON object"
+        }), 400
+    top_prediction = result.get("top_prediction")
+    if not isinstance(top_prediction, dict) or "label" not in top_prediction:
+        return jsonify({
+            "success": False,
+            "error": "Expected JSON with a top_prediction label"
+        }), 400
+    try:
+        confidence = float(top_prediction.get("confidence", 0.0))
+    except (TypeError, ValueError):
+        return jsonify({
+            "success": False,
+            "error": "top_prediction confidence must be a number"
+        }), 400
+
+    report_id = uuid.uuid4().hex
+    camera_id = request.headers.get('X-Camera-Id', '')
+    logger.info(f"Received {result.get('source', 'edge')} result: "
+                f"{top_prediction['label']} ({confidence:.2f})"
+                f"{' from camera ' + camera_id if camera_id else ''}")
+    push_result({**result, "report_id": report_id})
+    return jsonify({
+        "success": True,
+        "report_id": report_id
+    }), 200
+
+
+@app.route('/keepalive', methods=['POST'])
+def keepalive():
+    """
+    Accept a keep-alive from a camera node whose view has not changed.
+    
+    Expected request:
+        - POST body: JSON with "unchanged_seconds" and the camera's
+          upload "stats"
+    
+    Returns:
+        JSON response acknowledging the keep-alive
+    """
+    message = request.get_json(silent=True)
+    if not isinstance(message, dict):
+        return jsonify({
+            "success": False,
+            "error": "Expected a JSON object"
+        }), 400
+
+    stats = message.get("stats") or {}
+    logger.info(f"Camera {request.headers.get('X-Camera-Id', '')} keep-alive: unchanged for "
+                f"{message.get('unchanged_seconds', 0)}s, "
+                f"{stats.get('skipped', 0)} of {stats.get('frames', 0)} frames skipped")
+    return jsonify({"success": True}), 200
+
+
+@app.route('/similar', methods=['GET', 'POST'])
+def similar():
+    """
+    Find past detections that look like an image.
+    
+    Expected request:
+        - POST body: Image data (raw bytes or base64 encoded), or
+        - GET with ?image_id= of an image already sent to /detect
+        - Optional ?k= number of results (default 5)
+    
+    Returns:
+        JSON response with the k most similar indexed images
+    """
+    try:
+        k = int(request.args.get('k', 5))
+    except ValueError:
+        return jsonify({
+            "success": False,
+            "error": "k must be an integer"
+        }), 400
+    if not 1 <= k <= Config.SIMILAR_MAX_K:
+        return jsonify({
+            "success": False,
+            "error": f"k must be between 1 and {Config.SIMILAR_MAX_K}"
+        }), 400
+
+    try:
+        image_id = request.args.get('image_id')
+        if image_id:
+            embedding = embedding_index.get_embedding(image_id)
+            if embedding is None:
+                return jsonify({
+                    "success": False,
+                    "error": f"Unknown image_id: {image_id}"
+                }), 404
+        else:
+            if classifier is None:
+                return jsonify({
+                    "success": False,
+                    "error": "Classifier not initialized"
+                }), 503
+            if classifier.embedding_operation is None:
+                return jsonify({
+                    "success": False,
+                    "error": "The loaded model has no embedding layer"
+                }), 503
+            if not request.data:
+                return jsonify({
+                    "success": False,
+                    "error": "No image data or image_id provided"
+                }), 400
+            img_data = read_image_body()
+            error = validate_image_data(img_data)
+            if error:
+                return jsonify({
+                    "success": False,
+                    "error": error
+                }), 400
+            embedding = classifier.embed(img_data)
+
+        start = time.perf_counter()
+        results = embedding_index.search(embedding, k, exclude_id=image_id)
+        search_ms = (time.perf_counter() - start) * 1000
+
+        return jsonify({
+            "success": True,
+            "results": results,
+            "index_size": len(embedding_index),
+            "search_ms": search_ms
+        }), 200
+
+    except ValueError as e:
+        logger.error(f"Validation error: {e}")
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+
+    except Exception as e:
+        logger.error(f"Error processing request: {e}", exc_info=True)
+        return jsonify({
+            "success": False,
+            "error": "Internal server error"
+        }), 500
+
+
+@app.route('/history', methods=['GET'])
+def history():
+    """
+    List past results from the local history, newest first.
+    
+    Expected request:
+        - Optional ?bin= bin id, ?label= top label
+        - Optional ?start= and ?end= Unix times
+        - Optional ?limit= number of results (default 100)
+    
+    Returns:
+        JSON response with the matching results
+    """
+    if result_store is None:
+        return jsonify({
+            "success": False,
+            "error": "Result history not enabled"
+        }), 503
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        start = float(start) if start else None
+        end = float(end) if end else None
+        limit = int(request.args.get('limit', 100))
+    except ValueError:
+        return jsonify({
+            "success": False,
+            "error": "start and end must be numbers and limit an integer"
+        }), 400
+    if not 1 <= limit <= Config.HISTORY_MAX_LIMIT:
+        return jsonify({
+            "success": False,
+            "error": f"limit must be between 1 and {Config.HISTORY_MAX_LIMIT}"
+        }), 400
+
+    results = result_store.query(
+        bin_id=request.args.get('bin'),
+        label=request.args.get('label'),
+        start=start,
+        end=end,
+        limit=limit
+    )
+    return jsonify({
+        "success": True,
+        "results": results
+    }), 200
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    """
+    Summarize detections in a time range, for the analytics dashboard.
+    
+    Answered from hourly and daily rollups kept as results arrive, so the
+    cost does not depend on how much history is stored.
+    
+    Expected request:
+        - Optional ?start= and ?end= Unix times (default the last 24 hours),
+          widened to whole hours
+        - Optional ?bin= bin id, ?label= top label
+        - Optional ?interval= 'hour' or 'day' for a count per bucket
+    
+    Returns:
+        JSON response with counts per label and per bin
+    """
+    if result_store is None:
+        return jsonify({
+            "success": False,
+            "error": "Result history not enabled"
+        }), 503
+    try:
+        end = float(request.args.get('end') or time.time())
+        start = float(request.args.get('start') or end - 86400)
+    except ValueError:
+        return jsonify({
+            "success": False,
+            "error": "start and end must be numbers"
+        }), 400
+    try:
+        summary = result_store.rollup(
+            start,
+            end,
+            bin_id=request.args.get('bin'),
+            label=request.args.get('label'),
+            interval=request.args.get('interval')
+        )
+    except ValueError as e:
+        return jsonify({
+            "success": False,
+            "error": str(e)
+        }), 400
+    return jsonify({
+        "success": True,
+        **summary
+    }), 200
+
+
+DRIFT_FIELDS = ("lat", "lng", "wind_speed", "wind_direction",
+                "current_velocity", "current_direction")
+
+# Wind and current conditions for reports sent without them, shared by
+# every request
+try:
+    weather_cache = WeatherCache(
+        open_provider(),
+        grid=Config.WEATHER_GRID,
+        max_entries=Config.WEATHER_CACHE_MAX_ENTRIES
+    )
+except Exception as e:
+    logger.error(f"Failed to initialize weather provider: {e}")
+    weather_cache = None
+
+# Worker processes for ensemble drift, started on first use
+_ensemble_executor = None
+_ensemble_lock = threading.Lock()
+
+
+def get_ensemble_executor() -> Optional[ProcessPoolExecutor]:
+    """Get the pool for ensemble drift, or None to run in this process."""
+    global _ensemble_executor
+    workers = Config.DRIFT_ENSEMBLE_WORKERS or os.cpu_count() or 1
+    if workers <= 1:
+        return None
+    with _ensemble_lock:
+        if _ensemble_executor is None:
+            _ensemble_executor = ProcessPoolExecutor(workers)
+            atexit.register(_ensemble_executor.shutdown)
+        return _ensemble_executor
+
+
+@app.route('/drift', methods=['POST'])
+def drift():
+    """
+    Predict where reported waste drifts to, for many reports at once.
+    
+    Expected request:
+        - POST body: JSON with "reports", a list of {"id", "lat", "lng",
+          "wind_speed", "wind_direction", "current_velocity",
+          "current_direction"} (speeds in m/s, directions in degrees the
+          flow heads towards), and optionally "hours", a list of horizons
+          above 0 and up to DRIFT_MAX_HOURS (default [24, 48, 72])
+        - Wind and current fields given at the top level apply to every
+          report that does not have its own; reports with neither get
+          conditions from the weather cache
+        - Optionally "ensemble": true to add an uncertainty cone per
+          report, from particles integrated through the gridded conditions
+          around the reports
+    
+    Returns:
+        JSON response with the drift speed, direction and predicted
+        positions of each report
+    """
+    body = request.get_json(silent=True) or {}
+    reports = body.get("reports")
+    if not isinstance(reports, list) or not reports:
+        return jsonify({
+            "success": False,
+            "error": "Expected JSON with a list of reports"
+        }), 400
+    if len(reports) > Config.DRIFT_MAX_REPORTS:
+        return jsonify({
+            "success": False,
+            "error": f"At most {Config.DRIFT_MAX_REPORTS} reports per request"
+        }), 400
+
+    hours = body.get("hours", list(DEFAULT_HOURS))
+    if (not isinstance(hours, list) or not 1 <= len(hours) <= Config.DRIFT_MAX_HORIZONS
+            or not all(isinstance(h, (int, float)) and not isinstance(h, bool)
+                       and 0 < h <= Config.DRIFT_MAX_HOURS for h in hours)):
+        return jsonify({
+            "success": False,
+            "error": f"hours must list 1 to {Config.DRIFT_MAX_HORIZONS} numbers "
+                     f"above 0 and up to {Config.DRIFT_MAX_HOURS}"
+        }), 400
+    hours = [float(h) for h in hours]
+    try:
+        columns = {
+            field: np.array([
+                report[field] if report.get(field) is not None
+                else body.get(field, np.nan)
+                for report in reports
+            ], dtype=np.float64)
+            for field in DRIFT_FIELDS
+        }
+    except (TypeError, ValueError, AttributeError):
+        return jsonify({
+            "success": False,
+            "error": f"Each report needs numeric {', '.join(DRIFT_FIELDS)}"
+        }), 400
+    if not (np.isfinite(columns["lat"]).all() and np.isfinite(columns["lng"]).all()):
+        return jsonify({
+            "success": False,
+            "error": "Each report needs numeric lat and lng"
+        }), 400
+
+    # NaN marks a value to look up; anything else must be finite
+    if any(np.isinf(columns[field]).any() for field in DRIFT_FIELDS):
+        return jsonify({
+            "success": False,
+            "error": "Wind and current values must be finite numbers"
+        }), 400
+
+    for kind, (speed_field, direction_field) in KINDS.items():
+        missing = np.isnan(columns[speed_field]) | np.isnan(columns[direction_field])
+        if not missing.any():
+            continue
+        if weather_cache is None:
+            return jsonify({
+                "success": False,
+                "error": f"Reports need {speed_field} and {direction_field}; "
+                         "no weather provider is configured"
+            }), 400
+        try:
+            values = np.asarray(weather_cache.get_many(kind, list(zip(
+                columns["lat"][missing].tolist(), columns["lng"][missing].tolist()
+            ))), dtype=np.float64)
+        except Exception as e:
+            logger.error(f"Failed to look up {kind} conditions: {e}")
+            return jsonify({
+                "success": False,
+                "error": "Weather provider unavailable"
+            }), 502
+        columns[speed_field][missing] = values[:, 0]
+        columns[direction_field][missing] = values[:, 1]
+    if not all(np.isfinite(columns[field]).all() for field in DRIFT_FIELDS):
+        return jsonify({
+            "success": False,
+            "error": "Wind and current values must be finite numbers"
+        }), 400
+
+    prediction = predict_drift(hours=hours, **columns)
+    lat = prediction["lat"].tolist()
+    lng = prediction["lng"].tolist()
+    distance = prediction["distance"].tolist()
+    results = [{
+        "id": report.get("id"),
+        "speed": speed,
+        "speed_kmh": speed * 3.6,
+        "direction": direction,
+        "wind_contribution": wind,
+        "current_contribution": current,
+        "positions": [{"hours": h, "lat": la, "lng": ln, "distance": d}
+                      for h, la, ln, d in zip(hours, lat[i], lng[i], distance[i])]
+    } for i, (report, speed, direction, wind, current) in enumerate(zip(
+        reports,
+        prediction["speed"].tolist(),
+        prediction["direction"].tolist(),
+        prediction["wind_contribution"].tolist(),
+        prediction["current_contribution"].tolist()
+    ))]
+
+    if body.get("ensemble"):
+        if len(reports) > Config.DRIFT_ENSEMBLE_MAX_REPORTS:
+            return jsonify({
+                "success": False,
+                "error": f"At most {Config.DRIFT_ENSEMBLE_MAX_REPORTS} reports "
+                         "per ensemble request"
+            }), 400
+        if weather_cache is None:
+            return jsonify({
+                "success": False,
+                "error": "Ensemble drift needs a weather provider"
+            }), 400
+        try:
+            field = field_from_cache(weather_cache, columns["lat"], columns["lng"],
+                                     grid=Config.DRIFT_ENSEMBLE_GRID,
+                                     margin=Config.DRIFT_ENSEMBLE_MARGIN)
+        except Exception as e:
+            logger.error(f"Failed to build drift field: {e}")
+            return jsonify({
+                "success": False,
+                "error": "Weather provider unavailable"
+            }), 502
+        cones = {name: values.tolist() for name, values in simulate_ensemble(
+            field,
+            columns["lat"],
+            columns["lng"],
+            hours=hours,
+            particles=Config.DRIFT_ENSEMBLE_PARTICLES,
+            step=Config.DRIFT_ENSEMBLE_STEP,
+            executor=get_ensemble_executor()
+        ).items()}
+        horizons = sorted(set(hours))
+        for i, result in enumerate(results):
+            result["cone"] = [{
+                "hours": h,
+                "lat": cones["lat"][i][j],
+                "lng": cones["lng"][i][j],
+                "radius_50": cones["radius_50"][i][j],
+                "radius_90": cones["radius_90"][i][j]
+            } for j, h in enumerate(horizons)]
+
+    return jsonify({
+        "success": True,
+        "hours": hours,
+        "drift": results
+    }), 200
+
+
 @app.errorhandler(404)
 def not_found(error):
     """Handle 404 errors."""
@@ -0,0 +1,256 @@
+"""
+Camera backends for the camera service.
+
+A backend is opened once and kept open, and each capture returns an encoded
+JPEG in memory. PiCameraCapture drives the Raspberry Pi camera and
+SnapshotCamera an IP camera's snapshot URL; FakeCamera replays image files,
+or draws synthetic frames, so the capture pipeline can be tested and
+benchmarked off-device.
+
+Example:
+    python camera.py --backend=fake --fake_images='testing/*.jpg' --frames=200
+"""
+import argparse
+import glob
+import io
+import logging
+import time
+from typing import List, Optional, Tuple
+
+import requests
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+try:
+    import picamera
+    PICAMERA_AVAILABLE = True
+except ImportError:
+    PICAMERA_AVAILABLE = False
+    logger.warning("picamera not available. Camera functionality disabled.")
+
+
+def parse_resolution(resolution: str) -> Tuple[int, int]:
+    """Parse a "WIDTHxHEIGHT" string into a (width, height) tuple."""
+    width, height = resolution.lower().split('x')
+    return int(width), int(height)
+
+
+class PiCameraCapture:
+    """Raspberry Pi camera, kept open between captures."""
+
+    def __init__(
+        self,
+        resolution: Tuple[int, int] = (1024, 768),
+        quality: int = 85,
+        warmup: float = 2.0,
+        use_video_port: bool = True
+    ):
+        """
+        Initialize the camera backend.
+
+        Args:
+            resolution: Capture (width, height)
+            quality: JPEG quality of the captures
+            warmup: Seconds to let exposure and white balance settle on open
+            use_video_port: Capture from the video port, which skips the
+                mode switch of a still capture at some cost in quality
+        """
+        self.resolution = resolution
+        self.quality = quality
+        self.warmup = warmup
+        self.use_video_port = use_video_port
+        self.camera = None
+
+    def open(self) -> None:
+        """Open the camera and wait for it to settle, once."""
+        if not PICAMERA_AVAILABLE:
+            raise RuntimeError("picamera not installed")
+        logger.info("Opening camera...")
+        self.camera = picamera.PiCamera(resolution=self.resolution)
+        time.sleep(self.warmup)
+
+    def capture(self) -> bytes:
+        """
+        Capture a frame.
+
+        Returns:
+            JPEG bytes
+        """
+        if self.camera is None:
+            self.open()
+        stream = io.BytesIO()
+        self.camera.capture(stream, format='jpeg', quality=self.quality,
+                            use_video_port=self.use_video_port)
+        return stream.getvalue()
+
+    def close(self) -> None:
+        """Release the camera."""
+        if self.camera is not None:
+            self.camera.close()
+            self.camera = None
+
+
+class FakeCamera:
+    """
+    Camera stand-in for tests and benchmarks.
+
+    Replays the given image files in order, or draws synthetic frames with
+    a block that moves every frame when none are given.
+    """
+
+    def __init__(
+        self,
+        image_paths: Optional[List[str]] = None,
+        resolution: Tuple[int, int] = (1024, 768),
+        quality: int = 85,
+        capture_delay: float = 0.0
+    ):
+        """
+        Initialize the fake camera.
+
+        Args:
+            image_paths: Image files to replay, cycling through them
+            resolution: Size of synthetic frames
+            quality: JPEG quality of synthetic frames
+            capture_delay: Seconds each capture takes, to simulate a sensor
+        """
+        self.image_paths = image_paths or []
+        self.resolution = resolution
+        self.quality = quality
+        self.capture_delay = capture_delay
+        self.frames = 0
+        self._images: List[bytes] = []
+
+    def open(self) -> None:
+        """Load the replayed images into memory."""
+        self._images = []
+        for path in self.image_paths:
+            with open(path, 'rb') as f:
+                self._images.append(f.read())
+
+    def capture(self) -> bytes:
+        """
+        Capture a frame.
+
+        Returns:
+            JPEG bytes
+        """
+        if self.capture_delay:
+            time.sleep(self.capture_delay)
+        index = self.frames
+        self.frames += 1
+        if self.image_paths:
+            if not self._images:
+                self.open()
+            return self._images[index % len(self._images)]
+
+        from PIL import Image
+        width, height = self.resolution
+        image = Image.new('RGB', self.resolution, (60, 60, 60))
+        block = Image.new('RGB', (width // 4, height // 4), (240, 240, 240))
+        image.paste(block, ((index * 37) % (width - width // 4),
+                            (index * 23) % (height - height // 4)))
+        output = io.BytesIO()
+        image.save(output, format='JPEG', quality=self.quality)
+        return output.getvalue()
+
+    def close(self) -> None:
+        """Release the replayed images."""
+        self._images = []
+
+
+class SnapshotCamera:
+    """IP camera that serves a JPEG snapshot over HTTP."""
+
+    def __init__(self, url: str, session: Optional[requests.Session] = None,
+                 timeout: float = 10.0):
+        """
+        Initialize the camera backend.
+
+        Args:
+            url: Snapshot URL of the camera
+            session: Optional HTTP session to share with other cameras
+            timeout: Request timeout in seconds
+        """
+        self.url = url
+        self.session = session or requests.Session()
+        self.timeout = timeout
+
+    def capture(self) -> bytes:
+        """
+        Fetch a snapshot.
+
+        Returns:
+            JPEG bytes
+        """
+        response = self.session.get(self.url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.content
+
+    def close(self) -> None:
+        """Nothing to release; the session belongs to the caller."""
+
+
+def open_camera(backend: Optional[str] = None):
+    """
+    Create the configured camera backend.
+
+    Args:
+        backend: 'picamera' or 'fake' (defaults to Config.CAMERA_BACKEND)
+
+    Returns:
+        Camera backend with capture() and close() methods
+
+    Raises:
+        ValueError: If the backend is unknown
+    """
+    backend = backend or Config.CAMERA_BACKEND
+    resolution = parse_resolution(Config.CAMERA_RESOLUTION)
+    if backend == 'picamera':
+        return PiCameraCapture(resolution=resolution,
+                               quality=Config.CAMERA_JPEG_QUALITY,
+                               warmup=Config.CAMERA_WARMUP)
+    if backend == 'fake':
+        paths = sorted(glob.glob(Config.FAKE_CAMERA_IMAGES)) \
+            if Config.FAKE_CAMERA_IMAGES else []
+        return FakeCamera(image_paths=paths, resolution=resolution,
+                          quality=Config.CAMERA_JPEG_QUALITY)
+    raise ValueError(f"Unknown camera backend: {backend}")
+
+
+def main():
+    """Benchmark a camera backend's capture rate."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--backend', default=Config.CAMERA_BACKEND,
+                        help="Camera backend, 'picamera' or 'fake'.")
+    parser.add_argument('--fake_images', default='',
+                        help='Glob of images for the fake camera to replay.')
+    parser.add_argument('--frames', type=int, default=100,
+                        help='Number of frames to capture.')
+    args = parser.parse_args()
+
+    if args.fake_images:
+        Config.FAKE_CAMERA_IMAGES = args.fake_images
+    camera = open_camera(args.backend)
+    try:
+        camera.capture()
+        total_bytes = 0
+        start = time.perf_counter()
+        for _ in range(args.frames):
+            total_bytes += len(camera.capture())
+        seconds = time.perf_counter() - start
+    finally:
+        camera.close()
+    logger.info(f"Captured {args.frames} frames in {seconds:.2f}s "
+                f"({args.frames / seconds:.1f} fps, "
+                f"{total_bytes / args.frames / 1024:.0f} KiB per frame)")
+
+
+if __name__ == '__main__':
+    main()
@@ -17,7 +17,12 @@ class Config:
     # Model Configuration
     MODEL_PATH: str = os.getenv('MODEL_PATH', 'tf_files/retrained_graph.pb')
     LABEL_PATH: str = os.getenv('LABEL_PATH', 'tf_files/retrained_labels.txt')
-    
+
+    # Similar-image Search Configuration
+    EMBEDDING_INDEX_DIR: str = os.getenv('EMBEDDING_INDEX_DIR', 'tf_files/embedding_index')
+    EMBEDDING_INDEX_SAVE_INTERVAL: int = int(os.getenv('EMBEDDING_INDEX_SAVE_INTERVAL', '100'))
+    SIMILAR_MAX_K: int = int(os.getenv('SIMILAR_MAX_K', '100'))
+
     # Firebase Configuration
     FIREBASE_API_KEY: str = os.getenv('FIREBASE_API_KEY', '')
     FIREBASE_AUTH_DOMAIN: str = os.getenv('FIREBASE_AUTH_DOMAIN', '')
@@ -28,9 +33,89 @@ class Config:
     FIREBASE_APP_ID: str = os.getenv('FIREBASE_APP_ID', '')
     FIREBASE_PROJECT_ID: str = os.getenv('FIREBASE_PROJECT_ID', '')
     FIREBASE_B_ID: str = os.getenv('FIREBASE_B_ID', '')
+    # Results are written to Firebase at most every FIREBASE_FLUSH_INTERVAL
+    # seconds; set FIREBASE_PUSH_RESULTS to push every detection
+    FIREBASE_PUSH_RESULTS: bool = os.getenv('FIREBASE_PUSH_RESULTS', 'False').lower() == 'true'
+    FIREBASE_FLUSH_INTERVAL: float = float(os.getenv('FIREBASE_FLUSH_INTERVAL', '2'))
+    FIREBASE_MAX_RETRIES: int = int(os.getenv('FIREBASE_MAX_RETRIES', '3'))
+    # ID tokens are refreshed this many seconds before they expire
+    FIREBASE_TOKEN_MARGIN: float = float(os.getenv('FIREBASE_TOKEN_MARGIN', '300'))
+    
+    # Result History Configuration
+    # Every result is kept in a local SQLite history; set the path empty to disable
+    RESULT_STORE_PATH: str = os.getenv('RESULT_STORE_PATH', 'results.db')
+    RESULT_STORE_BATCH_SIZE: int = int(os.getenv('RESULT_STORE_BATCH_SIZE', '500'))
+    RESULT_STORE_FLUSH_INTERVAL: float = float(os.getenv('RESULT_STORE_FLUSH_INTERVAL', '1'))
+    HISTORY_MAX_LIMIT: int = int(os.getenv('HISTORY_MAX_LIMIT', '1000'))
+    
+    # Drift Prediction Configuration
+    DRIFT_MAX_REPORTS: int = int(os.getenv('DRIFT_MAX_REPORTS', '10000'))
+    DRIFT_MAX_HORIZONS: int = int(os.getenv('DRIFT_MAX_HORIZONS', '24'))
+    # Longest horizon /drift predicts, in hours
+    DRIFT_MAX_HOURS: float = float(os.getenv('DRIFT_MAX_HOURS', '240'))
+    # Wind and current lookups for /drift: 'open-meteo', or 'fixture' to
+    # read them from WEATHER_FIXTURE offline
+    WEATHER_PROVIDER: str = os.getenv('WEATHER_PROVIDER', 'open-meteo')
+    WEATHER_FIXTURE: str = os.getenv('WEATHER_FIXTURE', 'fixtures/weather.json')
+    WEATHER_GRID: float = float(os.getenv('WEATHER_GRID', '0.25'))
+    WEATHER_CACHE_MAX_ENTRIES: int = int(os.getenv('WEATHER_CACHE_MAX_ENTRIES', '100000'))
+    # Particle-ensemble drift ("ensemble": true in /drift); the field
+    # around the reports is sampled every DRIFT_ENSEMBLE_GRID degrees out to
+    # DRIFT_ENSEMBLE_MARGIN, and 0 workers means one per CPU
+    DRIFT_ENSEMBLE_PARTICLES: int = int(os.getenv('DRIFT_ENSEMBLE_PARTICLES', '100'))
+    DRIFT_ENSEMBLE_STEP: float = float(os.getenv('DRIFT_ENSEMBLE_STEP', '3600'))
+    DRIFT_ENSEMBLE_GRID: float = float(os.getenv('DRIFT_ENSEMBLE_GRID', '1.0'))
+    DRIFT_ENSEMBLE_MARGIN: float = float(os.getenv('DRIFT_ENSEMBLE_MARGIN', '2.0'))
+    DRIFT_ENSEMBLE_WORKERS: int = int(os.getenv('DRIFT_ENSEMBLE_WORKERS', '0'))
+    DRIFT_ENSEMBLE_MAX_REPORTS: int = int(os.getenv('DRIFT_ENSEMBLE_MAX_REPORTS', '2000'))
     
     # ML Service Configuration
     ML_SERVICE_URL: str = os.getenv('ML_SERVICE_URL', 'http://localhost:5000')
+
+    # Camera Service Configuration
+    # Sent with every upload as X-Camera-Id, to tell cameras apart
+    CAMERA_ID: str = os.getenv('CAMERA_ID', '')
+    # 'remote' uploads every image; 'local' classifies on the device and only
+    # uploads the image when the on-device model is unsure.
+    INFERENCE_MODE: str = os.getenv('INFERENCE_MODE', 'remote')
+    EDGE_MODEL_PATH: str = os.getenv('EDGE_MODEL_PATH', 'tf_files/student.tflite')
+    EDGE_LABEL_PATH: str = os.getenv('EDGE_LABEL_PATH', 'tf_files/student_labels.txt')
+    EDGE_CONFIDENCE_THRESHOLD: float = float(os.getenv('EDGE_CONFIDENCE_THRESHOLD', '0.8'))
+    # 'picamera' on the Pi, or 'fake' to replay FAKE_CAMERA_IMAGES off-device
+    CAMERA_BACKEND: str = os.getenv('CAMERA_BACKEND', 'picamera')
+    CAMERA_RESOLUTION: str = os.getenv('CAMERA_RESOLUTION', '1024x768')
+    CAMERA_JPEG_QUALITY: int = int(os.getenv('CAMERA_JPEG_QUALITY', '85'))
+    CAMERA_WARMUP: float = float(os.getenv('CAMERA_WARMUP', '2'))
+    FAKE_CAMERA_IMAGES: str = os.getenv('FAKE_CAMERA_IMAGES', '')
+    # Frames where fewer than this fraction of thumbnail cells changed are
+    # not uploaded; 0 uploads every frame. A keep-alive is sent instead at
+    # most every KEEPALIVE_INTERVAL seconds.
+    FRAME_CHANGE_THRESHOLD: float = float(os.getenv('FRAME_CHANGE_THRESHOLD', '0.01'))
+    KEEPALIVE_INTERVAL: int = int(os.getenv('KEEPALIVE_INTERVAL', '900'))
+    # Images are downscaled to this shorter side, just above the model's
+    # 299x299 input, and re-encoded as JPEG before upload; 0 keeps the size.
+    UPLOAD_IMAGE_SIZE: int = int(os.getenv('UPLOAD_IMAGE_SIZE', '320'))
+    UPLOAD_JPEG_QUALITY: int = int(os.getenv('UPLOAD_JPEG_QUALITY', '85'))
+    # Captures run at a fixed rate that starts at the service's interval,
+    # drops to CAPTURE_MIN_INTERVAL when waste is detected and grows by
+    # CAPTURE_BACKOFF per idle frame up to CAPTURE_MAX_INTERVAL (seconds).
+    CAPTURE_MIN_INTERVAL: float = float(os.getenv('CAPTURE_MIN_INTERVAL', '15'))
+    CAPTURE_MAX_INTERVAL: float = float(os.getenv('CAPTURE_MAX_INTERVAL', '300'))
+    CAPTURE_BACKOFF: float = float(os.getenv('CAPTURE_BACKOFF', '1.5'))
+    PIPELINE_QUEUE_SIZE: int = int(os.getenv('PIPELINE_QUEUE_SIZE', '2'))
+    # Uploads are spooled here until delivered; empty disables the spool.
+    UPLOAD_QUEUE_PATH: str = os.getenv('UPLOAD_QUEUE_PATH', 'upload_queue.db')
+    UPLOAD_QUEUE_MAX_MB: int = int(os.getenv('UPLOAD_QUEUE_MAX_MB', '256'))
+    UPLOAD_BATCH_SIZE: int = int(os.getenv('UPLOAD_BATCH_SIZE', '20'))
+    UPLOAD_RETRY_BASE: float = float(os.getenv('UPLOAD_RETRY_BASE', '5'))
+    UPLOAD_RETRY_MAX: float = float(os.getenv('UPLOAD_RETRY_MAX', '600'))
+    
+    # Gateway Configuration (gateway.py, many cameras in one process)
+    GATEWAY_CAMERAS: str = os.getenv('GATEWAY_CAMERAS', 'cameras.json')
+    GATEWAY_MAX_UPLOADS: int = int(os.getenv('GATEWAY_MAX_UPLOADS', '8'))
+    GATEWAY_CAPTURE_WORKERS: int = int(os.getenv('GATEWAY_CAPTURE_WORKERS', '8'))
+    GATEWAY_SPOOL_DIR: str = os.getenv('GATEWAY_SPOOL_DIR', 'gateway_spool')
+    GATEWAY_STATS_INTERVAL: int = int(os.getenv('GATEWAY_STATS_INTERVAL', '60'))
     
     # TensorFlow Configuration
     TF_CPP_MIN_LOG_LEVEL: str = os.getenv('TF_CPP_MIN_LOG_LEVEL', '3')
@@ -0,0 +1,322 @@
+"""
+Near-duplicate detection over cached bottleneck embeddings.
+
+Fixed cameras produce long runs of near-identical frames. This finds clusters
+of such images from their cached 2048-d bottlenecks, using a random-hyperplane
+LSH index to propose candidate pairs and an exact cosine check to confirm
+them. That keeps the cost far below all-pairs comparison at 100k+ images. It
+writes a JSON report of the clusters and, optionally, an exclude file that
+`retrain.py --exclude_file` uses to keep one image per cluster.
+
+Example:
+    python dedup.py \
+        --image_dir=training_dataset \
+        --bottleneck_dir=tf_files/bottlenecks \
+        --threshold=0.95 \
+        --report_file=duplicates.json \
+        --exclude_file=duplicates.txt
+    python dedup.py --benchmark=20000
+"""
+import argparse
+import json
+import logging
+import resource
+import time
+from typing import List, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+import retrain
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# When a cluster spans several sets, the image kept is taken from the first
+# set in this order, so duplicates never leak from training into evaluation.
+CATEGORY_PRIORITY = ('training', 'validation', 'testing')
+
+
+def load_embeddings(
+    image_lists: dict,
+    image_dir: str,
+    bottleneck_dir: str,
+    model_dir: str
+) -> Tuple[np.ndarray, List[Tuple[str, str]]]:
+    """
+    Load the bottleneck of every image in every set.
+
+    Inception is only used for images whose bottleneck is not cached yet.
+
+    Args:
+        image_lists: Dictionary produced by retrain.load_image_lists
+        image_dir: Root folder of the class-named image subfolders
+        bottleneck_dir: Folder holding cached bottleneck files
+        model_dir: Folder holding the Inception model
+
+    Returns:
+        Tuple of (float32 matrix [N, 2048], list of (image key, category)),
+        where the key is the '<label folder>/<file name>' used by
+        --exclude_file
+    """
+    retrain.maybe_download_and_extract(model_dir)
+    graph, bottleneck_tensor, jpeg_data_tensor, _ = (
+        retrain.create_inception_graph(model_dir))
+    count = sum(len(label_lists[category])
+                for label_lists in image_lists.values()
+                for category in CATEGORY_PRIORITY)
+    embeddings = np.zeros([count, retrain.BOTTLENECK_TENSOR_SIZE], np.float32)
+    keys = []
+    with tf.compat.v1.Session(graph=graph) as sess:
+        for label_name, label_lists in image_lists.items():
+            for category in CATEGORY_PRIORITY:
+                for index, base_name in enumerate(label_lists[category]):
+                    embeddings[len(keys)] = retrain.get_or_create_bottleneck(
+                        sess, image_lists, label_name, index, image_dir,
+                        category, bottleneck_dir, jpeg_data_tensor,
+                        bottleneck_tensor)
+                    keys.append((label_lists['dir'] + '/' + base_name, category))
+    return embeddings, keys
+
+
+def find_roots(parents: np.ndarray, nodes: np.ndarray) -> np.ndarray:
+    """
+    Find the root of each node in a union-find forest.
+
+    Args:
+        parents: Parent of every node; roots are their own parent
+        nodes: Nodes to look up
+
+    Returns:
+        Root of each node
+    """
+    roots = parents[nodes]
+    while True:
+        grandparents = parents[roots]
+        if np.array_equal(grandparents, roots):
+            return roots
+        roots = grandparents
+
+
+def merge_components(parents: np.ndarray, nodes_a: np.ndarray,
+                     nodes_b: np.ndarray) -> None:
+    """
+    Join the components of each pair of nodes, in place.
+
+    Every root is pointed at the smallest root it is joined to, so parents
+    always have smaller indices than their children and no cycles form.
+    Pairs whose update lost to another in the same pass are retried until
+    every pair shares a root.
+
+    Args:
+        parents: Union-find forest, as for find_roots
+        nodes_a: First node of each pair
+        nodes_b: Second node of each pair
+    """
+    while len(nodes_a):
+        roots_a = find_roots(parents, nodes_a)
+        roots_b = find_roots(parents, nodes_b)
+        apart = roots_a != roots_b
+        nodes_a, nodes_b = roots_a[apart], roots_b[apart]
+        np.minimum.at(parents, np.maximum(nodes_a, nodes_b),
+                      np.minimum(nodes_a, nodes_b))
+
+
+def find_near_duplicates(
+    embeddings: np.ndarray,
+    threshold: float = 0.95,
+    num_tables: int = 10,
+    num_bits: int = 16,
+    seed: int = 0,
+    chunk_size: int = 1024
+) -> Tuple[List[np.ndarray], dict]:
+    """
+    Group embeddings into clusters of near-duplicates.
+
+    Embeddings are mean-centered and normalized, then hashed with num_bits
+    random hyperplanes in each of num_tables tables. Only images sharing a
+    bucket are compared, and a pair is a duplicate when its cosine similarity
+    is at least threshold. Matches are merged into a union-find forest as
+    each block of similarities is computed, so no list of pairs is kept, and
+    images already joined to the first image of their bucket are not
+    compared again. Clusters are the resulting connected components.
+
+    Args:
+        embeddings: Matrix of shape [N, D]
+        threshold: Cosine similarity at or above which two images match
+        num_tables: Number of independent hash tables; more tables find more
+            of the true pairs
+        num_bits: Hyperplanes per table; more bits make buckets smaller
+        seed: Seed for the random hyperplanes
+        chunk_size: Rows compared at a time inside a large bucket
+
+    Returns:
+        Tuple of (clusters with at least two members, each an array of row
+        indices, dict of search statistics)
+    """
+    count = len(embeddings)
+    if count < 2:
+        return [], {'candidate_pairs': 0, 'compared_pairs': 0}
+    vectors = np.asarray(embeddings, dtype=np.float32) - embeddings.mean(axis=0)
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+    rng = np.random.RandomState(seed)
+    bit_values = (1 << np.arange(num_bits)).astype(np.int64)
+    parents = np.arange(count)
+    candidate_pairs = 0
+    compared_pairs = 0
+    for _ in range(num_tables):
+        planes = rng.randn(vectors.shape[1], num_bits).astype(np.float32)
+        codes = ((vectors @ planes) > 0).astype(np.int64) @ bit_values
+        order = np.argsort(codes, kind='stable')
+        _, starts, sizes = np.unique(codes[order], return_index=True,
+                                     return_counts=True)
+        for start, size in zip(starts[sizes > 1], sizes[sizes > 1]):
+            bucket = order[start:start + size]
+            candidate_pairs += size * (size - 1)
+            for offset in range(0, size, chunk_size):
+                rows = bucket[offset:offset + chunk_size]
+                # Rows already joined to the bucket's first image add
+                # nothing: any image they match finds them in turn.
+                first_root = find_roots(parents, bucket[:1])[0]
+                rows = rows[find_roots(parents, rows) != first_root]
+                if not len(rows):
+                    continue
+                compared_pairs += len(rows) * (size - 1)
+                similarity = vectors[rows] @ vectors[bucket].T
+                row_hits, column_hits = np.nonzero(similarity >= threshold)
+                merge_components(parents, rows[row_hits], bucket[column_hits])
+        # Flatten the forest so later lookups take one step.
+        parents = find_roots(parents, np.arange(count))
+
+    order = np.argsort(parents, kind='stable')
+    _, starts, sizes = np.unique(parents[order], return_index=True,
+                                 return_counts=True)
+    clusters = [order[start:start + size]
+                for start, size in zip(starts[sizes > 1], sizes[sizes > 1])]
+    clusters.sort(key=len, reverse=True)
+    stats = {
+        'candidate_pairs': int(candidate_pairs),
+        'compared_pairs': int(compared_pairs),
+    }
+    return clusters, stats
+
+
+def choose_representative(cluster: np.ndarray,
+                          keys: List[Tuple[str, str]]) -> int:
+    """Pick the image to keep from a cluster, preferring the training set."""
+    return min(cluster, key=lambda i: (CATEGORY_PRIORITY.index(keys[i][1]),
+                                       keys[i][0]))
+
+
+def benchmark(size: int, num_clusters: int, threshold: float, num_tables: int,
+              num_bits: int) -> None:
+    """
+    Time find_near_duplicates on synthetic embeddings.
+
+    Runs two cases: distinct random images, and images that all fall into
+    num_clusters large clusters of near-duplicates, as a fixed camera
+    produces.
+    """
+    rng = np.random.default_rng(0)
+    shape = (size, retrain.BOTTLENECK_TENSOR_SIZE)
+    for name in ('distinct', 'clustered'):
+        embeddings = np.abs(rng.standard_normal(shape, dtype=np.float32))
+        if name == 'clustered':
+            centers = np.abs(rng.standard_normal((num_clusters, shape[1]),
+                                                 dtype=np.float32))
+            embeddings *= 0.1
+            embeddings += centers[np.arange(size) % num_clusters]
+        start = time.perf_counter()
+        clusters, stats = find_near_duplicates(embeddings, threshold, num_tables,
+                                               num_bits)
+        seconds = time.perf_counter() - start
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        logger.info(
+            f"{name}: {size} embeddings in {seconds:.2f}s, {len(clusters)} clusters "
+            f"covering {sum(len(c) for c in clusters)} images, "
+            f"{stats['compared_pairs']} of {stats['candidate_pairs']} candidate pairs "
+            f"compared, peak RSS {peak_mb:.0f} MB")
+
+
+def main():
+    """Main entry point for command-line usage."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--image_dir', default='',
+                        help='Path to folders of labeled images.')
+    parser.add_argument('--image_archives', default='',
+                        help='Glob of tar/zip shards to read instead of --image_dir.')
+    parser.add_argument('--bottleneck_dir', default='tf_files/bottlenecks',
+                        help='Path to cached bottleneck values.')
+    parser.add_argument('--model_dir', default='inception',
+                        help='Path to classify_image_graph_def.pb.')
+    parser.add_argument('--threshold', type=float, default=0.95,
+                        help='Cosine similarity at which two images are duplicates.')
+    parser.add_argument('--num_tables', type=int, default=10,
+                        help='Number of LSH tables.')
+    parser.add_argument('--num_bits', type=int, default=16,
+                        help='Hyperplanes per LSH table.')
+    parser.add_argument('--testing_percentage', type=int, default=10,
+                        help='What percentage of images to use as a test set.')
+    parser.add_argument('--validation_percentage', type=int, default=10,
+                        help='What percentage of images to use as a validation set.')
+    parser.add_argument('--report_file', default='',
+                        help='Optional JSON file to write the clusters to.')
+    parser.add_argument('--exclude_file', default='',
+                        help='Optional file listing every duplicate except the '
+                             'one kept per cluster, for retrain.py --exclude_file.')
+    parser.add_argument('--benchmark', type=int, default=0,
+                        help='Instead of reading images, time the search on this '
+                             'many synthetic embeddings, distinct and clustered.')
+    parser.add_argument('--benchmark_clusters', type=int, default=10,
+                        help='Number of duplicate clusters in the clustered benchmark.')
+    args = parser.parse_args()
+
+    if args.benchmark:
+        benchmark(args.benchmark, args.benchmark_clusters, args.threshold,
+                  args.num_tables, args.num_bits)
+        return
+
+    image_lists = retrain.load_image_lists(
+        args.image_dir, args.image_archives, args.testing_percentage,
+        args.validation_percentage)
+    embeddings, keys = load_embeddings(
+        image_lists, args.image_dir, args.bottleneck_dir, args.model_dir)
+
+    start = time.perf_counter()
+    clusters, stats = find_near_duplicates(
+        embeddings, args.threshold, args.num_tables, args.num_bits)
+    duplicates = sum(len(cluster) - 1 for cluster in clusters)
+    logger.info(
+        f"Found {len(clusters)} clusters covering {duplicates} redundant images "
+        f"out of {len(keys)} in {time.perf_counter() - start:.2f}s "
+        f"({stats['compared_pairs']} of {stats['candidate_pairs']} candidate "
+        f"pairs compared)")
+
+    report = []
+    excluded = []
+    for cluster in clusters:
+        keep = choose_representative(cluster, keys)
+        report.append({
+            'keep': keys[keep][0],
+            'members': [{'image': keys[i][0], 'category': keys[i][1]}
+                        for i in cluster],
+        })
+        excluded.extend(keys[i][0] for i in cluster if i != keep)
+    for entry in report[:10]:
+        print(f"{len(entry['members']):5d} images, keeping {entry['keep']}")
+
+    if args.report_file:
+        with open(args.report_file, 'w') as f:
+            json.dump({'threshold': args.threshold, 'stats': stats,
+                       'clusters': report}, f, indent=1)
+    if args.exclude_file:
+        with open(args.exclude_file, 'w') as f:
+            f.write(''.join(key + '\n' for key in sorted(excluded)))
+
+
+if __name__ == '__main__':
+    main()
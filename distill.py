@@ -0,0 +1,614 @@
+"""
+Distill the retrained Inception model into a small student network.
+
+The student is a compact depthwise-separable CNN that runs on raw pixels, so
+it needs no Inception pass and is cheap enough for the Raspberry Pi camera
+nodes. It is trained on the teacher's temperature-softened predictions,
+mixed with the hard labels. The teacher's predictions come from the cached
+bottlenecks, so the teacher never has to run the full Inception graph again
+during training.
+
+Two exports are written:
+- A frozen graph with the same `DecodeJpeg/contents:0` -> `final_result:0`
+  interface as `retrain.py` output, which `WasteClassifier` can load.
+- A TensorFlow Lite model for on-device interpreters.
+
+A report compares the accuracy, latency and size of the student with the
+teacher's.
+
+Example:
+    python distill.py \
+        --image_dir=training_dataset \
+        --bottleneck_dir=tf_files/bottlenecks \
+        --teacher_graph=tf_files/retrained_graph.pb \
+        --teacher_labels=tf_files/retrained_labels.txt
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+import retrain
+from config import Config
+from evaluate import align_image_lists, load_graph, load_labels
+from sweep import sample_batch_indices
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+CATEGORIES = ('training', 'validation', 'testing')
+
+# (output channels at base_filters=16, stride) of each depthwise-separable
+# block after the stem convolution.
+STUDENT_BLOCKS = ((32, 1), (64, 2), (64, 1), (128, 2), (128, 1), (256, 2), (256, 1))
+
+TFLITE_INPUT_NAME = 'input'
+
+
+def preprocess_jpeg(jpeg_data: tf.Tensor, input_size: int) -> tf.Tensor:
+    """
+    Decode a JPEG and resize it to the student's input size.
+
+    Training inputs and the exported graph both go through this, so the
+    student sees identical pixels in both.
+
+    Returns:
+        Uint8 image tensor of shape [input_size, input_size, 3]
+    """
+    image = tf.image.decode_jpeg(jpeg_data, channels=retrain.MODEL_INPUT_DEPTH)
+    resized = tf.compat.v1.image.resize_bilinear(
+        tf.expand_dims(image, 0), [input_size, input_size])
+    return tf.cast(tf.round(tf.clip_by_value(resized[0], 0.0, 255.0)), tf.uint8)
+
+
+def build_student_network(
+    images: tf.Tensor,
+    class_count: int,
+    get_param: Callable[[str, List[int]], tf.Tensor],
+    base_filters: int = 16
+) -> tf.Tensor:
+    """
+    Build the student network.
+
+    Args:
+        images: Float tensor [N, S, S, 3] with values in [0, 1]
+        class_count: Number of output classes
+        get_param: Function returning the parameter tensor for a name and
+            shape, so the same code builds the trainable and the frozen graph
+        base_filters: Channels of the stem; every block scales with it
+
+    Returns:
+        Logits tensor [N, class_count]
+    """
+    net = images * 2.0 - 1.0
+    channels = base_filters
+    net = tf.nn.relu6(
+        tf.nn.conv2d(net, get_param('stem/weights', [3, 3, 3, channels]),
+                     [1, 2, 2, 1], 'SAME') +
+        get_param('stem/bias', [channels]))
+    for i, (filters, stride) in enumerate(STUDENT_BLOCKS):
+        filters = filters * base_filters // 16
+        net = tf.nn.relu6(
+            tf.nn.depthwise_conv2d(
+                net, get_param(f'block{i}/depthwise', [3, 3, channels, 1]),
+                [1, stride, stride, 1], 'SAME') +
+            get_param(f'block{i}/depthwise_bias', [channels]))
+        net = tf.nn.relu6(
+            tf.nn.conv2d(net, get_param(f'block{i}/pointwise',
+                                        [1, 1, channels, filters]),
+                         [1, 1, 1, 1], 'SAME') +
+            get_param(f'block{i}/pointwise_bias', [filters]))
+        channels = filters
+    features = tf.reduce_mean(net, axis=[1, 2])
+    return (tf.matmul(features, get_param('logits/weights', [channels, class_count])) +
+            get_param('logits/bias', [class_count]))
+
+
+def load_distillation_data(
+    image_lists: dict,
+    image_dir: str,
+    bottleneck_dir: str,
+    teacher_graph: tf.compat.v1.Graph,
+    input_size: int,
+    cache_dir: str,
+    batch_size: int = 1000
+) -> Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    Load student inputs, hard labels and teacher predictions for every split.
+
+    Teacher predictions are computed from the cached bottlenecks. Student
+    inputs are decoded and resized once, then kept as uint8 .npy files in
+    cache_dir and memory-mapped on later runs.
+
+    Args:
+        image_lists: Image lists aligned with the teacher's labels
+        image_dir: Root folder of the class-named image subfolders
+        bottleneck_dir: Folder holding cached bottleneck files
+        teacher_graph: Graph of the retrained teacher
+        input_size: Side length of the student's input
+        cache_dir: Folder for the resized student inputs
+        batch_size: Number of bottlenecks fed to the teacher at a time
+
+    Returns:
+        Dict of category to (uint8 pixels [N, S, S, 3], int64 labels [N],
+        float32 teacher probabilities [N, C])
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    preprocess_graph = tf.compat.v1.Graph()
+    with preprocess_graph.as_default():
+        jpeg_input = tf.compat.v1.placeholder(tf.string)
+        preprocessed = preprocess_jpeg(jpeg_input, input_size)
+
+    data = {}
+    with tf.compat.v1.Session(graph=teacher_graph) as teacher_sess, \
+            tf.compat.v1.Session(graph=preprocess_graph) as preprocess_sess:
+        for category in CATEGORIES:
+            probabilities = []
+            labels = []
+            for bottlenecks, batch_labels, _ in retrain.iter_cached_bottleneck_batches(
+                    teacher_sess, image_lists, batch_size, category,
+                    bottleneck_dir, image_dir,
+                    teacher_graph.get_tensor_by_name(retrain.JPEG_DATA_TENSOR_NAME),
+                    teacher_graph.get_tensor_by_name(retrain.BOTTLENECK_TENSOR_NAME)):
+                probabilities.append(teacher_sess.run(
+                    teacher_graph.get_tensor_by_name('final_result:0'),
+                    {teacher_graph.get_tensor_by_name(
+                        'input/BottleneckInputPlaceholder:0'): bottlenecks}))
+                labels.append(batch_labels)
+            class_count = len(image_lists)
+            probabilities = (np.concatenate(probabilities) if probabilities
+                             else np.zeros([0, class_count], np.float32))
+            labels = (np.concatenate(labels) if labels
+                      else np.zeros([0], np.int64))
+
+            # Same order as iter_cached_bottleneck_batches: label by label.
+            keys = [(label_name, index, label_lists['dir'] + '/' + base_name)
+                    for label_name, label_lists in image_lists.items()
+                    for index, base_name in enumerate(label_lists[category])]
+            pixels_path = os.path.join(cache_dir, f'{category}-{input_size}.npy')
+            keys_path = os.path.join(cache_dir, f'{category}-{input_size}.json')
+            cached_keys = None
+            if os.path.exists(keys_path) and os.path.exists(pixels_path):
+                with open(keys_path) as f:
+                    cached_keys = json.load(f)
+            if cached_keys == [key for _, _, key in keys]:
+                pixels = np.load(pixels_path, mmap_mode='r')
+            else:
+                pixels = np.lib.format.open_memmap(
+                    pixels_path, mode='w+', dtype=np.uint8,
+                    shape=(len(keys), input_size, input_size, 3))
+                for row, (label_name, index, _) in enumerate(keys):
+                    pixels[row] = preprocess_sess.run(preprocessed, {
+                        jpeg_input: retrain.read_image_data(
+                            image_lists, label_name, index, image_dir, category)})
+                pixels.flush()
+                with open(keys_path, 'w') as f:
+                    json.dump([key for _, _, key in keys], f)
+            data[category] = (pixels, labels, probabilities.astype(np.float32))
+            logger.info(f"Loaded {len(labels)} {category} images")
+    return data
+
+
+def train_student(
+    data: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]],
+    class_count: int,
+    input_size: int,
+    base_filters: int = 16,
+    steps: int = 3000,
+    batch_size: int = 64,
+    learning_rate: float = 0.001,
+    temperature: float = 4.0,
+    alpha: float = 0.7,
+    eval_interval: int = 100,
+    seed: int = 0
+) -> Tuple[Dict[str, np.ndarray], dict]:
+    """
+    Train the student on a mix of softened teacher targets and hard labels.
+
+    The loss is alpha * T^2 * cross-entropy to the teacher's predictions at
+    temperature T, plus (1 - alpha) * cross-entropy to the true labels.
+    Batches are sampled class-uniformly and randomly mirrored. The weights
+    with the best validation accuracy are kept.
+
+    Args:
+        data: Output of load_distillation_data
+        class_count: Number of classes
+        input_size: Side length of the student's input
+        base_filters: Width of the student network
+        steps: Number of training steps
+        batch_size: Images per step
+        learning_rate: Adam learning rate
+        temperature: Softmax temperature applied to teacher and student
+        alpha: Weight of the distillation term
+        eval_interval: Steps between validation evaluations
+        seed: Random seed
+
+    Returns:
+        Tuple of (dict of parameter name to trained values, dict of training
+        statistics)
+    """
+    train_pixels, train_labels, train_teacher = data['training']
+    validation_pixels, validation_labels, _ = data['validation']
+    class_counts = np.bincount(train_labels, minlength=class_count)
+    if not np.all(class_counts):
+        raise ValueError("Every label needs at least one training image")
+    class_offsets = np.concatenate([[0], np.cumsum(class_counts)[:-1]])
+
+    graph = tf.compat.v1.Graph()
+    with graph.as_default():
+        tf.compat.v1.set_random_seed(seed)
+        images = tf.compat.v1.placeholder(
+            tf.uint8, [None, input_size, input_size, 3], name='images')
+        hard_labels = tf.compat.v1.placeholder(tf.int64, [None], name='labels')
+        teacher_probabilities = tf.compat.v1.placeholder(
+            tf.float32, [None, class_count], name='teacher_probabilities')
+        params = {}
+
+        def get_param(name: str, shape: List[int]) -> tf.Tensor:
+            if name.endswith('bias'):
+                initializer = tf.compat.v1.zeros_initializer()
+            else:
+                initializer = tf.compat.v1.variance_scaling_initializer(2.0)
+            params[name] = tf.compat.v1.get_variable(name, shape,
+                                                     initializer=initializer)
+            return params[name]
+
+        with tf.compat.v1.variable_scope('student'):
+            logits = build_student_network(
+                tf.cast(images, tf.float32) / 255.0, class_count, get_param,
+                base_filters)
+        # Softening the teacher by T is softmax(log(p) / T).
+        soft_targets = tf.nn.softmax(
+            tf.math.log(tf.maximum(teacher_probabilities, 1e-8)) / temperature)
+        distillation_loss = tf.reduce_mean(tf.reduce_sum(
+            -soft_targets * tf.nn.log_softmax(logits / temperature), axis=1))
+        hard_loss = tf.reduce_mean(
+            tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=hard_labels, logits=logits))
+        loss = (alpha * temperature ** 2 * distillation_loss +
+                (1.0 - alpha) * hard_loss)
+        train_step = tf.compat.v1.train.AdamOptimizer(learning_rate).minimize(loss)
+        predictions = tf.argmax(logits, 1)
+        init = tf.compat.v1.global_variables_initializer()
+
+    def accuracy(sess, pixels, labels):
+        if not len(labels):
+            return 0.0
+        correct = 0
+        for start in range(0, len(labels), 256):
+            correct += int(np.sum(sess.run(
+                predictions, {images: pixels[start:start + 256]}) ==
+                labels[start:start + 256]))
+        return correct / len(labels)
+
+    rng = np.random.RandomState(seed)
+    best_accuracy = -1.0
+    best_values = None
+    best_step = 0
+    start = time.perf_counter()
+    with tf.compat.v1.Session(graph=graph) as sess:
+        sess.run(init)
+        for step in range(1, steps + 1):
+            indices = np.sort(sample_batch_indices(
+                rng, class_offsets, class_counts, batch_size))
+            batch = np.array(train_pixels[indices])
+            mirror = rng.rand(batch_size) < 0.5
+            batch[mirror] = batch[mirror, :, ::-1]
+            batch_loss, _ = sess.run([loss, train_step], {
+                images: batch,
+                hard_labels: train_labels[indices],
+                teacher_probabilities: train_teacher[indices],
+            })
+            if step % eval_interval == 0 or step == steps:
+                validation_accuracy = accuracy(
+                    sess, validation_pixels, validation_labels)
+                logger.info(f"Step {step}: loss {batch_loss:.4f}, "
+                            f"validation accuracy {validation_accuracy:.1%}")
+                if validation_accuracy > best_accuracy:
+                    best_accuracy = validation_accuracy
+                    best_values = sess.run(params)
+                    best_step = step
+    stats = {
+        'best_step': best_step,
+        'best_validation_accuracy': best_accuracy,
+        'seconds': time.perf_counter() - start,
+    }
+    return best_values, stats
+
+
+def build_inference_graph(
+    values: Dict[str, np.ndarray],
+    class_count: int,
+    input_size: int,
+    base_filters: int,
+    from_jpeg: bool
+) -> Tuple[tf.compat.v1.Graph, tf.Tensor, tf.Tensor]:
+    """
+    Build a constant-only student graph for export.
+
+    Args:
+        values: Trained parameter values
+        class_count: Number of classes
+        input_size: Side length of the student's input
+        base_filters: Width of the student network
+        from_jpeg: If true, the input is 'DecodeJpeg/contents' as in the
+            retrained graph; otherwise it is a float 'input' tensor
+            [N, S, S, 3] with values in [0, 1], as used by TensorFlow Lite
+
+    Returns:
+        Tuple of (graph, input tensor, 'final_result' softmax tensor)
+    """
+    graph = tf.compat.v1.Graph()
+    with graph.as_default():
+        if from_jpeg:
+            with tf.compat.v1.name_scope('DecodeJpeg'):
+                input_tensor = tf.compat.v1.placeholder(tf.string, name='contents')
+            images = tf.expand_dims(tf.cast(
+                preprocess_jpeg(input_tensor, input_size), tf.float32) / 255.0, 0)
+        else:
+            input_tensor = tf.compat.v1.placeholder(
+                tf.float32, [None, input_size, input_size, 3],
+                name=TFLITE_INPUT_NAME)
+            images = input_tensor
+        with tf.compat.v1.name_scope('student'):
+            logits = build_student_network(
+                images, class_count,
+                lambda name, shape: tf.constant(values[name], name=name),
+                base_filters)
+        output = tf.nn.softmax(logits, name='final_result')
+    return graph, input_tensor, output
+
+
+def export_student(
+    values: Dict[str, np.ndarray],
+    label_names: List[str],
+    input_size: int,
+    base_filters: int,
+    output_graph: str,
+    output_labels: str,
+    output_tflite: str,
+    quantize: bool = True
+) -> None:
+    """
+    Write the frozen student graph, its labels and its TensorFlow Lite model.
+
+    Args:
+        values: Trained parameter values
+        label_names: Label strings in class index order
+        input_size: Side length of the student's input
+        base_filters: Width of the student network
+        output_graph: Path of the frozen GraphDef
+        output_labels: Path of the labels file
+        output_tflite: Path of the .tflite model
+        quantize: Whether to quantize the TensorFlow Lite weights to 8 bits
+    """
+    class_count = len(label_names)
+    graph, _, _ = build_inference_graph(
+        values, class_count, input_size, base_filters, from_jpeg=True)
+    for path in (output_graph, output_labels, output_tflite):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+    with tf.io.gfile.GFile(output_graph, 'wb') as f:
+        f.write(graph.as_graph_def().SerializeToString())
+    with tf.io.gfile.GFile(output_labels, 'w') as f:
+        f.write('\n'.join(label_names) + '\n')
+
+    graph, input_tensor, output = build_inference_graph(
+        values, class_count, input_size, base_filters, from_jpeg=False)
+    with tf.compat.v1.Session(graph=graph) as sess:
+        converter = tf.compat.v1.lite.TFLiteConverter.from_session(
+            sess, [input_tensor], [output])
+        if quantize:
+            converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        with open(output_tflite, 'wb') as f:
+            f.write(converter.convert())
+
+
+def measure_latency(run: Callable[[object], object], inputs: list,
+                    warmup: int = 3) -> Dict[str, float]:
+    """Time run on each input, returning the mean and 95th percentile in ms."""
+    for item in inputs[:warmup]:
+        run(item)
+    timings = []
+    for item in inputs:
+        start = time.perf_counter()
+        run(item)
+        timings.append((time.perf_counter() - start) * 1000)
+    return {'mean_ms': float(np.mean(timings)),
+            'p95_ms': float(np.percentile(timings, 95))}
+
+
+def build_report(
+    data: Dict[str, Tuple[np.ndarray, np.ndarray, np.ndarray]],
+    image_lists: dict,
+    image_dir: str,
+    teacher_graph_path: str,
+    student_graph_path: str,
+    tflite_path: str,
+    latency_samples: int = 50
+) -> dict:
+    """
+    Compare the student with the teacher on the test split.
+
+    Accuracy is measured on every test image, using the TensorFlow Lite
+    student as it would be deployed. Latency is measured per image,
+    one at a time, from JPEG bytes for both frozen graphs and from
+    preprocessed pixels for the TensorFlow Lite model.
+
+    Returns:
+        Report dictionary
+    """
+    pixels, labels, teacher_probabilities = data['testing']
+    teacher_predictions = np.argmax(teacher_probabilities, axis=1)
+
+    tflite = tf.lite.Interpreter(model_path=tflite_path)
+    input_detail = tflite.get_input_details()[0]
+    output_index = tflite.get_output_details()[0]['index']
+    tflite.resize_tensor_input(input_detail['index'],
+                               [1] + list(pixels.shape[1:]))
+    tflite.allocate_tensors()
+
+    def run_tflite(image: np.ndarray) -> np.ndarray:
+        tflite.set_tensor(input_detail['index'],
+                          image[None].astype(np.float32) / 255.0)
+        tflite.invoke()
+        return tflite.get_tensor(output_index)[0]
+
+    student_predictions = np.array(
+        [np.argmax(run_tflite(image)) for image in pixels], dtype=np.int64)
+
+    jpegs = []
+    for label_name, label_lists in image_lists.items():
+        for index in range(len(label_lists['testing'])):
+            if len(jpegs) < latency_samples:
+                jpegs.append(retrain.read_image_data(
+                    image_lists, label_name, index, image_dir, 'testing'))
+    latency = {}
+    for name, path in (('teacher', teacher_graph_path),
+                       ('student', student_graph_path)):
+        graph = load_graph(path)
+        with tf.compat.v1.Session(graph=graph) as sess:
+            output = graph.get_tensor_by_name('final_result:0')
+            jpeg_input = graph.get_tensor_by_name(retrain.JPEG_DATA_TENSOR_NAME)
+            latency[name] = measure_latency(
+                lambda jpeg: sess.run(output, {jpeg_input: jpeg}), jpegs)
+
+    count = max(len(labels), 1)
+    return {
+        'test_images': int(len(labels)),
+        'teacher': {
+            'accuracy': float(np.sum(teacher_predictions == labels) / count),
+            'latency_from_jpeg': latency['teacher'],
+            'model_bytes': os.path.getsize(teacher_graph_path),
+        },
+        'student': {
+            'accuracy': float(np.sum(student_predictions == labels) / count),
+            'agreement_with_teacher': float(
+                np.sum(student_predictions == teacher_predictions) / count),
+            'latency_from_jpeg': latency['student'],
+            'tflite_latency_from_pixels': measure_latency(
+                run_tflite, list(pixels[:latency_samples])),
+            'model_bytes': os.path.getsize(student_graph_path),
+            'tflite_bytes': os.path.getsize(tflite_path),
+        },
+    }
+
+
+def print_report(report: dict) -> None:
+    """Print the teacher/student comparison as a table."""
+    teacher = report['teacher']
+    student = report['student']
+    print(f"=== DISTILLATION REPORT ({report['test_images']} test images) ===")
+    print(f"{'':28s}{'teacher':>12s}{'student':>12s}")
+    print(f"{'accuracy':28s}{teacher['accuracy']:>12.1%}{student['accuracy']:>12.1%}")
+    print(f"{'mean latency from JPEG':28s}"
+          f"{teacher['latency_from_jpeg']['mean_ms']:>10.1f}ms"
+          f"{student['latency_from_jpeg']['mean_ms']:>10.1f}ms")
+    print(f"{'p95 latency from JPEG':28s}"
+          f"{teacher['latency_from_jpeg']['p95_ms']:>10.1f}ms"
+          f"{student['latency_from_jpeg']['p95_ms']:>10.1f}ms")
+    print(f"{'model size':28s}{teacher['model_bytes'] / 1e6:>10.2f}MB"
+          f"{student['model_bytes'] / 1e6:>10.2f}MB")
+    print(f"Student agrees with the teacher on {student['agreement_with_teacher']:.1%} "
+          f"of test images")
+    print(f"TFLite student: {student['tflite_bytes'] / 1e6:.2f}MB, "
+          f"{student['tflite_latency_from_pixels']['mean_ms']:.2f}ms mean per image")
+
+
+def main():
+    """Main entry point for command-line usage."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--image_dir', default='',
+                        help='Path to folders of labeled images.')
+    parser.add_argument('--image_archives', default='',
+                        help='Glob of tar/zip shards to read instead of --image_dir.')
+    parser.add_argument('--bottleneck_dir', default='tf_files/bottlenecks',
+                        help='Path to cached bottleneck values.')
+    parser.add_argument('--teacher_graph', default=Config.MODEL_PATH,
+                        help='Retrained graph to distill.')
+    parser.add_argument('--teacher_labels', default=Config.LABEL_PATH,
+                        help='Labels file written with the teacher graph.')
+    parser.add_argument('--cache_dir', default='tf_files/student_inputs',
+                        help='Where to cache the resized student inputs.')
+    parser.add_argument('--input_size', type=int, default=128,
+                        help='Side length of the student input image.')
+    parser.add_argument('--base_filters', type=int, default=16,
+                        help='Width of the student network.')
+    parser.add_argument('--training_steps', type=int, default=3000,
+                        help='How many training steps to run.')
+    parser.add_argument('--train_batch_size', type=int, default=64,
+                        help='How many images to train on at a time.')
+    parser.add_argument('--learning_rate', type=float, default=0.001,
+                        help='Adam learning rate.')
+    parser.add_argument('--temperature', type=float, default=4.0,
+                        help='Softmax temperature for the teacher targets.')
+    parser.add_argument('--alpha', type=float, default=0.7,
+                        help='Weight of the teacher targets against the hard labels.')
+    parser.add_argument('--eval_interval', type=int, default=100,
+                        help='Steps between validation evaluations.')
+    parser.add_argument('--testing_percentage', type=int, default=10,
+                        help='What percentage of images to use as a test set.')
+    parser.add_argument('--validation_percentage', type=int, default=10,
+                        help='What percentage of images to use as a validation set.')
+    parser.add_argument('--no_quantize', action='store_true',
+                        help='Keep float weights in the TensorFlow Lite model.')
+    parser.add_argument('--latency_samples', type=int, default=50,
+                        help='How many test images to time each model on.')
+    parser.add_argument('--output_graph', default='tf_files/student_graph.pb',
+                        help='Where to save the frozen student graph.')
+    parser.add_argument('--output_labels', default='tf_files/student_labels.txt',
+                        help='Where to save the student graph\'s labels.')
+    parser.add_argument('--output_tflite', default='tf_files/student.tflite',
+                        help='Where to save the TensorFlow Lite student.')
+    parser.add_argument('--report_file', default='tf_files/student_report.json',
+                        help='Where to save the comparison report.')
+    args = parser.parse_args()
+
+    label_names = load_labels(args.teacher_labels)
+    image_lists = retrain.load_image_lists(
+        args.image_dir, args.image_archives, args.testing_percentage,
+        args.validation_percentage)
+    if not image_lists:
+        logger.error(f"No images found in {args.image_archives or args.image_dir}")
+        sys.exit(1)
+    image_lists = align_image_lists(image_lists, label_names)
+
+    data = load_distillation_data(
+        image_lists, args.image_dir, args.bottleneck_dir,
+        load_graph(args.teacher_graph), args.input_size, args.cache_dir)
+    values, stats = train_student(
+        data, len(label_names), args.input_size,
+        base_filters=args.base_filters,
+        steps=args.training_steps,
+        batch_size=args.train_batch_size,
+        learning_rate=args.learning_rate,
+        temperature=args.temperature,
+        alpha=args.alpha,
+        eval_interval=args.eval_interval)
+    logger.info(f"Trained student in {stats['seconds']:.1f}s, keeping step "
+                f"{stats['best_step']} ({stats['best_validation_accuracy']:.1%} "
+                f"validation accuracy)")
+
+    export_student(values, label_names, args.input_size, args.base_filters,
+                   args.output_graph, args.output_labels, args.output_tflite,
+                   quantize=not args.no_quantize)
+    report = build_report(data, image_lists, args.image_dir, args.teacher_graph,
+                          args.output_graph, args.output_tflite,
+                          args.latency_samples)
+    report['training'] = stats
+    print_report(report)
+    with open(args.report_file, 'w') as f:
+        json.dump(report, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
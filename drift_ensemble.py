@@ -0,0 +1,429 @@
+"""
+Particle-ensemble drift simulation for reported waste.
+
+drift.predict_drift moves each report along one constant velocity. This
+module instead releases a cloud of particles at each report and integrates
+them with fourth-order Runge-Kutta through gridded velocity fields that
+vary in space and time. Each particle draws its own error in the speed and
+direction of the flow, and random-walk diffusion is added at every step.
+The spread of the cloud at each horizon gives an uncertainty cone around
+the most likely position.
+
+All particles of all reports advance together as NumPy arrays. Large runs
+are split by report across a pool of worker processes.
+
+Example:
+    python drift_ensemble.py --reports=1000 --particles=100 --workers=4
+"""
+import argparse
+import logging
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Sequence
+
+import numpy as np
+
+from config import Config
+from drift import DEFAULT_HOURS, METERS_PER_DEGREE, WIND_FACTOR
+from weather_cache import KINDS, FixtureProvider, WeatherCache
+
+logger = logging.getLogger(__name__)
+
+
+class GriddedField:
+    """
+    Surface velocity on a regular lat/lng grid, at a series of times.
+
+    Velocities are sampled by bilinear interpolation in space and linear
+    interpolation in time. Positions and times outside the grid take the
+    value at its edge.
+    """
+
+    def __init__(self, times, lats, lngs, u, v):
+        """
+        Initialize the field.
+
+        Args:
+            times: Evenly spaced times of the slices, in seconds from the
+                start of the simulation
+            lats: Evenly spaced latitudes of the grid rows, ascending
+            lngs: Evenly spaced longitudes of the grid columns, ascending
+            u: Eastward velocity in m/s, of shape [times, lats, lngs]
+            v: Northward velocity in m/s, of shape [times, lats, lngs]
+        """
+        self.times = np.atleast_1d(np.asarray(times, dtype=np.float64))
+        self.lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+        self.lngs = np.atleast_1d(np.asarray(lngs, dtype=np.float64))
+        shape = (len(self.times), len(self.lats), len(self.lngs))
+        self.u = np.asarray(u, dtype=np.float64).reshape(shape)
+        self.v = np.asarray(v, dtype=np.float64).reshape(shape)
+
+    @classmethod
+    def combine(cls, times, lats, lngs, wind_u, wind_v, current_u, current_v):
+        """
+        Build the surface drift field from wind and current fields.
+
+        As in drift.predict_drift, waste moves with the current plus a
+        tenth of the wind.
+
+        Args:
+            times, lats, lngs: Grid axes, as for the constructor
+            wind_u, wind_v: Wind velocity in m/s
+            current_u, current_v: Current velocity in m/s
+
+        Returns:
+            GriddedField of the drift velocity
+        """
+        return cls(times, lats, lngs,
+                   np.asarray(current_u) + WIND_FACTOR * np.asarray(wind_u),
+                   np.asarray(current_v) + WIND_FACTOR * np.asarray(wind_v))
+
+    @staticmethod
+    def _axis(axis: np.ndarray, values: np.ndarray):
+        """Get the lower grid index and weight of values along an axis."""
+        if len(axis) == 1:
+            zeros = np.zeros(values.shape, dtype=np.intp)
+            return zeros, zeros, np.zeros(values.shape)
+        position = np.clip((values - axis[0]) / (axis[1] - axis[0]), 0, len(axis) - 1)
+        lower = np.minimum(position.astype(np.intp), len(axis) - 2)
+        return lower, lower + 1, position - lower
+
+    def sample(self, t: float, lat: np.ndarray, lng: np.ndarray):
+        """
+        Get the velocity at some positions.
+
+        Args:
+            t: Time in seconds from the start of the simulation
+            lat: Latitudes in degrees
+            lng: Longitudes in degrees
+
+        Returns:
+            Tuple of eastward and northward velocity arrays in m/s
+        """
+        t0, t1, wt = self._axis(self.times, np.asarray(float(t)))
+        y0, y1, wy = self._axis(self.lats, lat)
+        x0, x1, wx = self._axis(self.lngs, lng)
+        # Flat indices and weights of the four surrounding grid points,
+        # shared by both components and both time slices.
+        columns = len(self.lngs)
+        corners = [(y0 * columns + x0, (1 - wy) * (1 - wx)),
+                   (y0 * columns + x1, (1 - wy) * wx),
+                   (y1 * columns + x0, wy * (1 - wx)),
+                   (y1 * columns + x1, wy * wx)]
+        results = []
+        for grid in (self.u, self.v):
+            value = 0.0
+            for ti, tw in ((int(t0), 1 - float(wt)), (int(t1), float(wt))):
+                if not tw:
+                    continue
+                layer = grid[ti].ravel()
+                value = value + tw * sum(weight * layer.take(index)
+                                         for index, weight in corners)
+            results.append(value)
+        return results[0], results[1]
+
+
+def _fill_nearest(values: np.ndarray, known: np.ndarray) -> np.ndarray:
+    """
+    Fill the unknown cells of a grid from the nearest known cell.
+
+    Known cells spread one ring per pass, a cell taking the value of a side
+    neighbour before a diagonal one. Around a single block of known cells
+    this gives every outside cell the value of the nearest edge cell, as
+    GriddedField does for positions beyond its edge.
+
+    Args:
+        values: Array of shape [lats, lngs, ...]; unknown cells are ignored
+        known: Boolean array of shape [lats, lngs], True where values is set
+
+    Returns:
+        Copy of values with every cell set
+    """
+    values = values.copy()
+    known = known.copy()
+    rows, columns = known.shape
+    offsets = [(0, -1), (0, 1), (-1, 0), (1, 0), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+    while not known.all():
+        source_known = known.copy()
+        source = values.copy()
+        for dy, dx in offsets:
+            # Cells whose neighbour at (dy, dx) was known before this pass.
+            target = (slice(max(-dy, 0), rows - max(dy, 0)),
+                      slice(max(-dx, 0), columns - max(dx, 0)))
+            neighbour = (slice(max(dy, 0), rows - max(-dy, 0)),
+                         slice(max(dx, 0), columns - max(-dx, 0)))
+            fill = ~known[target] & source_known[neighbour]
+            values[target][fill] = source[neighbour][fill]
+            known[target] |= fill
+    return values
+
+
+def field_from_cache(cache, lat, lng, grid: float = 1.0,
+                     margin: float = 2.0) -> GriddedField:
+    """
+    Build a drift field around reports from the weather cache.
+
+    Conditions are looked up at every grid point within margin degrees of
+    a report. Points between far-apart reports take the conditions of the
+    nearest point looked up, just as positions beyond the grid take those
+    at its edge, so particles keep moving there instead of stalling, and
+    a report's cone does not depend on reports far from it.
+    The cache holds current conditions, so the field is steady in time.
+
+    Args:
+        cache: weather_cache.WeatherCache to look conditions up in
+        lat: Latitudes of the reports in degrees
+        lng: Longitudes of the reports in degrees
+        grid: Grid spacing in degrees
+        margin: Distance around each report to cover, in degrees
+
+    Returns:
+        GriddedField covering the reports
+    """
+    lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+    lng = np.atleast_1d(np.asarray(lng, dtype=np.float64))
+    lats = np.arange(math.floor((lat.min() - margin) / grid),
+                     math.ceil((lat.max() + margin) / grid) + 1) * grid
+    lngs = np.arange(math.floor((lng.min() - margin) / grid),
+                     math.ceil((lng.max() + margin) / grid) + 1) * grid
+
+    reach = int(math.ceil(margin / grid))
+    needed = np.zeros((len(lats), len(lngs)), dtype=bool)
+    rows = np.rint((lat - lats[0]) / grid).astype(np.intp)
+    columns = np.rint((lng - lngs[0]) / grid).astype(np.intp)
+    for row, column in set(zip(rows.tolist(), columns.tolist())):
+        needed[max(row - reach, 0):row + reach + 1,
+               max(column - reach, 0):column + reach + 1] = True
+    ys, xs = np.nonzero(needed)
+    points = list(zip(lats[ys].tolist(), lngs[xs].tolist()))
+
+    # Eastward and northward wind and current at the points looked up.
+    components = np.zeros(needed.shape + (2 * len(KINDS),))
+    for i, kind in enumerate(KINDS):
+        values = np.asarray(cache.get_many(kind, points), dtype=np.float64).reshape(-1, 2)
+        radians = np.radians(values[:, 1])
+        components[ys, xs, 2 * i] = values[:, 0] * np.sin(radians)
+        components[ys, xs, 2 * i + 1] = values[:, 0] * np.cos(radians)
+    components = dict(zip(KINDS, np.split(_fill_nearest(components, needed), len(KINDS),
+                                          axis=-1)))
+    return GriddedField.combine([0.0], lats, lngs,
+                                components["wind"][..., 0], components["wind"][..., 1],
+                                components["current"][..., 0], components["current"][..., 1])
+
+
+def _simulate_chunk(field: GriddedField, lat: np.ndarray, lng: np.ndarray,
+                    hours: Sequence[float], particles: int, step: float,
+                    speed_sigma: float, direction_sigma: float,
+                    diffusivity: float, seed: int, first: int) -> Dict[str, np.ndarray]:
+    """
+    Simulate the ensembles of some reports; see simulate_ensemble.
+
+    Each report draws from its own random stream, keyed by the seed and its
+    index first + i in the request, so its cone does not depend on the
+    other reports or on how they are split into chunks.
+    """
+    rngs = [np.random.default_rng([seed, first + i]) for i in range(len(lat))]
+    reports = len(lat)
+
+    def normal(loc, sigma):
+        return np.concatenate([rng.normal(loc, sigma, particles) for rng in rngs])
+
+    y = np.repeat(lat, particles)
+    x = np.repeat(lng, particles)
+    # Each particle's error in the speed and direction of the flow.
+    scale = np.maximum(normal(1.0, speed_sigma), 0.0)
+    angle = np.radians(normal(0.0, direction_sigma))
+    cos_a, sin_a = scale * np.cos(angle), scale * np.sin(angle)
+    kick = math.sqrt(2 * diffusivity * step)
+
+    def velocity(t, y, x):
+        u, v = field.sample(t, y, x)
+        u, v = u * cos_a + v * sin_a, v * cos_a - u * sin_a
+        return (v / METERS_PER_DEGREE,
+                u / (METERS_PER_DEGREE * np.maximum(np.cos(np.radians(y)), 1e-6)))
+
+    horizons = sorted(set(float(h) for h in hours))
+    steps: Dict[int, list] = {}
+    for h in horizons:
+        steps.setdefault(max(int(round(h * 3600 / step)), 1), []).append(h)
+    positions = {}
+    t = 0.0
+    for n in range(1, max(steps) + 1):
+        k1y, k1x = velocity(t, y, x)
+        k2y, k2x = velocity(t + step / 2, y + k1y * step / 2, x + k1x * step / 2)
+        k3y, k3x = velocity(t + step / 2, y + k2y * step / 2, x + k2x * step / 2)
+        k4y, k4x = velocity(t + step, y + k3y * step, x + k3x * step)
+        y = y + step / 6 * (k1y + 2 * k2y + 2 * k3y + k4y)
+        x = x + step / 6 * (k1x + 2 * k2x + 2 * k3x + k4x)
+        if kick:
+            y = y + kick * normal(0.0, 1.0) / METERS_PER_DEGREE
+            x = x + kick * normal(0.0, 1.0) / (
+                METERS_PER_DEGREE * np.maximum(np.cos(np.radians(y)), 1e-6))
+        y = np.clip(y, -89.9, 89.9)
+        t += step
+        for h in steps.get(n, ()):
+            positions[h] = (y.reshape(reports, particles),
+                            x.reshape(reports, particles))
+
+    summary = {name: np.zeros((reports, len(horizons)))
+               for name in ("lat", "lng", "radius_50", "radius_90")}
+    for j, h in enumerate(horizons):
+        py, px = positions[h]
+        center_y, center_x = py.mean(axis=1), px.mean(axis=1)
+        dy = (py - center_y[:, None]) * METERS_PER_DEGREE
+        dx = (px - center_x[:, None]) * METERS_PER_DEGREE * np.cos(
+            np.radians(center_y))[:, None]
+        distance = np.hypot(dx, dy)
+        summary["lat"][:, j] = center_y
+        summary["lng"][:, j] = (center_x + 180.0) % 360.0 - 180.0
+        summary["radius_50"][:, j] = np.percentile(distance, 50, axis=1)
+        summary["radius_90"][:, j] = np.percentile(distance, 90, axis=1)
+    return summary
+
+
+def simulate_ensemble(
+    field: GriddedField,
+    lat,
+    lng,
+    hours: Sequence[float] = DEFAULT_HOURS,
+    particles: int = 100,
+    step: float = 3600.0,
+    speed_sigma: float = 0.2,
+    direction_sigma: float = 15.0,
+    diffusivity: float = 10.0,
+    seed: int = 0,
+    executor: Optional[ProcessPoolExecutor] = None,
+    chunk_size: int = 250,
+    max_hours: Optional[float] = None
+) -> Dict[str, np.ndarray]:
+    """
+    Simulate a particle ensemble for each report.
+
+    Args:
+        field: Drift velocity field
+        lat: Latitudes of the reports in degrees
+        lng: Longitudes of the reports in degrees
+        hours: Horizons to report, in hours
+        particles: Particles per report
+        step: Integration time step in seconds; horizons are rounded to it
+        speed_sigma: Standard deviation of each particle's relative error
+            in the flow speed
+        direction_sigma: Standard deviation of each particle's error in
+            the flow direction, in degrees
+        diffusivity: Horizontal diffusivity of the random walk, in m^2/s
+        seed: Random seed; the same seed gives the same result
+        executor: Optional process pool to spread chunks of reports over
+        chunk_size: Reports per chunk given to a worker
+        max_hours: Longest horizon accepted, bounding the number of steps
+            (defaults to Config.DRIFT_MAX_HOURS)
+
+    Returns:
+        Dictionary of arrays of shape [reports, horizons], horizons sorted:
+        "lat" and "lng" of the center of each ensemble, and "radius_50"
+        and "radius_90", the distance in meters from the center within
+        which half and nine tenths of the particles lie
+
+    Raises:
+        ValueError: If a horizon is not a finite number above 0 and up to
+            max_hours
+    """
+    max_hours = Config.DRIFT_MAX_HOURS if max_hours is None else max_hours
+    if not hours or not all(math.isfinite(h) and 0 < h <= max_hours for h in hours):
+        raise ValueError(f"hours must be above 0 and up to {max_hours}")
+    lat = np.atleast_1d(np.asarray(lat, dtype=np.float64))
+    lng = np.atleast_1d(np.asarray(lng, dtype=np.float64))
+    args = (hours, particles, step, speed_sigma, direction_sigma, diffusivity)
+    starts = range(0, len(lat), chunk_size)
+    if executor is None or len(starts) == 1:
+        chunks = [_simulate_chunk(field, lat[i:i + chunk_size], lng[i:i + chunk_size],
+                                  *args, seed, i) for i in starts]
+    else:
+        futures = [executor.submit(_simulate_chunk, field, lat[i:i + chunk_size],
+                                   lng[i:i + chunk_size], *args, seed, i)
+                   for i in starts]
+        chunks = [future.result() for future in futures]
+    return {name: np.concatenate([chunk[name] for chunk in chunks])
+            for name in chunks[0]}
+
+
+def synthetic_field(hours: float = 72.0, lat_range=(-60, 60), lng_range=(-180, 180),
+                    grid: float = 1.0) -> GriddedField:
+    """
+    Build a time-varying test field: rotating eddies under a turning wind.
+
+    Args:
+        hours: Time the field covers, in hours, with a slice every 6 hours
+        lat_range: (south, north) of the grid in degrees
+        lng_range: (west, east) of the grid in degrees
+        grid: Grid spacing in degrees
+
+    Returns:
+        GriddedField of the drift velocity
+    """
+    times = np.arange(0, hours + 6, 6) * 3600.0
+    lats = np.arange(lat_range[0], lat_range[1] + grid, grid)
+    lngs = np.arange(lng_range[0], lng_range[1] + grid, grid)
+    t, y, x = np.meshgrid(times, np.radians(lats), np.radians(lngs), indexing='ij')
+    current_u = 0.3 * np.sin(4 * y) * np.cos(4 * x)
+    current_v = -0.3 * np.cos(4 * y) * np.sin(4 * x)
+    heading = t / (hours * 3600.0) * math.pi
+    return GriddedField.combine(times, lats, lngs, 6 * np.sin(heading), 6 * np.cos(heading),
+                                current_u, current_v)
+
+
+def main():
+    """Benchmark ensemble simulation for many reports."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--reports', type=int, default=1000,
+                        help='Number of reports to simulate.')
+    parser.add_argument('--particles', type=int, default=Config.DRIFT_ENSEMBLE_PARTICLES,
+                        help='Particles per report.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='Worker processes; 1 runs in this process.')
+    args = parser.parse_args()
+
+    field = synthetic_field()
+    rng = np.random.RandomState(0)
+    lat = rng.uniform(-50, 50, args.reports)
+    lng = rng.uniform(-170, 170, args.reports)
+
+    executor = ProcessPoolExecutor(args.workers) if args.workers > 1 else None
+    try:
+        if executor is not None:
+            # Start the workers before timing.
+            simulate_ensemble(field, lat[:2], lng[:2], particles=2, executor=executor)
+        start = time.perf_counter()
+        cones = simulate_ensemble(field, lat, lng, particles=args.particles,
+                                  executor=executor)
+        seconds = time.perf_counter() - start
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    logger.info(f"Simulated {args.reports} reports x {args.particles} particles over "
+                f"{DEFAULT_HOURS[-1]} h in {seconds:.2f}s with {args.workers} workers; "
+                f"median 72 h cone radius {np.median(cones['radius_90'][:, -1]) / 1000:.0f} km")
+
+    # A report's cone must not change when a far-away report joins the
+    # request, through either the field built around them or the draws.
+    cache = WeatherCache(FixtureProvider({"wind": {"default": [5.0, 90]},
+                                          "current": {"default": [0.2, 90]}}))
+    hours = [Config.DRIFT_MAX_HOURS]
+    cones = [simulate_ensemble(field_from_cache(cache, [0.0] * len(lng), lng),
+                               [0.0] * len(lng), lng, hours=hours,
+                               particles=args.particles)
+             for lng in ([0.0], [0.0, 20.0])]
+    difference = max(np.max(np.abs(cones[0][name][0] - cones[1][name][0]))
+                     for name in cones[0])
+    logger.info(f"Report at 0,0 reaches lng {cones[0]['lng'][0, 0]:.2f} at {hours[0]:g} h "
+                f"alone and {cones[1]['lng'][0, 0]:.2f} with a report at 0,20 "
+                f"(max difference {difference:.1e})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+"""
+On-device waste classification with a compact TensorFlow Lite model.
+
+Runs the student model exported by distill.py. It uses the lightweight
+tflite_runtime interpreter when it is installed, as on a Raspberry Pi, and
+falls back to the interpreter bundled with TensorFlow otherwise.
+"""
+import io
+import logging
+from typing import Dict, Optional
+
+import numpy as np
+from PIL import Image
+
+from config import Config
+
+try:
+    from tflite_runtime.interpreter import Interpreter
+except ImportError:
+    try:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter
+    except ImportError:
+        Interpreter = None
+        logging.warning("No TensorFlow Lite interpreter available. "
+                        "On-device classification disabled.")
+
+logger = logging.getLogger(__name__)
+
+
+def resize_bilinear(image: np.ndarray, height: int, width: int) -> np.ndarray:
+    """
+    Resize an image the way TensorFlow's resize_bilinear does by default.
+
+    The student was trained on images resized with that op (no corner
+    alignment, no half-pixel centers), so matching it keeps on-device inputs
+    identical to the training inputs.
+
+    Args:
+        image: Uint8 array of shape [H, W, 3]
+        height: Output height
+        width: Output width
+
+    Returns:
+        Float32 array of shape [height, width, 3]
+    """
+    in_height, in_width = image.shape[:2]
+    y = np.arange(height) * (in_height / height)
+    x = np.arange(width) * (in_width / width)
+    y0 = np.floor(y).astype(np.int64)
+    x0 = np.floor(x).astype(np.int64)
+    y1 = np.minimum(y0 + 1, in_height - 1)
+    x1 = np.minimum(x0 + 1, in_width - 1)
+    dy = (y - y0)[:, None, None].astype(np.float32)
+    dx = (x - x0)[None, :, None].astype(np.float32)
+    pixels = image.astype(np.float32)
+    top = pixels[y0][:, x0] * (1 - dx) + pixels[y0][:, x1] * dx
+    bottom = pixels[y1][:, x0] * (1 - dx) + pixels[y1][:, x1] * dx
+    return top * (1 - dy) + bottom * dy
+
+
+class EdgeClassifier:
+    """
+    Waste classifier running a TensorFlow Lite model on the device.
+    Provides the same classify interface as WasteClassifier.
+    """
+
+    def __init__(
+        self,
+        model_path: Optional[str] = None,
+        label_path: Optional[str] = None,
+        num_threads: int = 2
+    ):
+        """
+        Initialize the edge classifier.
+
+        Args:
+            model_path: Path to the .tflite model
+            label_path: Path to the labels file
+            num_threads: Interpreter threads
+        """
+        self.model_path = model_path or Config.EDGE_MODEL_PATH
+        self.label_path = label_path or Config.EDGE_LABEL_PATH
+        self.num_threads = num_threads
+        self.labels: Optional[list] = None
+        self.interpreter = None
+        self.input_index: Optional[int] = None
+        self.output_index: Optional[int] = None
+        self.input_size: Optional[tuple] = None
+
+        self._load_model()
+
+    def _load_model(self) -> None:
+        """Load the TensorFlow Lite model and labels."""
+        if Interpreter is None:
+            raise RuntimeError("No TensorFlow Lite interpreter installed")
+        try:
+            logger.info("Loading on-device classification model...")
+            with open(self.label_path, 'r') as f:
+                self.labels = [line.rstrip() for line in f if line.strip()]
+            if not self.labels:
+                raise ValueError("No labels found in labels file")
+
+            self.interpreter = Interpreter(model_path=self.model_path,
+                                           num_threads=self.num_threads)
+            self.interpreter.allocate_tensors()
+            input_details = self.interpreter.get_input_details()[0]
+            self.input_index = input_details['index']
+            self.input_size = tuple(int(v) for v in input_details['shape'][1:3])
+            self.output_index = self.interpreter.get_output_details()[0]['index']
+
+            logger.info(f"Edge model loaded with {len(self.labels)} labels, "
+                        f"input {self.input_size[0]}x{self.input_size[1]}")
+        except Exception as e:
+            logger.error(f"Failed to load edge model: {e}")
+            raise
+
+    def preprocess(self, image_data: bytes) -> np.ndarray:
+        """
+        Decode an image into the model's input tensor.
+
+        Args:
+            image_data: Encoded image bytes
+
+        Returns:
+            Float32 array of shape [1, height, width, 3] with values in [0, 1]
+        """
+        image = Image.open(io.BytesIO(image_data))
+        # Let the JPEG decoder downscale by a power of two while staying at
+        # least as large as the input, so big photos are never fully decoded
+        image.draft('RGB', self.input_size[::-1])
+        image = np.asarray(image.convert('RGB'))
+        resized = np.round(np.clip(resize_bilinear(image, *self.input_size), 0, 255))
+        return (resized / 255.0).astype(np.float32)[None]
+
+    def classify(self, image_data: bytes) -> Dict[str, float]:
+        """
+        Classify an image and return predictions.
+
+        Args:
+            image_data: Image data as bytes
+
+        Returns:
+            Dictionary mapping label names to confidence scores, highest first
+
+        Raises:
+            ValueError: If image_data is invalid
+        """
+        if not image_data:
+            raise ValueError("Image data is empty")
+
+        self.interpreter.set_tensor(self.input_index, self.preprocess(image_data))
+        self.interpreter.invoke()
+        predictions = self.interpreter.get_tensor(self.output_index)[0]
+
+        results = {}
+        for i in np.argsort(predictions)[::-1]:
+            if i < len(self.labels):
+                results[self.labels[i]] = float(predictions[i])
+        return results
+
+    def get_top_prediction(self, image_data: bytes) -> tuple[str, float]:
+        """
+        Get the top prediction for an image.
+
+        Args:
+            image_data: Image data as bytes
+
+        Returns:
+            Tuple of (label, confidence_score)
+        """
+        results = self.classify(image_data)
+        return max(results.items(), key=lambda x: x[1])
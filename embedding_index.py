@@ -0,0 +1,276 @@
+"""
+Vector index of image embeddings for similar-image search.
+
+Stores the pool_3 embedding of every processed image together with a small
+metadata record, and answers k-nearest-neighbour queries by cosine
+similarity. Each query first scores a low-dimensional random projection of
+every vector, then re-ranks the best candidates exactly against the full
+vectors. That keeps queries in the millisecond range at six-figure index
+sizes. The index grows incrementally and is persisted as a folder of
+append-only .npz segments, so saving only writes what changed since the
+last save.
+"""
+import glob
+import json
+import logging
+import os
+import threading
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingIndex:
+    """
+    Incrementally updated cosine-similarity index over image embeddings.
+    """
+
+    def __init__(
+        self,
+        dimension: int = 2048,
+        projection_dimension: int = 256,
+        rerank_factor: int = 20,
+        seed: int = 0
+    ):
+        """
+        Initialize an empty index.
+
+        Args:
+            dimension: Size of the stored embeddings
+            projection_dimension: Size of the random projection used for the
+                coarse scoring pass
+            rerank_factor: Candidates re-ranked exactly per requested result
+            seed: Seed for the random projection
+        """
+        self.dimension = dimension
+        self.projection_dimension = projection_dimension
+        self.rerank_factor = rerank_factor
+        self.seed = seed
+        self._projection = (
+            np.random.RandomState(seed)
+            .randn(dimension, projection_dimension)
+            .astype(np.float32) / np.sqrt(projection_dimension)
+        )
+        self._vectors = np.zeros([0, dimension], dtype=np.float16)
+        self._projected = np.zeros([0, projection_dimension], dtype=np.float32)
+        self._ids: List[str] = []
+        self._metadata: List[Dict[str, Any]] = []
+        self._id_to_row: Dict[str, int] = {}
+        # Rows added or replaced since the last flush
+        self._dirty: set = set()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def _normalize(self, embedding: np.ndarray) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        if vector.shape[0] != self.dimension:
+            raise ValueError(
+                f"Expected an embedding of size {self.dimension}, "
+                f"got {vector.shape[0]}")
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _grow(self, capacity: int) -> None:
+        """Reallocate storage; existing rows are copied, old views stay valid."""
+        vectors = np.zeros([capacity, self.dimension], dtype=np.float16)
+        projected = np.zeros([capacity, self.projection_dimension], dtype=np.float32)
+        vectors[:len(self._vectors)] = self._vectors
+        projected[:len(self._projected)] = self._projected
+        self._vectors = vectors
+        self._projected = projected
+
+    def add(self, image_id: str, embedding: np.ndarray,
+            metadata: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Add an image to the index, replacing any entry with the same id.
+
+        Args:
+            image_id: Unique identifier of the image
+            embedding: Embedding vector of the image
+            metadata: JSON-serializable record returned with search results
+        """
+        vector = self._normalize(embedding)
+        with self._lock:
+            row = self._id_to_row.get(image_id)
+            if row is None:
+                row = len(self._ids)
+                if row == len(self._vectors):
+                    self._grow(max(1024, 2 * row))
+                self._ids.append(image_id)
+                self._metadata.append(metadata or {})
+                self._id_to_row[image_id] = row
+            else:
+                self._metadata[row] = metadata or {}
+            self._vectors[row] = vector
+            self._projected[row] = vector @ self._projection
+            self._dirty.add(row)
+
+    def get_embedding(self, image_id: str) -> Optional[np.ndarray]:
+        """Return the stored (normalized) embedding of an image, if indexed."""
+        with self._lock:
+            row = self._id_to_row.get(image_id)
+            if row is None:
+                return None
+            return self._vectors[row].astype(np.float32)
+
+    def search(self, embedding: np.ndarray, k: int = 5,
+               exclude_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Find the k indexed images most similar to an embedding.
+
+        Args:
+            embedding: Query embedding
+            k: Number of results to return
+            exclude_id: Optional id to leave out, e.g. the query image itself
+
+        Returns:
+            List of result dicts with 'image_id', 'score' (cosine similarity)
+            and the stored metadata, most similar first
+        """
+        query = self._normalize(embedding)
+        with self._lock:
+            count = len(self._ids)
+            vectors = self._vectors[:count]
+            projected = self._projected[:count]
+            ids = self._ids[:count]
+            metadata = self._metadata[:count]
+        if count == 0 or k <= 0:
+            return []
+
+        wanted = k + (1 if exclude_id is not None else 0)
+        candidate_count = wanted * self.rerank_factor
+        if candidate_count >= count:
+            candidates = np.arange(count)
+        else:
+            coarse = projected @ (query @ self._projection)
+            candidates = np.argpartition(-coarse, candidate_count)[:candidate_count]
+        scores = vectors[candidates].astype(np.float32) @ query
+        order = np.argsort(-scores)
+
+        results = []
+        for position in order:
+            row = int(candidates[position])
+            if ids[row] == exclude_id:
+                continue
+            results.append({'image_id': ids[row],
+                            'score': float(scores[position]),
+                            **metadata[row]})
+            if len(results) == k:
+                break
+        return results
+
+    def _write_segment(self, directory: str, rows: np.ndarray) -> str:
+        """Write the given rows to a new segment file, atomically."""
+        os.makedirs(directory, exist_ok=True)
+        existing = glob.glob(os.path.join(directory, 'segment-*.npz'))
+        number = max([int(os.path.basename(p)[8:-4]) for p in existing],
+                     default=-1) + 1
+        path = os.path.join(directory, 'segment-%06d.npz' % number)
+        with open(path + '.tmp', 'wb') as f:
+            np.savez(f,
+                     vectors=self._vectors[rows],
+                     projected=self._projected[rows],
+                     ids=np.array([self._ids[row] for row in rows], dtype=str),
+                     metadata=np.array(json.dumps(
+                         [self._metadata[row] for row in rows])),
+                     config=np.array([self.dimension, self.projection_dimension,
+                                      self.rerank_factor, self.seed]))
+        os.replace(path + '.tmp', path)
+        return path
+
+    def flush(self, directory: str) -> int:
+        """
+        Append every row added or replaced since the last flush as a new
+        segment in directory.
+
+        Args:
+            directory: Folder holding the index segments
+
+        Returns:
+            Number of rows written
+        """
+        with self._lock:
+            rows = np.array(sorted(self._dirty), dtype=np.int64)
+            self._dirty = set()
+            if len(rows):
+                self._write_segment(directory, rows)
+        if len(rows):
+            logger.info(f"Saved {len(rows)} embeddings to {directory}")
+        return len(rows)
+
+    def compact(self, directory: str) -> None:
+        """
+        Rewrite the whole index as a single segment and drop the old ones.
+
+        Args:
+            directory: Folder holding the index segments
+        """
+        with self._lock:
+            old_segments = glob.glob(os.path.join(directory, 'segment-*.npz'))
+            self._write_segment(directory, np.arange(len(self._ids)))
+            self._dirty = set()
+            for path in old_segments:
+                os.remove(path)
+        logger.info(f"Compacted embedding index in {directory} "
+                    f"to one segment of {len(self._ids)} images")
+
+    @classmethod
+    def load(cls, directory: str) -> 'EmbeddingIndex':
+        """
+        Read an index from the segments written by flush.
+
+        Later segments replace earlier entries with the same id.
+
+        Args:
+            directory: Folder holding the index segments
+
+        Returns:
+            The loaded index
+        """
+        index = None
+        for path in sorted(glob.glob(os.path.join(directory, 'segment-*.npz'))):
+            with np.load(path) as data:
+                if index is None:
+                    index = cls(*(int(v) for v in data['config']))
+                vectors = data['vectors']
+                projected = data['projected']
+                ids = [str(image_id) for image_id in data['ids']]
+                metadata = json.loads(str(data['metadata']))
+            rows = []
+            for image_id, record in zip(ids, metadata):
+                row = index._id_to_row.get(image_id)
+                if row is None:
+                    row = len(index._ids)
+                    index._ids.append(image_id)
+                    index._metadata.append(record)
+                    index._id_to_row[image_id] = row
+                else:
+                    index._metadata[row] = record
+                rows.append(row)
+            if len(index._ids) > len(index._vectors):
+                index._grow(max(1024, len(index._ids), 2 * len(index._vectors)))
+            index._vectors[rows] = vectors
+            index._projected[rows] = projected
+        if index is None:
+            index = cls()
+        logger.info(f"Loaded embedding index with {len(index)} images "
+                    f"from {directory}")
+        return index
+
+    @classmethod
+    def load_or_create(cls, directory: str,
+                       max_segments: int = 50) -> 'EmbeddingIndex':
+        """
+        Load the index in directory if there is one, else return an empty one.
+
+        The segments are compacted once there are more than max_segments.
+        """
+        if not directory or not glob.glob(os.path.join(directory, 'segment-*.npz')):
+            return cls()
+        index = cls.load(directory)
+        if len(glob.glob(os.path.join(directory, 'segment-*.npz'))) > max_segments:
+            index.compact(directory)
+        return index
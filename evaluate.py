@@ -0,0 +1,189 @@
+"""
+Streaming evaluation of an exported retrained graph.
+
+Runs any split of the image dataset through a `retrained_graph.pb` in
+fixed-size batches and reports accuracy, per-class precision/recall and the
+confusion matrix. Memory use is bounded by the batch size, not the split size.
+
+Example:
+    python evaluate.py \
+        --image_dir=training_dataset \
+        --bottleneck_dir=tf_files/bottlenecks \
+        --category=testing
+"""
+import argparse
+import logging
+import sys
+
+import tensorflow as tf
+
+import retrain
+from config import Config
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+BOTTLENECK_INPUT_TENSOR_NAME = 'input/BottleneckInputPlaceholder:0'
+FINAL_TENSOR_NAME = 'final_result:0'
+
+
+def load_graph(graph_path: str) -> tf.compat.v1.Graph:
+    """
+    Load an exported retrained graph.
+
+    Args:
+        graph_path: Path to the frozen GraphDef file
+
+    Returns:
+        Graph holding the imported model
+    """
+    graph = tf.compat.v1.Graph()
+    with graph.as_default():
+        graph_def = tf.compat.v1.GraphDef()
+        with tf.io.gfile.GFile(graph_path, 'rb') as f:
+            graph_def.ParseFromString(f.read())
+        tf.import_graph_def(graph_def, name='')
+    return graph
+
+
+def load_labels(label_path: str) -> list:
+    """
+    Load the label list written alongside a retrained graph.
+
+    Args:
+        label_path: Path to the labels file
+
+    Returns:
+        List of label strings in class index order
+    """
+    with tf.io.gfile.GFile(label_path, 'r') as f:
+        return [line.rstrip() for line in f if line.strip()]
+
+
+def align_image_lists(image_lists: dict, labels: list) -> dict:
+    """
+    Reorder image lists so that their key order matches the model's labels.
+
+    Labels the model knows but the dataset lacks keep an empty entry, so class
+    indices line up with the graph output. Dataset folders the model was not
+    trained on are skipped.
+
+    Args:
+        image_lists: Dictionary produced by retrain.create_image_lists
+        labels: Label strings in class index order
+
+    Returns:
+        Dictionary keyed by label in model order
+    """
+    for label_name in image_lists:
+        if label_name not in labels:
+            logger.warning(f"Skipping '{label_name}': not a label of this model")
+    empty = {'dir': '', 'training': [], 'testing': [], 'validation': []}
+    return {label: image_lists.get(label, empty) for label in labels}
+
+
+def evaluate(
+    graph_path: str,
+    label_path: str,
+    image_dir: str,
+    bottleneck_dir: str,
+    category: str = 'testing',
+    batch_size: int = 1000,
+    testing_percentage: int = 10,
+    validation_percentage: int = 10,
+    print_misclassified: bool = False,
+    image_archives: str = ''
+):
+    """
+    Evaluate a retrained graph on one split of an image dataset.
+
+    Bottlenecks missing from the cache are computed with the graph's own
+    Inception layers and written back to the cache.
+
+    Args:
+        graph_path: Path to the exported retrained graph
+        label_path: Path to the exported labels file
+        image_dir: Root folder of the class-named image subfolders
+        bottleneck_dir: Folder holding cached bottleneck files
+        category: Split to evaluate - training, testing or validation
+        batch_size: Number of images fed to the graph at a time
+        testing_percentage: Test split percentage used at training time
+        validation_percentage: Validation split percentage used at training time
+        print_misclassified: Whether to print each misclassified image
+        image_archives: Optional glob of tar/zip shards to read instead of
+            image_dir
+
+    Returns:
+        Tuple of (confusion matrix, label list), or None if no images found
+    """
+    labels = load_labels(label_path)
+    image_lists = retrain.load_image_lists(
+        image_dir, image_archives, testing_percentage, validation_percentage)
+    if not image_lists:
+        logger.error(f"No images found in {image_archives or image_dir}")
+        return None
+    image_lists = align_image_lists(image_lists, labels)
+
+    graph = load_graph(graph_path)
+    with tf.compat.v1.Session(graph=graph) as sess:
+        batches = retrain.iter_cached_bottleneck_batches(
+            sess, image_lists, batch_size, category, bottleneck_dir, image_dir,
+            graph.get_tensor_by_name(retrain.JPEG_DATA_TENSOR_NAME),
+            graph.get_tensor_by_name(retrain.BOTTLENECK_TENSOR_NAME))
+        if print_misclassified:
+            print('=== MISCLASSIFIED IMAGES ===')
+        confusion = retrain.run_streaming_evaluation(
+            sess, batches,
+            graph.get_tensor_by_name(BOTTLENECK_INPUT_TENSOR_NAME),
+            graph.get_tensor_by_name(FINAL_TENSOR_NAME),
+            len(labels),
+            labels if print_misclassified else None)
+    return confusion, labels
+
+
+def main():
+    """Main entry point for command-line usage."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--graph', default=Config.MODEL_PATH,
+                        help='Exported retrained graph to evaluate.')
+    parser.add_argument('--labels', default=Config.LABEL_PATH,
+                        help='Labels file written with the graph.')
+    parser.add_argument('--image_dir', default='',
+                        help='Path to folders of labeled images.')
+    parser.add_argument('--image_archives', default='',
+                        help='Glob of tar/zip shards to read instead of --image_dir.')
+    parser.add_argument('--bottleneck_dir', default='tf_files/bottlenecks',
+                        help='Path to cached bottleneck values.')
+    parser.add_argument('--category', default='testing',
+                        choices=['training', 'testing', 'validation'],
+                        help='Which split to evaluate.')
+    parser.add_argument('--batch_size', type=int, default=1000,
+                        help='How many images to feed at a time.')
+    parser.add_argument('--testing_percentage', type=int, default=10,
+                        help='Test split percentage used at training time.')
+    parser.add_argument('--validation_percentage', type=int, default=10,
+                        help='Validation split percentage used at training time.')
+    parser.add_argument('--print_misclassified', action='store_true',
+                        help='Print every misclassified image.')
+    args = parser.parse_args()
+
+    result = evaluate(
+        args.graph, args.labels, args.image_dir, args.bottleneck_dir,
+        category=args.category,
+        batch_size=args.batch_size,
+        testing_percentage=args.testing_percentage,
+        validation_percentage=args.validation_percentage,
+        print_misclassified=args.print_misclassified,
+        image_archives=args.image_archives
+    )
+    if result is None:
+        sys.exit(1)
+    confusion, labels = result
+    retrain.print_evaluation_report(confusion, labels)
+
+
+if __name__ == '__main__':
+    main()
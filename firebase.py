@@ -4,15 +4,27 @@ Handles authentication and database operations.
 """
 import datetime
 import logging
+import threading
+import time
 from typing import Dict, Any, Optional
 import pyrebase
 from config import Config
 
 logger = logging.getLogger(__name__)
 
+# Database node under which each bin's latest result is kept
+RESULTS_ROOT = "dummy"
+
 
 class Firebase:
-    """Firebase client for database operations."""
+    """
+    Firebase client for database operations.
+    
+    The ID token from signing in is cached and refreshed in the background
+    before it expires, so one client can be used for the life of the
+    process. Use get_client() to share a single client, and its pooled
+    HTTP connections, across the process.
+    """
     
     def __init__(self):
         """Initialize Firebase client."""
@@ -22,6 +34,11 @@ class Firebase:
         self.user: Optional[Dict[str, Any]] = None
         self.uid: Optional[str] = None
         self._authenticated = False
+        self._token_lock = threading.Lock()
+        self._token_expires_at = 0.0
+        self._refresher: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+        self.stats = {"sign_ins": 0, "refreshes": 0}
 
     def authenticate(self) -> bool:
         """
@@ -39,23 +56,28 @@ class Firebase:
                 logger.error("Missing required Firebase credentials")
                 return False
             
-            self.firebase = pyrebase.initialize_app({
-                "apiKey": firebase_config["API_KEY"],
-                "authDomain": firebase_config["AUTH_DOMAIN"],
-                "databaseURL": firebase_config["DATABASE_URL"],
-                "storageBucket": firebase_config["STORAGE_BUCKET"]
-            })
-            
-            self.db = self.firebase.database()
-            self.auth = self.firebase.auth()
+            # The app holds the HTTP session, so it is created only once
+            if self.firebase is None:
+                self.firebase = pyrebase.initialize_app({
+                    "apiKey": firebase_config["API_KEY"],
+                    "authDomain": firebase_config["AUTH_DOMAIN"],
+                    "databaseURL": firebase_config["DATABASE_URL"],
+                    "storageBucket": firebase_config["STORAGE_BUCKET"]
+                })
+                self.db = self.firebase.database()
+                self.auth = self.firebase.auth()
             
             # Authenticate user
-            self.user = self.auth.sign_in_with_email_and_password(
-                firebase_config["EMAIL"],
-                firebase_config["PASS"]
-            )
-            self.uid = self.user["localId"]
-            self._authenticated = True
+            with self._token_lock:
+                user = self.auth.sign_in_with_email_and_password(
+                    firebase_config["EMAIL"],
+                    firebase_config["PASS"]
+                )
+                self.stats["sign_ins"] += 1
+                self._set_token(user)
+                self.uid = self.user["localId"]
+                self._authenticated = True
+            self._start_refresher()
             
             logger.info("Firebase authentication successful")
             return True
@@ -64,6 +86,70 @@ class Firebase:
             logger.error(f"Firebase authentication failed: {e}")
             self._authenticated = False
             return False
+    
+    def _set_token(self, user: Dict[str, Any]) -> None:
+        """Cache a sign-in or refresh response and note when it expires."""
+        self.user = {**(self.user or {}), **user}
+        expires_in = float(user.get("expiresIn", 3600))
+        self._token_expires_at = time.monotonic() + expires_in
+    
+    def _refresh_token(self) -> bool:
+        """
+        Exchange the refresh token for a new ID token.
+        
+        Falls back to signing in again if the refresh token is rejected.
+        
+        Returns:
+            bool: True if a new token was obtained
+        """
+        try:
+            with self._token_lock:
+                user = self.auth.refresh(self.user["refreshToken"])
+                self.stats["refreshes"] += 1
+                self._set_token(user)
+            logger.info("Firebase ID token refreshed")
+            return True
+        except Exception as e:
+            logger.warning(f"Firebase token refresh failed, signing in again: {e}")
+            return self.authenticate()
+    
+    def _start_refresher(self) -> None:
+        """Start the background thread that refreshes the token before expiry."""
+        if self._refresher is None:
+            self._refresher = threading.Thread(target=self._refresh_loop,
+                                               name="firebase-token", daemon=True)
+            self._refresher.start()
+    
+    def _refresh_loop(self) -> None:
+        """Refresh the token shortly before it expires, until closed."""
+        while True:
+            delay = self._token_expires_at - time.monotonic() - Config.FIREBASE_TOKEN_MARGIN
+            if self._stop.wait(max(delay, 0.0)):
+                return
+            if not self._refresh_token():
+                # Try again shortly rather than spin
+                if self._stop.wait(30):
+                    return
+    
+    def id_token(self) -> Optional[str]:
+        """
+        Get a valid ID token, signing in or refreshing first if needed.
+        
+        Returns:
+            The ID token, or None if authentication failed
+        """
+        if not self._authenticated:
+            if not self.authenticate():
+                return None
+        if time.monotonic() >= self._token_expires_at - Config.FIREBASE_TOKEN_MARGIN:
+            # The background refresh is late, e.g. after the machine slept
+            if not self._refresh_token():
+                return None
+        return self.user["idToken"]
+    
+    def close(self) -> None:
+        """Stop refreshing the token."""
+        self._stop.set()
         
     def push(self, result: Dict[str, Any], path: Optional[str] = None) -> bool:
         """
@@ -76,16 +162,12 @@ class Firebase:
         Returns:
             bool: True if push successful, False otherwise
         """
-        if not self._authenticated:
-            if not self.authenticate():
-                logger.error("Cannot push: Authentication failed")
-                return False
+        token = self.id_token()
+        if token is None:
+            logger.error("Cannot push: Authentication failed")
+            return False
         
         try:
-            if not self.user or not self.db:
-                logger.error("Firebase not initialized")
-                return False
-            
             b_id = path or Config.FIREBASE_B_ID
             if not b_id:
                 logger.error("No B_ID configured for Firebase push")
@@ -96,14 +178,176 @@ class Firebase:
                 "last_updated": str(datetime.datetime.now())
             }
             
-            self.db.child("dummy").child(b_id).update(
+            self.db.child(RESULTS_ROOT).child(b_id).update(
                 update_data,
-                self.user["idToken"]
+                token
             )
             
-            logger.info(f"Successfully pushed data to Firebase at path: dummy/{b_id}")
+            logger.info(f"Successfully pushed data to Firebase at path: {RESULTS_ROOT}/{b_id}")
             return True
             
         except Exception as e:
             logger.error(f"Failed to push data to Firebase: {e}")
             return False
+    
+    def update(self, updates: Dict[str, Any]) -> bool:
+        """
+        Write several database paths in one multi-path update.
+        
+        Args:
+            updates: Dictionary mapping paths from the database root, such
+                as "dummy/<b_id>/current_result", to their new values
+            
+        Returns:
+            bool: True if the update succeeded, False otherwise
+        """
+        token = self.id_token()
+        if token is None:
+            logger.error("Cannot update: Authentication failed")
+            return False
+        
+        try:
+            self.db.update(updates, token)
+            return True
+            
+        except Exception as e:
+            logger.error(f"Failed to update Firebase: {e}")
+            return False
+
+
+_shared_client: Optional[Firebase] = None
+_shared_client_lock = threading.Lock()
+
+
+def get_client() -> Firebase:
+    """
+    Get the process-wide Firebase client, creating it on first use.
+    
+    Returns:
+        Shared Firebase client
+    """
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None:
+            _shared_client = Firebase()
+        return _shared_client
+
+
+class FirebaseWriteBuffer:
+    """
+    Write-behind buffer for pushing results to Firebase.
+    
+    Results are queued in memory and written by a background thread every
+    flush interval. Only the latest result per bin is kept, since each
+    push overwrites the bin's previous result anyway, and all bins go out
+    in a single multi-path update.
+    """
+    
+    def __init__(
+        self,
+        client: Optional[Firebase] = None,
+        flush_interval: Optional[float] = None,
+        max_retries: Optional[int] = None
+    ):
+        """
+        Initialize the buffer.
+        
+        Args:
+            client: Firebase client to write with (defaults to the shared one)
+            flush_interval: Seconds between writes
+            max_retries: Failed writes of a result before it is dropped
+        """
+        self.client = client or get_client()
+        self.flush_interval = (Config.FIREBASE_FLUSH_INTERVAL if flush_interval is None
+                               else flush_interval)
+        self.max_retries = (Config.FIREBASE_MAX_RETRIES if max_retries is None
+                            else max_retries)
+        # b_id -> (result, last_updated, failed attempts)
+        self._pending: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"received": 0, "coalesced": 0, "written": 0,
+                      "requests": 0, "dropped": 0}
+    
+    def push(self, result: Dict[str, Any], path: Optional[str] = None) -> bool:
+        """
+        Queue a result for a bin, replacing any result not yet written.
+        
+        Args:
+            result: Data dictionary to push
+            path: Optional bin id (defaults to configured B_ID)
+            
+        Returns:
+            bool: True if the result was queued, False if there is no bin id
+        """
+        b_id = path or Config.FIREBASE_B_ID
+        if not b_id:
+            logger.error("No B_ID configured for Firebase push")
+            return False
+        
+        with self._lock:
+            self.stats["received"] += 1
+            if b_id in self._pending:
+                self.stats["coalesced"] += 1
+            self._pending[b_id] = (result, str(datetime.datetime.now()), 0)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="firebase-flush",
+                                                daemon=True)
+                self._thread.start()
+        return True
+    
+    def _run(self) -> None:
+        """Flush periodically until closed."""
+        while not self._stop.wait(self.flush_interval):
+            self.flush()
+    
+    def flush(self) -> int:
+        """
+        Write the queued results in one multi-path update.
+        
+        A failed write is retried at the next flush, unless a newer result
+        for the bin has arrived since, up to max_retries times.
+        
+        Returns:
+            Number of bins written
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, {}
+            if not batch:
+                return 0
+            
+            updates = {}
+            for b_id, (result, last_updated, _) in batch.items():
+                updates[f"{RESULTS_ROOT}/{b_id}/current_result"] = result
+                updates[f"{RESULTS_ROOT}/{b_id}/last_updated"] = last_updated
+            
+            self.stats["requests"] += 1
+            if self.client.update(updates):
+                self.stats["written"] += len(batch)
+                logger.info(f"Pushed results for {len(batch)} bins to Firebase")
+                return len(batch)
+            
+            with self._lock:
+                for b_id, (result, last_updated, attempts) in batch.items():
+                    if b_id in self._pending:
+                        continue
+                    if attempts + 1 >= self.max_retries:
+                        self.stats["dropped"] += 1
+                        logger.error(f"Dropping Firebase result for {b_id} after "
+                                     f"{attempts + 1} failed writes")
+                        continue
+                    self._pending[b_id] = (result, last_updated, attempts + 1)
+            return 0
+    
+    def close(self) -> None:
+        """Stop the background thread and write what is still queued."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for _ in range(self.max_retries):
+            self.flush()
+            if not self._pending:
+                break
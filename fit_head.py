@@ -0,0 +1,286 @@
+"""
+Full-batch trainer for the retrained final layer.
+
+The final layer is plain softmax regression on the 2048-d bottlenecks, so
+instead of thousands of small SGD steps this fits it on the whole cached
+embedding matrix at once with L-BFGS, L2 regularization and optional class
+weighting. The result is exported with exactly the same interface as
+`retrain.py` output, so `WasteClassifier` can load it unchanged.
+
+Example:
+    python fit_head.py \
+        --image_dir=training_dataset \
+        --bottleneck_dir=tf_files/bottlenecks \
+        --model_dir=inception
+"""
+import argparse
+import logging
+import time
+from typing import Callable, Tuple
+
+import numpy as np
+
+import retrain
+from sweep import load_cached_splits
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+def class_sample_weights(labels: np.ndarray, class_count: int,
+                         weighting: str = 'balanced') -> np.ndarray:
+    """
+    Compute per-example weights that sum to one.
+
+    Args:
+        labels: Label index of each example
+        class_count: Number of classes
+        weighting: 'balanced' gives every class the same total weight, which
+            matches the class-uniform batch sampling of retrain.py; 'none'
+            weights every example equally
+
+    Returns:
+        Array of example weights
+    """
+    if weighting == 'none':
+        return np.full(len(labels), 1.0 / len(labels))
+    if weighting != 'balanced':
+        raise ValueError(f"Unknown class weighting: {weighting}")
+    counts = np.bincount(labels, minlength=class_count).astype(np.float64)
+    present = np.count_nonzero(counts)
+    per_class = np.divide(1.0, counts * present,
+                          out=np.zeros_like(counts), where=counts > 0)
+    return per_class[labels]
+
+
+def softmax_regression_objective(
+    bottlenecks: np.ndarray,
+    labels: np.ndarray,
+    sample_weights: np.ndarray,
+    class_count: int,
+    l2_regularization: float
+) -> Callable[[np.ndarray], Tuple[float, np.ndarray]]:
+    """
+    Build the weighted cross-entropy objective over flattened parameters.
+
+    The parameter vector holds the [2048, C] weights followed by the [C]
+    biases. Biases are not regularized.
+
+    Args:
+        bottlenecks: Float32 matrix of shape [N, 2048]
+        labels: Label index of each row
+        sample_weights: Weight of each row, summing to one
+        class_count: Number of classes
+        l2_regularization: Strength of the L2 penalty on the weights
+
+    Returns:
+        Function mapping parameters to (loss, gradient)
+    """
+    size = retrain.BOTTLENECK_TENSOR_SIZE
+    rows = np.arange(len(labels))
+    weights_column = sample_weights[:, None]
+
+    def objective(params: np.ndarray) -> Tuple[float, np.ndarray]:
+        layer_weights = params[:size * class_count].reshape(size, class_count)
+        layer_biases = params[size * class_count:]
+        logits = (bottlenecks @ layer_weights.astype(np.float32)).astype(
+            np.float64) + layer_biases
+        logits -= logits.max(axis=1, keepdims=True)
+        log_norm = np.log(np.exp(logits).sum(axis=1))
+        loss = float(np.dot(sample_weights, log_norm - logits[rows, labels]))
+        loss += 0.5 * l2_regularization * float(np.sum(layer_weights ** 2))
+
+        residual = np.exp(logits - log_norm[:, None])
+        residual[rows, labels] -= 1.0
+        residual *= weights_column
+        weights_gradient = (bottlenecks.T @ residual.astype(np.float32)).astype(
+            np.float64) + l2_regularization * layer_weights
+        biases_gradient = residual.sum(axis=0)
+        return loss, np.concatenate([weights_gradient.ravel(), biases_gradient])
+
+    return objective
+
+
+def minimize_lbfgs(
+    objective: Callable[[np.ndarray], Tuple[float, np.ndarray]],
+    initial_params: np.ndarray,
+    max_iterations: int = 300,
+    history_size: int = 10,
+    tolerance: float = 1e-7
+) -> Tuple[np.ndarray, float, int]:
+    """
+    Minimize a smooth function with limited-memory BFGS.
+
+    Uses the standard two-loop recursion and a backtracking line search on
+    the Armijo condition, which is plenty for a convex objective like this.
+
+    Args:
+        objective: Function mapping parameters to (loss, gradient)
+        initial_params: Starting point
+        max_iterations: Upper bound on the number of iterations
+        history_size: Number of curvature pairs to keep
+        tolerance: Stop once the relative loss decrease falls below this
+
+    Returns:
+        Tuple of (parameters, final loss, iterations run)
+    """
+    params = initial_params.copy()
+    loss, gradient = objective(params)
+    steps = []
+    iteration = 0
+    for iteration in range(1, max_iterations + 1):
+        direction = -gradient
+        alphas = []
+        for s, y, rho in reversed(steps):
+            alpha = rho * np.dot(s, direction)
+            direction -= alpha * y
+            alphas.append(alpha)
+        if steps:
+            s, y, _ = steps[-1]
+            direction *= np.dot(s, y) / np.dot(y, y)
+        else:
+            direction /= max(np.linalg.norm(gradient), 1.0)
+        for (s, y, rho), alpha in zip(steps, reversed(alphas)):
+            direction += s * (alpha - rho * np.dot(y, direction))
+
+        slope = np.dot(gradient, direction)
+        if slope >= 0:
+            # Curvature history went stale, fall back to steepest descent.
+            steps = []
+            direction = -gradient / max(np.linalg.norm(gradient), 1.0)
+            slope = np.dot(gradient, direction)
+
+        step = 1.0
+        while True:
+            new_params = params + step * direction
+            new_loss, new_gradient = objective(new_params)
+            if new_loss <= loss + 1e-4 * step * slope or step < 1e-10:
+                break
+            step *= 0.5
+
+        s = new_params - params
+        y = new_gradient - gradient
+        curvature = np.dot(s, y)
+        if curvature > 1e-10:
+            steps.append((s, y, 1.0 / curvature))
+            steps = steps[-history_size:]
+
+        converged = loss - new_loss <= tolerance * max(abs(loss), 1.0)
+        params, loss, gradient = new_params, new_loss, new_gradient
+        if converged:
+            break
+    return params, loss, iteration
+
+
+def fit_head(
+    bottlenecks: np.ndarray,
+    labels: np.ndarray,
+    class_count: int,
+    l2_regularization: float = 1e-3,
+    class_weighting: str = 'balanced',
+    max_iterations: int = 300
+) -> Tuple[np.ndarray, np.ndarray, dict]:
+    """
+    Fit the softmax final layer on the full training matrix.
+
+    Args:
+        bottlenecks: Float32 matrix of shape [N, 2048]
+        labels: Label index of each row
+        class_count: Number of classes
+        l2_regularization: Strength of the L2 penalty on the weights
+        class_weighting: 'balanced' or 'none'
+        max_iterations: Upper bound on L-BFGS iterations
+
+    Returns:
+        Tuple of (weights [2048, C], biases [C], dict of fit statistics)
+    """
+    size = retrain.BOTTLENECK_TENSOR_SIZE
+    objective = softmax_regression_objective(
+        bottlenecks, labels,
+        class_sample_weights(labels, class_count, class_weighting),
+        class_count, l2_regularization)
+    start = time.perf_counter()
+    params, loss, iterations = minimize_lbfgs(
+        objective, np.zeros(size * class_count + class_count), max_iterations)
+    stats = {
+        'loss': loss,
+        'iterations': iterations,
+        'seconds': time.perf_counter() - start,
+    }
+    return (params[:size * class_count].reshape(size, class_count),
+            params[size * class_count:], stats)
+
+
+def confusion_matrix(bottlenecks: np.ndarray, labels: np.ndarray,
+                     layer_weights: np.ndarray, layer_biases: np.ndarray,
+                     class_count: int) -> np.ndarray:
+    """Score a fitted head, with ground truth rows and predicted columns."""
+    predictions = np.argmax(bottlenecks @ layer_weights + layer_biases, axis=1)
+    confusion = np.zeros([class_count, class_count], dtype=np.int64)
+    np.add.at(confusion, (labels, predictions), 1)
+    return confusion
+
+
+def main():
+    """Main entry point for command-line usage."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--image_dir', default='',
+                        help='Path to folders of labeled images.')
+    parser.add_argument('--image_archives', default='',
+                        help='Glob of tar/zip shards to read instead of --image_dir.')
+    parser.add_argument('--bottleneck_dir', default='tf_files/bottlenecks',
+                        help='Path to cached bottleneck values.')
+    parser.add_argument('--model_dir', default='inception',
+                        help='Path to classify_image_graph_def.pb.')
+    parser.add_argument('--l2_regularization', type=float, default=1e-3,
+                        help='Strength of the L2 penalty on the weights.')
+    parser.add_argument('--class_weighting', default='balanced',
+                        choices=['balanced', 'none'],
+                        help='How to weight examples of each class.')
+    parser.add_argument('--max_iterations', type=int, default=300,
+                        help='Upper bound on L-BFGS iterations.')
+    parser.add_argument('--testing_percentage', type=int, default=10,
+                        help='What percentage of images to use as a test set.')
+    parser.add_argument('--validation_percentage', type=int, default=10,
+                        help='What percentage of images to use as a validation set.')
+    parser.add_argument('--output_graph', default='tf_files/retrained_graph.pb',
+                        help='Where to save the trained graph.')
+    parser.add_argument('--output_labels', default='tf_files/retrained_labels.txt',
+                        help='Where to save the trained graph\'s labels.')
+    parser.add_argument('--final_tensor_name', default='final_result',
+                        help='Name of the output classification layer.')
+    args = parser.parse_args()
+
+    label_names, splits = load_cached_splits(
+        args.image_dir, args.bottleneck_dir, args.model_dir,
+        args.testing_percentage, args.validation_percentage,
+        args.image_archives)
+    class_count = len(label_names)
+    train_bottlenecks, train_labels = splits['training']
+
+    layer_weights, layer_biases, stats = fit_head(
+        train_bottlenecks, train_labels, class_count,
+        l2_regularization=args.l2_regularization,
+        class_weighting=args.class_weighting,
+        max_iterations=args.max_iterations)
+    logger.info(f"Fitted {len(train_labels)} examples in {stats['seconds']:.2f}s "
+                f"({stats['iterations']} iterations, loss {stats['loss']:.4f})")
+
+    validation_bottlenecks, validation_labels = splits['validation']
+    if len(validation_labels):
+        retrain.print_evaluation_report(
+            confusion_matrix(validation_bottlenecks, validation_labels,
+                             layer_weights, layer_biases, class_count),
+            label_names, 'Validation accuracy')
+
+    retrain.export_final_layer(
+        args.model_dir, layer_weights, layer_biases, label_names,
+        args.output_graph, args.output_labels, args.final_tensor_name)
+    logger.info(f"Exported head to {args.output_graph}")
+
+
+if __name__ == '__main__':
+    main()
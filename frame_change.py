@@ -0,0 +1,93 @@
+"""
+Cheap change detection between camera frames.
+
+Each frame is reduced to a small grayscale thumbnail, and compared with the
+thumbnail of the last frame that was uploaded. A frame counts as changed
+when enough thumbnail cells differ by more than a noise margin. Thumbnails
+are mean-centered first, so a global change in brightness, such as a cloud
+passing, does not count as a change.
+"""
+import io
+import logging
+from typing import Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Thumbnail (width, height) the frames are compared at.
+THUMBNAIL_SIZE = (64, 48)
+
+# Difference in a thumbnail cell, as a fraction of full scale, that is
+# treated as sensor noise.
+CELL_NOISE = 0.08
+
+
+def frame_thumbnail(image_data: bytes) -> np.ndarray:
+    """
+    Reduce an encoded frame to a mean-centered grayscale thumbnail.
+
+    Uses the JPEG decoder's draft mode, so the full frame is never decoded.
+
+    Args:
+        image_data: Encoded image bytes
+
+    Returns:
+        Float32 array of shape [height, width] with values around 0
+    """
+    image = Image.open(io.BytesIO(image_data))
+    image.draft('L', THUMBNAIL_SIZE)
+    image = image.convert('L').resize(THUMBNAIL_SIZE, Image.BOX)
+    pixels = np.asarray(image, dtype=np.float32) / 255.0
+    return pixels - pixels.mean()
+
+
+class FrameChangeDetector:
+    """Decides whether a frame differs enough from the last one kept."""
+
+    def __init__(self, threshold: float = 0.01):
+        """
+        Initialize the detector.
+
+        Args:
+            threshold: Fraction of thumbnail cells that must change for a
+                frame to count as changed
+        """
+        self.threshold = threshold
+        self.reference: Optional[np.ndarray] = None
+
+    def change_score(self, thumbnail: np.ndarray) -> float:
+        """
+        Get the fraction of cells that differ from the reference frame.
+
+        Args:
+            thumbnail: Thumbnail from frame_thumbnail
+
+        Returns:
+            Score between 0 and 1, or 1 if there is no reference frame yet
+        """
+        if self.reference is None:
+            return 1.0
+        return float(np.mean(np.abs(thumbnail - self.reference) > CELL_NOISE))
+
+    def check(self, image_data: bytes) -> Tuple[bool, float]:
+        """
+        Check a frame, making it the new reference if it changed.
+
+        Args:
+            image_data: Encoded image bytes
+
+        Returns:
+            Tuple of (whether the frame changed, change score)
+        """
+        thumbnail = frame_thumbnail(image_data)
+        score = self.change_score(thumbnail)
+        changed = score >= self.threshold
+        if changed:
+            self.reference = thumbnail
+        return changed, score
+
+    def reset(self) -> None:
+        """Forget the reference frame, so the next frame counts as changed."""
+        self.reference = None
@@ -0,0 +1,458 @@
+"""
+Gateway process driving many cameras at once.
+
+Each camera gets its own schedule, change detection and upload spool, as
+with the single-camera service, but all cameras share one event loop, one
+pooled HTTP session and a global limit on concurrent uploads. Blocking
+captures and uploads run in a bounded thread pool. Per-camera statistics
+are logged periodically. With --simulate, fake cameras stand in for real
+ones to measure how many cameras a gateway can sustain.
+
+Example:
+    python gateway.py --cameras=cameras.json
+    python gateway.py --simulate=50 --interval=5 --duration=60 --sink_latency=0.2
+
+A cameras file lists one object per camera, with an "id" and either a
+"snapshot_url" or, for replayed test footage, an "images" glob. It can also
+give an "interval", "min_interval" and "max_interval" in seconds:
+    [{"id": "harbour-1", "snapshot_url": "http://10.0.0.11/snapshot.jpg"},
+     {"id": "harbour-2", "snapshot_url": "http://10.0.0.12/snapshot.jpg",
+      "interval": 30}]
+"""
+import argparse
+import asyncio
+import collections
+import glob
+import json
+import logging
+import os
+import statistics
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from camera import FakeCamera, SnapshotCamera
+from config import Config
+from pipeline import AdaptiveInterval
+from service import CameraService
+from upload_queue import UploadQueue
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Marks the end of a camera's upload queue.
+_STOP = object()
+
+# Upload latencies kept per camera for the statistics.
+LATENCY_WINDOW = 1000
+
+
+def load_cameras(path: str) -> List[dict]:
+    """
+    Load the list of cameras from a JSON file.
+
+    Raises:
+        ValueError: If a camera has no id or no source
+    """
+    with open(path) as f:
+        cameras = json.load(f)
+    for spec in cameras:
+        if not spec.get("id"):
+            raise ValueError(f"Camera without an id in {path}")
+        if not spec.get("snapshot_url") and not spec.get("images"):
+            raise ValueError(f"Camera {spec['id']} needs a snapshot_url or images")
+    return cameras
+
+
+class GatewayCamera:
+    """State of one camera in the gateway."""
+
+    def __init__(self, spec: dict, service: CameraService,
+                 schedule: AdaptiveInterval):
+        self.camera_id = spec["id"]
+        self.service = service
+        self.schedule = schedule
+        self.jobs: Optional[asyncio.Queue] = None
+        self.wake: Optional[asyncio.Event] = None
+        self.stats = {"captures": 0, "dropped": 0, "overruns": 0, "uploads": 0}
+        self.first_capture: Optional[float] = None
+        self.last_capture: Optional[float] = None
+        self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+
+    def summary(self) -> dict:
+        """Get the camera's statistics."""
+        captures = self.stats["captures"]
+        period = None
+        if captures > 1:
+            period = (self.last_capture - self.first_capture) / (captures - 1)
+        latencies = sorted(self.latencies)
+        return {
+            **self.stats,
+            "skipped": self.service.stats["skipped"],
+            "interval": round(self.schedule.interval, 2),
+            "period": round(period, 3) if period is not None else None,
+            "upload_p50_ms": round(latencies[len(latencies) // 2] * 1000)
+            if latencies else None,
+            "upload_p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000)
+            if latencies else None,
+            "spooled": len(self.service.upload_queue)
+        }
+
+
+class CameraGateway:
+    """Drives many cameras from one asyncio event loop."""
+
+    def __init__(
+        self,
+        cameras: List[dict],
+        ml_service_url: Optional[str] = None,
+        max_uploads: Optional[int] = None,
+        capture_workers: Optional[int] = None,
+        spool_dir: Optional[str] = None,
+        queue_size: Optional[int] = None
+    ):
+        """
+        Initialize the gateway.
+
+        Args:
+            cameras: Camera specs, as read by load_cameras; a spec may also
+                hold a ready-made "camera" backend
+            ml_service_url: URL of the ML service endpoint
+            max_uploads: Uploads in flight at once, across all cameras
+            capture_workers: Threads for capturing and encoding frames
+            spool_dir: Folder for the cameras' upload spools (defaults to
+                Config.GATEWAY_SPOOL_DIR)
+            queue_size: Upload jobs waiting per camera before the oldest
+                is dropped
+        """
+        self.max_uploads = max_uploads or Config.GATEWAY_MAX_UPLOADS
+        capture_workers = capture_workers or Config.GATEWAY_CAPTURE_WORKERS
+        self.queue_size = queue_size or Config.PIPELINE_QUEUE_SIZE
+        spool_dir = spool_dir or Config.GATEWAY_SPOOL_DIR
+
+        # One pool of keep-alive connections for every camera's uploads.
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=self.max_uploads + capture_workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.max_uploads + capture_workers,
+            thread_name_prefix="gateway"
+        )
+        self._upload_slots: Optional[asyncio.Semaphore] = None
+
+        spool_bytes = Config.UPLOAD_QUEUE_MAX_MB * 1024 * 1024 // max(len(cameras), 1)
+        self.cameras: Dict[str, GatewayCamera] = {}
+        for spec in cameras:
+            camera_id = spec["id"]
+            if camera_id in self.cameras:
+                raise ValueError(f"Duplicate camera id: {camera_id}")
+            upload_queue = UploadQueue(
+                os.path.join(spool_dir, f"{camera_id}.db"),
+                max_bytes=spool_bytes,
+                retry_base=Config.UPLOAD_RETRY_BASE,
+                retry_max=Config.UPLOAD_RETRY_MAX
+            )
+            interval = spec.get("interval", 60)
+            service = CameraService(
+                ml_service_url=ml_service_url,
+                capture_interval=interval,
+                upload_queue=upload_queue,
+                camera=spec.get("camera") or self._make_camera(spec),
+                camera_id=camera_id,
+                session=self.session
+            )
+            schedule = AdaptiveInterval(
+                interval,
+                spec.get("min_interval", Config.CAPTURE_MIN_INTERVAL),
+                spec.get("max_interval", Config.CAPTURE_MAX_INTERVAL),
+                Config.CAPTURE_BACKOFF
+            )
+            self.cameras[camera_id] = GatewayCamera(spec, service, schedule)
+
+    def _make_camera(self, spec: dict):
+        """Create the camera backend for a spec."""
+        if spec.get("snapshot_url"):
+            return SnapshotCamera(spec["snapshot_url"], session=self.session)
+        return FakeCamera(image_paths=sorted(glob.glob(spec["images"])))
+
+    async def _capture_loop(self, camera: GatewayCamera) -> None:
+        """Capture and encode one camera's frames on its schedule."""
+        loop = asyncio.get_running_loop()
+        next_capture = loop.time()
+        while True:
+            started = loop.time()
+            image_data = await loop.run_in_executor(
+                self.executor, camera.service.capture_image)
+            if image_data is not None:
+                camera.stats["captures"] += 1
+                camera.last_capture = time.monotonic()
+                if camera.first_capture is None:
+                    camera.first_capture = camera.last_capture
+                try:
+                    job = await loop.run_in_executor(
+                        self.executor, camera.service.encode_frame, image_data)
+                except Exception as e:
+                    logger.error(f"Camera {camera.camera_id}: error encoding frame: {e}")
+                    job = None
+                if job is None or job[0] == "keepalive":
+                    camera.schedule.idle()
+                if job is not None:
+                    if camera.jobs.full():
+                        camera.jobs.get_nowait()
+                        camera.stats["dropped"] += 1
+                    camera.jobs.put_nowait(job)
+
+            next_capture += camera.schedule.interval
+            if next_capture < loop.time():
+                camera.stats["overruns"] += 1
+                next_capture = loop.time()
+            camera.wake.clear()
+            try:
+                await asyncio.wait_for(camera.wake.wait(),
+                                       max(0.0, next_capture - loop.time()))
+                # The interval got shorter while waiting
+                next_capture = min(next_capture, started + camera.schedule.interval)
+                await asyncio.sleep(max(0.0, next_capture - loop.time()))
+            except asyncio.TimeoutError:
+                pass
+
+    async def _upload_loop(self, camera: GatewayCamera) -> None:
+        """Send one camera's uploads, within the global concurrency limit."""
+        loop = asyncio.get_running_loop()
+        service = camera.service
+        while True:
+            try:
+                job = await asyncio.wait_for(camera.jobs.get(),
+                                             camera.schedule.interval)
+            except asyncio.TimeoutError:
+                if len(service.upload_queue):
+                    async with self._upload_slots:
+                        await loop.run_in_executor(self.executor, service.drain_uploads)
+                continue
+            if job is _STOP:
+                return
+
+            async with self._upload_slots:
+                started = time.monotonic()
+                try:
+                    response_data = await loop.run_in_executor(
+                        self.executor, service.upload_job, job)
+                except Exception as e:
+                    logger.error(f"Camera {camera.camera_id}: error uploading: {e}")
+                    continue
+                camera.latencies.append(time.monotonic() - started)
+            camera.stats["uploads"] += 1
+            if camera.schedule.observe_upload(job, response_data,
+                                              service.confidence_threshold):
+                camera.wake.set()
+
+    async def _report_loop(self, interval: float) -> None:
+        """Log a summary of all cameras periodically."""
+        while True:
+            await asyncio.sleep(interval)
+            self.log_stats()
+
+    def log_stats(self) -> None:
+        """Log each camera's statistics."""
+        for camera_id, summary in self.stats().items():
+            logger.info(f"Camera {camera_id}: {summary}")
+
+    def stats(self) -> Dict[str, dict]:
+        """Get the statistics of every camera."""
+        return {camera_id: camera.summary()
+                for camera_id, camera in self.cameras.items()}
+
+    async def run_async(self, duration: Optional[float] = None) -> None:
+        """
+        Run all cameras until cancelled, or for duration seconds.
+
+        Frames captured before stopping still finish uploading.
+        """
+        self._upload_slots = asyncio.Semaphore(self.max_uploads)
+        capture_tasks = []
+        upload_tasks = []
+        for camera in self.cameras.values():
+            camera.jobs = asyncio.Queue(maxsize=self.queue_size)
+            camera.wake = asyncio.Event()
+            capture_tasks.append(asyncio.create_task(self._capture_loop(camera)))
+            upload_tasks.append(asyncio.create_task(self._upload_loop(camera)))
+        reporter = asyncio.create_task(self._report_loop(Config.GATEWAY_STATS_INTERVAL))
+        logger.info(f"Gateway running {len(self.cameras)} cameras, "
+                    f"up to {self.max_uploads} uploads at once")
+
+        try:
+            if duration:
+                await asyncio.sleep(duration)
+            else:
+                await asyncio.Event().wait()
+        finally:
+            reporter.cancel()
+            for task in capture_tasks:
+                task.cancel()
+            await asyncio.gather(*capture_tasks, return_exceptions=True)
+            for camera in self.cameras.values():
+                # Make room for the stop marker rather than wait for it
+                if camera.jobs.full():
+                    camera.jobs.get_nowait()
+                    camera.stats["dropped"] += 1
+                camera.jobs.put_nowait(_STOP)
+            await asyncio.gather(*upload_tasks, return_exceptions=True)
+
+    def run(self, duration: Optional[float] = None) -> None:
+        """Run the gateway, blocking until interrupted or duration passes."""
+        try:
+            asyncio.run(self.run_async(duration))
+        except KeyboardInterrupt:
+            logger.info("Gateway stopped by user")
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Release the cameras and worker threads."""
+        for camera in self.cameras.values():
+            camera.service.close_camera()
+        self.executor.shutdown(wait=True)
+        self.log_stats()
+
+
+def start_sink(latency: float) -> str:
+    """
+    Start a stand-in ML service that answers every upload after latency.
+
+    Returns:
+        URL of the stand-in service
+    """
+    body = json.dumps({
+        "success": True,
+        "top_prediction": {"label": "plastic", "confidence": 0.5}
+    }).encode()
+
+    class SinkHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(latency)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SinkHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}"
+
+
+def simulate(
+    num_cameras: int,
+    interval: float,
+    duration: float,
+    images: str = '',
+    capture_delay: float = 0.05,
+    ml_service_url: Optional[str] = None,
+    max_uploads: Optional[int] = None
+) -> dict:
+    """
+    Run fake cameras at a fixed interval and check the gateway keeps up.
+
+    A camera is sustained if its capture period stays within 10% of the
+    interval and no upload was dropped.
+
+    Args:
+        num_cameras: Number of fake cameras
+        interval: Capture interval of every camera, in seconds
+        duration: Seconds to run for
+        images: Optional glob of images to replay, instead of synthetic
+            frames
+        capture_delay: Seconds each fake capture takes
+        ml_service_url: URL to upload to
+        max_uploads: Uploads in flight at once
+
+    Returns:
+        Dict of the benchmark's results
+    """
+    # Per-frame logs from hundreds of cameras would swamp the results
+    logging.getLogger("service").setLevel(logging.WARNING)
+    paths = sorted(glob.glob(images)) if images else []
+    cameras = [{
+        "id": f"sim-{i:03d}",
+        "interval": interval,
+        "min_interval": interval,
+        "max_interval": interval,
+        "camera": FakeCamera(image_paths=paths, capture_delay=capture_delay)
+    } for i in range(num_cameras)]
+    with tempfile.TemporaryDirectory() as spool_dir:
+        gateway = CameraGateway(cameras, ml_service_url=ml_service_url,
+                                max_uploads=max_uploads, spool_dir=spool_dir)
+        gateway.run(duration)
+        stats = gateway.stats()
+
+    sustained = [camera_id for camera_id, summary in stats.items()
+                 if summary["period"] is not None
+                 and summary["period"] <= interval * 1.1
+                 and summary["dropped"] == 0]
+    periods = [s["period"] for s in stats.values() if s["period"] is not None]
+    latencies = [s["upload_p95_ms"] for s in stats.values()
+                 if s["upload_p95_ms"] is not None]
+    return {
+        "cameras": num_cameras,
+        "sustained": len(sustained),
+        "uploads": sum(s["uploads"] for s in stats.values()),
+        "dropped": sum(s["dropped"] for s in stats.values()),
+        "mean_period": statistics.mean(periods) if periods else None,
+        "worst_upload_p95_ms": max(latencies) if latencies else None
+    }
+
+
+def main():
+    """Main entry point for the gateway."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--cameras', default=Config.GATEWAY_CAMERAS,
+                        help='JSON file listing the cameras.')
+    parser.add_argument('--max_uploads', type=int, default=Config.GATEWAY_MAX_UPLOADS,
+                        help='Uploads in flight at once, across all cameras.')
+    parser.add_argument('--simulate', type=int, default=0,
+                        help='Benchmark with this many fake cameras instead.')
+    parser.add_argument('--interval', type=float, default=5.0,
+                        help='Capture interval of the fake cameras.')
+    parser.add_argument('--duration', type=float, default=60.0,
+                        help='Seconds to run the benchmark for.')
+    parser.add_argument('--images', default='',
+                        help='Glob of images for the fake cameras to replay.')
+    parser.add_argument('--capture_delay', type=float, default=0.05,
+                        help='Seconds each fake capture takes.')
+    parser.add_argument('--sink_latency', type=float, default=-1,
+                        help='Upload to a local stand-in service answering '
+                             'after this many seconds, instead of the ML service.')
+    args = parser.parse_args()
+
+    if args.simulate:
+        url = start_sink(args.sink_latency) if args.sink_latency >= 0 else None
+        result = simulate(args.simulate, args.interval, args.duration,
+                          images=args.images, capture_delay=args.capture_delay,
+                          ml_service_url=url, max_uploads=args.max_uploads)
+        logger.info(f"Benchmark: {json.dumps(result)}")
+        return
+
+    gateway = CameraGateway(load_cameras(args.cameras),
+                            max_uploads=args.max_uploads)
+    gateway.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,35 @@
+"""
+Image resizing shared by the training tools and the camera service.
+"""
+import io
+
+from PIL import Image
+
+
+def reduce_image(data: bytes, size: int, quality: int) -> bytes:
+    """
+    Shrink an image so that its shorter side is at most size pixels.
+
+    Uses the JPEG decoder's draft mode, so large photos are decoded at a
+    fraction of their resolution. Images already small enough are
+    re-encoded at their own size.
+
+    Args:
+        data: Source image bytes
+        size: Target length of the shorter side, 0 to keep the size
+        quality: JPEG quality of the output
+
+    Returns:
+        Encoded JPEG bytes
+    """
+    image = Image.open(io.BytesIO(data))
+    width, height = image.size
+    scale = min(1.0, size / float(min(width, height))) if size > 0 else 1.0
+    target = (max(1, round(width * scale)), max(1, round(height * scale)))
+    image.draft('RGB', target)
+    image = image.convert('RGB')
+    if image.size != target:
+        image = image.resize(target, Image.LANCZOS)
+    output = io.BytesIO()
+    image.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
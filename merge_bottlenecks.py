@@ -0,0 +1,212 @@
+"""
+Merge the output of a sharded bottleneck extraction into one cache.
+
+Each shard is produced by `retrain.py --num_shards=N --shard_index=i`, which
+writes its bottleneck files plus a `shard-i-of-N.json` manifest. This script
+copies every shard into a single bottleneck folder, then checks that
+all N shards are present, that every file listed in a manifest exists,
+and that no two sources disagree about the same bottleneck. When the image
+folder is given, it also checks that every image in the dataset has a
+bottleneck.
+
+Example:
+    python merge_bottlenecks.py \
+        --shard_dirs=shard0,shard1,shard2 \
+        --bottleneck_dir=tf_files/bottlenecks \
+        --image_dir=training_dataset
+"""
+import argparse
+import glob
+import json
+import logging
+import os
+import shutil
+import sys
+from typing import Dict, List, Optional
+
+import numpy as np
+
+import retrain
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+def load_manifests(shard_dirs: List[str]) -> List[dict]:
+    """
+    Load every shard manifest found in the given folders.
+
+    Args:
+        shard_dirs: Folders written by sharded retrain.py runs
+
+    Returns:
+        List of manifests, each with an added 'source' folder
+    """
+    manifests = []
+    for shard_dir in shard_dirs:
+        for path in sorted(glob.glob(os.path.join(shard_dir, 'shard-*-of-*.json'))):
+            with open(path) as f:
+                manifest = json.load(f)
+            manifest['source'] = shard_dir
+            manifests.append(manifest)
+    return manifests
+
+
+def same_bottleneck(path_a: str, path_b: str) -> bool:
+    """
+    Compare two bottleneck files.
+
+    Identical bytes are equal. Otherwise the values are parsed and compared
+    with a small tolerance, since machines may format floats differently.
+    """
+    with open(path_a) as f:
+        text_a = f.read()
+    with open(path_b) as f:
+        text_b = f.read()
+    if text_a == text_b:
+        return True
+    try:
+        values_a = np.array([float(x) for x in text_a.split(',')])
+        values_b = np.array([float(x) for x in text_b.split(',')])
+    except ValueError:
+        return False
+    return values_a.shape == values_b.shape and np.allclose(
+        values_a, values_b, rtol=1e-5, atol=1e-6)
+
+
+def merge_shards(
+    shard_dirs: List[str],
+    bottleneck_dir: str,
+    image_dir: Optional[str] = None,
+    testing_percentage: int = 10,
+    validation_percentage: int = 10,
+    image_archives: str = ''
+) -> Dict[str, list]:
+    """
+    Merge shard outputs into one bottleneck folder and verify the result.
+
+    Args:
+        shard_dirs: Folders written by sharded retrain.py runs
+        bottleneck_dir: Destination bottleneck folder (may be one of the
+            shard folders)
+        image_dir: Optional image folder to check completeness against
+        testing_percentage: Test split percentage, used to list the dataset
+        validation_percentage: Validation split percentage, used to list the
+            dataset
+        image_archives: Optional glob of tar/zip shards to check completeness
+            against instead of image_dir
+
+    Returns:
+        Dict of problem lists: 'missing_shards', 'missing_files',
+        'conflicts', 'misplaced' and 'uncovered_images'
+    """
+    problems = {'missing_shards': [], 'missing_files': [], 'conflicts': [],
+                'misplaced': [], 'uncovered_images': []}
+    manifests = load_manifests(shard_dirs)
+    if not manifests:
+        problems['missing_shards'].append('no shard manifests found')
+        return problems
+
+    num_shards_seen = {m['num_shards'] for m in manifests}
+    if len(num_shards_seen) > 1:
+        problems['conflicts'].append(
+            f"shards disagree on num_shards: {sorted(num_shards_seen)}")
+    num_shards = max(num_shards_seen)
+    present = {m['shard_index'] for m in manifests}
+    problems['missing_shards'].extend(
+        f"shard {i} of {num_shards}" for i in range(num_shards) if i not in present)
+
+    retrain.ensure_dir_exists(bottleneck_dir)
+    owner = {}
+    copied = 0
+    for manifest in manifests:
+        shard = manifest['shard_index']
+        for relative_path in manifest['files']:
+            source = os.path.join(manifest['source'], relative_path)
+            if not os.path.exists(source):
+                problems['missing_files'].append(source)
+                continue
+            sub_dir, file_name = os.path.split(relative_path)
+            base_name = file_name[:-len('.txt')]
+            if retrain.get_shard_index(sub_dir, base_name, num_shards) != shard:
+                problems['misplaced'].append(source)
+            destination = os.path.join(bottleneck_dir, relative_path)
+            if relative_path in owner:
+                if not same_bottleneck(owner[relative_path], source):
+                    problems['conflicts'].append(
+                        f"{owner[relative_path]} != {source}")
+                continue
+            owner[relative_path] = source
+            if os.path.abspath(source) == os.path.abspath(destination):
+                continue
+            if os.path.exists(destination):
+                if not same_bottleneck(destination, source):
+                    problems['conflicts'].append(f"{destination} != {source}")
+                continue
+            retrain.ensure_dir_exists(os.path.dirname(destination))
+            shutil.copyfile(source, destination)
+            copied += 1
+        # Keep the manifests with the merged cache, so it can be re-verified.
+        if os.path.abspath(manifest['source']) != os.path.abspath(bottleneck_dir):
+            with open(retrain.get_shard_manifest_path(
+                    bottleneck_dir, manifest['num_shards'], shard), 'w') as f:
+                json.dump({k: v for k, v in manifest.items() if k != 'source'},
+                          f, indent=1)
+    logger.info(f"Merged {len(owner)} bottlenecks from {len(manifests)} shards "
+                f"({copied} copied)")
+
+    if image_dir or image_archives:
+        image_lists = retrain.load_image_lists(
+            image_dir, image_archives, testing_percentage, validation_percentage)
+        for label_name, label_lists in image_lists.items():
+            for category in ('training', 'testing', 'validation'):
+                for index in range(len(label_lists[category])):
+                    relative_path = retrain.get_bottleneck_relative_path(
+                        image_lists, label_name, index, category)
+                    if not os.path.exists(os.path.join(bottleneck_dir, relative_path)):
+                        problems['uncovered_images'].append(relative_path)
+    return problems
+
+
+def main():
+    """Main entry point for command-line usage."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--shard_dirs', required=True,
+                        help='Comma-separated folders written by the shards.')
+    parser.add_argument('--bottleneck_dir', default='tf_files/bottlenecks',
+                        help='Folder to merge the shards into.')
+    parser.add_argument('--image_dir', default='',
+                        help='Optional image folder to check completeness against.')
+    parser.add_argument('--image_archives', default='',
+                        help='Optional glob of tar/zip shards to check against instead.')
+    parser.add_argument('--testing_percentage', type=int, default=10,
+                        help='What percentage of images to use as a test set.')
+    parser.add_argument('--validation_percentage', type=int, default=10,
+                        help='What percentage of images to use as a validation set.')
+    args = parser.parse_args()
+
+    problems = merge_shards(
+        [d for d in args.shard_dirs.split(',') if d],
+        args.bottleneck_dir,
+        image_dir=args.image_dir or None,
+        testing_percentage=args.testing_percentage,
+        validation_percentage=args.validation_percentage,
+        image_archives=args.image_archives
+    )
+    failed = False
+    for kind, items in problems.items():
+        if items:
+            failed = True
+            logger.error(f"{len(items)} {kind.replace('_', ' ')}:")
+            for item in items[:20]:
+                logger.error(f"  {item}")
+    if failed:
+        sys.exit(1)
+    logger.info("Bottleneck cache is complete and consistent")
+
+
+if __name__ == '__main__':
+    main()
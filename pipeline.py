@@ -0,0 +1,234 @@
+"""
+Fixed-rate capture pipeline for the camera service.
+
+Capture, encode and upload run as separate stages connected by bounded
+queues, so a slow upload no longer delays the next capture. Captures are
+scheduled at a fixed rate rather than a fixed pause after each upload. The
+interval adapts to what the camera sees: it drops to its minimum when waste
+is detected and backs off towards its maximum while the bin is unchanged.
+"""
+import logging
+import queue
+import threading
+import time
+from typing import Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Marks the end of the stream in the stage queues.
+_STOP = object()
+
+
+class AdaptiveInterval:
+    """Capture interval that speeds up on activity and backs off when idle."""
+
+    def __init__(
+        self,
+        interval: float,
+        min_interval: float,
+        max_interval: float,
+        backoff: float = 1.5
+    ):
+        """
+        Initialize the interval.
+
+        Args:
+            interval: Starting interval in seconds
+            min_interval: Interval while waste is being detected
+            max_interval: Longest interval while the bin is unchanged
+            backoff: Factor the interval grows by per idle frame
+        """
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.interval = min(max(interval, self.min_interval), self.max_interval)
+        self._lock = threading.Lock()
+
+    def active(self) -> bool:
+        """
+        Drop to the minimum interval.
+
+        Returns:
+            True if the interval got shorter
+        """
+        with self._lock:
+            shorter = self.interval > self.min_interval
+            self.interval = self.min_interval
+            return shorter
+
+    def idle(self) -> None:
+        """Lengthen the interval, up to the maximum."""
+        with self._lock:
+            self.interval = min(self.interval * self.backoff, self.max_interval)
+
+    def observe_upload(self, job: tuple, response_data: Optional[dict],
+                       confidence_threshold: float) -> bool:
+        """
+        Adapt to the response to an upload.
+
+        A confident top prediction counts as waste detected and an
+        uncertain one as idle; keep-alives and uploads without a response
+        leave the interval alone. For on-device results the prediction is
+        the job's own, since /report answers without one.
+
+        Args:
+            job: Upload job from CameraService.encode_frame
+            response_data: Response data from the ML service, if any
+            confidence_threshold: Confidence that counts as detected
+
+        Returns:
+            True if the interval got shorter
+        """
+        if job[0] == "keepalive":
+            return False
+        source = job[1] if job[0] == "result" else response_data
+        top_prediction = (source or {}).get("top_prediction") or {}
+        confidence = top_prediction.get("confidence")
+        if confidence is None:
+            return False
+        if confidence >= confidence_threshold:
+            return self.active()
+        self.idle()
+        return False
+
+
+class CapturePipeline:
+    """
+    Runs a CameraService as a three-stage pipeline.
+
+    The calling thread captures on schedule; encoding (change detection,
+    on-device classification, downscaling) and uploading each run in a
+    worker thread. When the encode stage falls behind, the oldest waiting
+    frame is dropped in favour of the newest.
+    """
+
+    def __init__(self, service, schedule: Optional[AdaptiveInterval] = None,
+                 queue_size: Optional[int] = None):
+        """
+        Initialize the pipeline.
+
+        Args:
+            service: CameraService to capture, encode and upload with
+            schedule: Capture interval (defaults to one starting at the
+                service's capture_interval, bounded by the configuration)
+            queue_size: Capacity of each stage queue
+        """
+        self.service = service
+        self.schedule = schedule or AdaptiveInterval(
+            service.capture_interval,
+            Config.CAPTURE_MIN_INTERVAL,
+            Config.CAPTURE_MAX_INTERVAL,
+            Config.CAPTURE_BACKOFF
+        )
+        queue_size = queue_size or Config.PIPELINE_QUEUE_SIZE
+        self.frames: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.jobs: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.stats = {"captures": 0, "dropped": 0, "overruns": 0}
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+
+    def _put_latest(self, frame: bytes) -> None:
+        """Queue a frame, dropping the oldest one if the queue is full."""
+        while True:
+            try:
+                self.frames.put_nowait(frame)
+                return
+            except queue.Full:
+                try:
+                    self.frames.get_nowait()
+                    self.stats["dropped"] += 1
+                except queue.Empty:
+                    pass
+
+    def _encode_stage(self) -> None:
+        """Turn frames into upload jobs."""
+        while True:
+            frame = self.frames.get()
+            if frame is _STOP:
+                self.jobs.put(_STOP)
+                return
+            try:
+                job = self.service.encode_frame(frame)
+            except Exception as e:
+                logger.error(f"Error encoding frame: {e}")
+                continue
+            if job is None or job[0] == "keepalive":
+                self.schedule.idle()
+            if job is not None:
+                self.jobs.put(job)
+
+    def _upload_stage(self) -> None:
+        """Send upload jobs, and the spooled backlog while there are none."""
+        while True:
+            try:
+                job = self.jobs.get(timeout=self.schedule.interval)
+            except queue.Empty:
+                self.service.drain_uploads()
+                continue
+            if job is _STOP:
+                return
+            try:
+                response_data = self.service.upload_job(job)
+            except Exception as e:
+                logger.error(f"Error uploading: {e}")
+                continue
+            if self.schedule.observe_upload(job, response_data,
+                                            self.service.confidence_threshold):
+                logger.info(f"Waste detected, capturing every "
+                            f"{self.schedule.interval:.0f}s")
+                self._wake.set()
+
+    def run(self, max_captures: Optional[int] = None) -> None:
+        """
+        Capture on schedule until interrupted or stopped.
+
+        Args:
+            max_captures: Stop after this many captures, for benchmarks
+        """
+        workers = [
+            threading.Thread(target=self._encode_stage, name="encode", daemon=True),
+            threading.Thread(target=self._upload_stage, name="upload", daemon=True)
+        ]
+        for worker in workers:
+            worker.start()
+
+        next_capture = time.monotonic()
+        try:
+            while not self._stop.is_set():
+                started = time.monotonic()
+                image_data = self.service.capture_image()
+                if image_data is not None:
+                    self.stats["captures"] += 1
+                    self._put_latest(image_data)
+                if max_captures and self.stats["captures"] >= max_captures:
+                    break
+
+                next_capture += self.schedule.interval
+                now = time.monotonic()
+                if next_capture < now:
+                    # The capture overran its slot; start again from now
+                    # rather than firing the missed slots back to back.
+                    self.stats["overruns"] += 1
+                    next_capture = now
+                while not self._stop.is_set():
+                    self._wake.clear()
+                    if self._wake.wait(max(0.0, next_capture - time.monotonic())):
+                        # The interval got shorter while waiting
+                        next_capture = min(next_capture,
+                                           started + self.schedule.interval)
+                    if time.monotonic() >= next_capture:
+                        break
+        except KeyboardInterrupt:
+            logger.info("Service stopped by user")
+        finally:
+            # Let frames already captured finish encoding and uploading.
+            self.frames.put(_STOP)
+            for worker in workers:
+                worker.join(timeout=60)
+
+    def stop(self) -> None:
+        """Stop capturing, from another thread."""
+        self._stop.set()
+        self._wake.set()
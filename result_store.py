@@ -0,0 +1,493 @@
+"""
+Local history of detection results, and the sinks results are written to.
+
+Every result the ML service produces is handed to a ResultSinks, which
+passes it on to each configured sink: the local ResultStore, Firebase, or
+anything else with push() and close() methods. ResultStore keeps every
+result in an append-only SQLite table, indexed by bin, time and label.
+Results are queued in memory and inserted by a background thread in
+batches, one transaction per batch. The same transaction updates rollups:
+counts per bin and label for every hour and every day (UTC). rollup()
+answers queries from these instead of the raw history, so its cost does
+not grow with the number of results stored.
+
+Example:
+    python result_store.py --path=/tmp/results.db --results=200000 --bins=1000
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Rollup periods and their length in seconds.
+PERIODS = {"hour": 3600, "day": 86400}
+
+
+def result_row(result: Dict[str, Any], bin_id: str, created: float) -> tuple:
+    """
+    Flatten a result into a row of the results table.
+
+    Args:
+        result: Result with a "top_prediction" of {"label", "confidence"}
+        bin_id: Bin the result came from
+        created: Unix time the result was received
+
+    Returns:
+        Tuple of (bin_id, created, label, confidence, result JSON)
+    """
+    top_prediction = result.get("top_prediction") or {}
+    label = top_prediction.get("label")
+    confidence = top_prediction.get("confidence")
+    return (bin_id, created, None if label is None else str(label),
+            None if confidence is None else float(confidence),
+            json.dumps(result, separators=(',', ':')))
+
+
+class ResultStore:
+    """
+    Append-only history of results, stored in SQLite.
+
+    push() only queues a result; it is written by a background thread at
+    the next flush, which comes every flush interval or as soon as a full
+    batch is waiting.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        batch_size: int = 500,
+        flush_interval: float = 1.0
+    ):
+        """
+        Open, or create, a store.
+
+        Args:
+            path: Path to the SQLite database file
+            batch_size: Queued results that trigger an early flush
+            flush_interval: Seconds between flushes
+        """
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._pending: List[tuple] = []
+        self._lock = threading.Lock()
+        self._db_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {"received": 0, "written": 0, "batches": 0, "failed": 0}
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " id INTEGER PRIMARY KEY,"
+            " bin_id TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " label TEXT,"
+            " confidence REAL,"
+            " result TEXT NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS results_bin_created"
+            " ON results (bin_id, created)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS results_label_created"
+            " ON results (label, created)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS results_created ON results (created)"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS rollups ("
+            " period TEXT NOT NULL,"
+            " bucket INTEGER NOT NULL,"
+            " bin_id TEXT NOT NULL,"
+            " label TEXT NOT NULL,"
+            " count INTEGER NOT NULL,"
+            " confidence_sum REAL NOT NULL,"
+            " PRIMARY KEY (period, bucket, bin_id, label)) WITHOUT ROWID"
+        )
+        self._db.commit()
+        if self._db.execute("SELECT 1 FROM rollups LIMIT 1").fetchone() is None:
+            self._rebuild_rollups()
+
+    def _rebuild_rollups(self) -> None:
+        """Compute the rollups of a history written before they existed."""
+        with self._db:
+            for period, seconds in PERIODS.items():
+                self._db.execute(
+                    "INSERT INTO rollups (period, bucket, bin_id, label, count,"
+                    " confidence_sum)"
+                    " SELECT ?, CAST(created / ? AS INTEGER) * ?, bin_id,"
+                    " COALESCE(label, ''), COUNT(*), COALESCE(SUM(confidence), 0)"
+                    " FROM results GROUP BY 2, 3, 4",
+                    (period, seconds, seconds)
+                )
+
+    @staticmethod
+    def _batch_rollups(batch: List[tuple]) -> List[tuple]:
+        """Sum a batch of rows into rollup increments."""
+        increments: Dict[tuple, List[float]] = {}
+        for bin_id, created, label, confidence, _ in batch:
+            for period, seconds in PERIODS.items():
+                key = (period, int(created // seconds) * seconds, bin_id, label or '')
+                total = increments.setdefault(key, [0, 0.0])
+                total[0] += 1
+                total[1] += confidence or 0.0
+        return [key + (count, confidence_sum)
+                for key, (count, confidence_sum) in increments.items()]
+
+    def push(self, result: Dict[str, Any], path: Optional[str] = None) -> bool:
+        """
+        Queue a result for the history.
+
+        Args:
+            result: Result dictionary
+            path: Optional bin id (defaults to configured B_ID)
+
+        Returns:
+            bool: True, as the result is always queued
+        """
+        row = result_row(result, path or Config.FIREBASE_B_ID, time.time())
+        with self._lock:
+            self.stats["received"] += 1
+            self._pending.append(row)
+            if len(self._pending) >= self.batch_size:
+                self._wake.set()
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="result-store",
+                                                daemon=True)
+                self._thread.start()
+        return True
+
+    def _run(self) -> None:
+        """Flush periodically, or when a batch is full, until closed."""
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Insert the queued results in one transaction.
+
+        Returns:
+            Number of results written
+        """
+        with self._lock:
+            batch, self._pending = self._pending, []
+        if not batch:
+            return 0
+
+        try:
+            with self._db_lock:
+                with self._db:
+                    self._db.executemany(
+                        "INSERT INTO results (bin_id, created, label, confidence, result)"
+                        " VALUES (?, ?, ?, ?, ?)",
+                        batch
+                    )
+                    self._db.executemany(
+                        "INSERT INTO rollups (period, bucket, bin_id, label, count,"
+                        " confidence_sum) VALUES (?, ?, ?, ?, ?, ?)"
+                        " ON CONFLICT (period, bucket, bin_id, label) DO UPDATE SET"
+                        " count = count + excluded.count,"
+                        " confidence_sum = confidence_sum + excluded.confidence_sum",
+                        self._batch_rollups(batch)
+                    )
+        except sqlite3.Error as e:
+            self.stats["failed"] += len(batch)
+            logger.error(f"Failed to write {len(batch)} results to the history: {e}")
+            return 0
+        self.stats["written"] += len(batch)
+        self.stats["batches"] += 1
+        return len(batch)
+
+    def query(
+        self,
+        bin_id: Optional[str] = None,
+        label: Optional[str] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        limit: int = 100
+    ) -> List[Dict[str, Any]]:
+        """
+        Get stored results, newest first.
+
+        Results still queued for the next flush are not included.
+
+        Args:
+            bin_id: Only results from this bin
+            label: Only results with this top label
+            start: Only results received at or after this Unix time
+            end: Only results received before this Unix time
+            limit: Maximum number of results to return
+
+        Returns:
+            List of {"bin_id", "created", "result"} dictionaries
+        """
+        conditions = []
+        params: List[Any] = []
+        if bin_id is not None:
+            conditions.append("bin_id = ?")
+            params.append(bin_id)
+        if label is not None:
+            conditions.append("label = ?")
+            params.append(label)
+        if start is not None:
+            conditions.append("created >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("created < ?")
+            params.append(end)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        with self._db_lock:
+            rows = self._db.execute(
+                f"SELECT bin_id, created, result FROM results{where}"
+                " ORDER BY created DESC LIMIT ?",
+                params + [limit]
+            ).fetchall()
+        return [{"bin_id": b, "created": created, "result": json.loads(result)}
+                for b, created, result in rows]
+
+    def rollup(
+        self,
+        start: float,
+        end: float,
+        bin_id: Optional[str] = None,
+        label: Optional[str] = None,
+        interval: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Summarize the results received in a time range, from the rollups.
+
+        The range is widened to whole hours. Whole days inside it are read
+        from the daily rollups and only the hours at either end from the
+        hourly ones, so at most 48 hourly buckets are read per bin and
+        label, however long the range.
+
+        Args:
+            start: Start of the range, as a Unix time
+            end: End of the range, as a Unix time
+            bin_id: Only results from this bin
+            label: Only results with this top label
+            interval: 'hour' or 'day' to also get a count per bucket
+
+        Returns:
+            Dictionary with the range, the total count, count and mean
+            confidence per label, count per bin, and with an interval, a
+            list of {"time", "count"} per non-empty bucket; a day
+            bucket at either end counts only the hours inside the range
+
+        Raises:
+            ValueError: If the interval is unknown
+        """
+        if interval is not None and interval not in PERIODS:
+            raise ValueError(f"interval must be one of {', '.join(PERIODS)}")
+        hour, day = PERIODS["hour"], PERIODS["day"]
+        start = int(start // hour) * hour
+        end = max(start, -int(-end // hour) * hour)
+        first_day = -(-start // day) * day
+        last_day = max(first_day, end // day * day)
+
+        filters = ""
+        params: List[Any] = []
+        if bin_id is not None:
+            filters += " AND bin_id = ?"
+            params.append(bin_id)
+        if label is not None:
+            filters += " AND label = ?"
+            params.append(label)
+
+        # Hours at either end of the range, and the whole days between.
+        where = (" WHERE ((period = 'hour' AND ((bucket >= ? AND bucket < ?)"
+                 " OR (bucket >= ? AND bucket < ?)))"
+                 " OR (period = 'day' AND bucket >= ? AND bucket < ?))"
+                 f"{filters}")
+        where_params = [start, min(first_day, end), max(last_day, start), end,
+                        first_day, last_day] + params
+        with self._db_lock:
+            rows = self._db.execute(
+                "SELECT bin_id, label, SUM(count), SUM(confidence_sum) FROM rollups"
+                f"{where} GROUP BY bin_id, label",
+                where_params
+            ).fetchall()
+            series = None
+            if interval == "hour":
+                series = self._db.execute(
+                    "SELECT bucket, SUM(count) FROM rollups"
+                    " WHERE period = 'hour' AND bucket >= ? AND bucket < ?"
+                    f"{filters} GROUP BY bucket ORDER BY bucket",
+                    [start, end] + params
+                ).fetchall()
+            elif interval == "day":
+                # The days at either end are only partly in the range, so
+                # they are summed from the same hours as the total.
+                series = self._db.execute(
+                    "SELECT bucket - bucket % ? AS day, SUM(count) FROM rollups"
+                    f"{where} GROUP BY day ORDER BY day",
+                    [day] + where_params
+                ).fetchall()
+
+        labels: Dict[str, Dict[str, Any]] = {}
+        bins: Dict[str, int] = {}
+        total = 0
+        for row_bin, row_label, count, confidence_sum in rows:
+            total += count
+            bins[row_bin] = bins.get(row_bin, 0) + count
+            entry = labels.setdefault(row_label, {"count": 0, "confidence_sum": 0.0})
+            entry["count"] += count
+            entry["confidence_sum"] += confidence_sum
+        summary = {
+            "start": start,
+            "end": end,
+            "total": total,
+            "labels": {
+                name: {"count": entry["count"],
+                       "mean_confidence": entry["confidence_sum"] / entry["count"]}
+                for name, entry in labels.items()
+            },
+            "bins": bins
+        }
+        if series is not None:
+            summary["series"] = [{"time": bucket, "count": count}
+                                 for bucket, count in series]
+        return summary
+
+    def __len__(self) -> int:
+        with self._db_lock:
+            return self._db.execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def close(self) -> None:
+        """Stop the background thread, write what is still queued and close."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        with self._db_lock:
+            self._db.close()
+
+
+class ResultSinks:
+    """
+    Passes each result on to several sinks.
+
+    A sink is any object with push(result, path) and close() methods, such
+    as ResultStore or firebase.FirebaseWriteBuffer. A sink that fails does
+    not stop the others from getting the result.
+    """
+
+    def __init__(self, sinks: Optional[List[Any]] = None):
+        """
+        Initialize the sinks.
+
+        Args:
+            sinks: Sinks to pass results on to
+        """
+        self.sinks = list(sinks or [])
+
+    def add(self, sink: Any) -> None:
+        """Add a sink."""
+        self.sinks.append(sink)
+
+    def push(self, result: Dict[str, Any], path: Optional[str] = None) -> None:
+        """
+        Pass a result on to every sink.
+
+        Args:
+            result: Result dictionary
+            path: Optional bin id
+        """
+        for sink in self.sinks:
+            try:
+                sink.push(result, path)
+            except Exception as e:
+                logger.error(f"{type(sink).__name__} failed to take a result: {e}")
+
+    def close(self) -> None:
+        """Close every sink."""
+        for sink in self.sinks:
+            try:
+                sink.close()
+            except Exception as e:
+                logger.error(f"Failed to close {type(sink).__name__}: {e}")
+
+
+def main():
+    """Benchmark sustained inserts into a result store."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--path', default='benchmark_results.db',
+                        help='Database file to write; it is deleted first.')
+    parser.add_argument('--results', type=int, default=100000,
+                        help='Number of results to push.')
+    parser.add_argument('--bins', type=int, default=1000,
+                        help='Number of bins the results come from.')
+    parser.add_argument('--batch_size', type=int, default=Config.RESULT_STORE_BATCH_SIZE,
+                        help='Queued results that trigger a flush.')
+    args = parser.parse_args()
+
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.path + suffix):
+            os.remove(args.path + suffix)
+    labels = ['plastic', 'metal', 'glass', 'paper', 'cardboard', 'trash']
+    rng = random.Random(0)
+    results = [{
+        "success": True,
+        "image_id": f"{i:032x}",
+        "top_prediction": {"label": rng.choice(labels),
+                           "confidence": round(rng.random(), 4)}
+    } for i in range(args.results)]
+    bins = [f"bin-{rng.randrange(args.bins)}" for _ in range(args.results)]
+
+    store = ResultStore(args.path, batch_size=args.batch_size)
+    start = time.perf_counter()
+    for result, bin_id in zip(results, bins):
+        store.push(result, bin_id)
+    queued = time.perf_counter() - start
+    store.close()
+    seconds = time.perf_counter() - start
+    logger.info(f"Stored {store.stats['written']} results in {seconds:.2f}s "
+                f"({store.stats['written'] / seconds:,.0f} per second, "
+                f"{store.stats['batches']} batches, push took "
+                f"{queued / args.results * 1e6:.1f} us each)")
+
+    store = ResultStore(args.path)
+    start = time.perf_counter()
+    rows = store.query(bin_id=bins[0], start=time.time() - 3600)
+    by_bin = time.perf_counter() - start
+    start = time.perf_counter()
+    store.query(label='glass', limit=100)
+    by_label = time.perf_counter() - start
+    start = time.perf_counter()
+    summary = store.rollup(0, time.time() + 3600, interval='hour')
+    by_range = time.perf_counter() - start
+    store.close()
+    logger.info(f"Queried {len(rows)} results of one bin in {by_bin * 1000:.1f} ms, "
+                f"latest 100 of one label in {by_label * 1000:.1f} ms")
+    logger.info(f"Summarized {summary['total']} results from the rollups "
+                f"in {by_range * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -83,21 +83,25 @@ import tensorflow as tf
 tf.compat.v1.disable_v2_behavior()
 
 import argparse
+import csv
 from datetime import datetime
 import hashlib
+import json
+import math
 import os.path
 import random
 import re
 import struct
 import sys
 import tarfile
+import time
+import zipfile
 
 import numpy as np
 from six.moves import urllib
 import tensorflow as tf
 
 from tensorflow.python.framework import graph_util
-from tensorflow.python.framework import tensor_shape
 from tensorflow.python.platform import gfile
 from tensorflow.python.util import compat
 
@@ -119,6 +123,11 @@ JPEG_DATA_TENSOR_NAME = 'DecodeJpeg/contents:0'
 RESIZED_INPUT_TENSOR_NAME = 'ResizeBilinear:0'
 MAX_NUM_IMAGES_PER_CLASS = 2 ** 27 - 1  # ~134M
 
+# Transcoded images are kept a little larger than the biggest pre-crop size
+# the distortion flags can ask for, so that distorted training never upsamples.
+TRANSCODE_HEADROOM = 1.1
+TRANSCODE_MANIFEST_NAME = 'manifest.json'
+
 
 def create_image_lists(image_dir, testing_percentage, validation_percentage):
   """Builds a list of training images from the file system.
@@ -183,13 +192,11 @@ def create_image_lists(image_dir, testing_percentage, validation_percentage):
       # To do that, we need a stable way of deciding based on just the file name
       # itself, so we do a hash of that and then use that to generate a
       # probability value that we use to assign it.
-      hash_name_hashed = hashlib.sha1(compat.as_bytes(hash_name)).hexdigest()
-      percentage_hash = ((int(hash_name_hashed, 16) %
-                          (MAX_NUM_IMAGES_PER_CLASS + 1)) *
-                         (100.0 / MAX_NUM_IMAGES_PER_CLASS))
-      if percentage_hash < validation_percentage:
+      category = which_set(hash_name, testing_percentage,
+                           validation_percentage)
+      if category == 'validation':
         validation_images.append(base_name)
-      elif percentage_hash < (testing_percentage + validation_percentage):
+      elif category == 'testing':
         testing_images.append(base_name)
       else:
         training_images.append(base_name)
@@ -202,6 +209,361 @@ def create_image_lists(image_dir, testing_percentage, validation_percentage):
   return result
 
 
+def which_set(hash_name, testing_percentage, validation_percentage):
+  """Stably assigns an image to the training, testing or validation set.
+
+  Args:
+    hash_name: String identifying the image (or group of close variations of
+    it) that the assignment is derived from.
+    testing_percentage: Integer percentage of the images to reserve for tests.
+    validation_percentage: Integer percentage of images reserved for validation.
+
+  Returns:
+    Name string of the set - training, testing, or validation.
+  """
+  hash_name_hashed = hashlib.sha1(compat.as_bytes(hash_name)).hexdigest()
+  percentage_hash = ((int(hash_name_hashed, 16) %
+                      (MAX_NUM_IMAGES_PER_CLASS + 1)) *
+                     (100.0 / MAX_NUM_IMAGES_PER_CLASS))
+  if percentage_hash < validation_percentage:
+    return 'validation'
+  elif percentage_hash < (testing_percentage + validation_percentage):
+    return 'testing'
+  return 'training'
+
+
+def list_archive_members(archive_path):
+  """Lists the JPEG members of a tar or zip shard, with their labels.
+
+  Labels come from a sidecar index named <archive>.index.csv if one exists,
+  holding 'member,label' rows, optionally followed by the member's data offset
+  and size in the archive ('member,label,offset,size') to save scanning the tar
+  headers. Otherwise the label is the name of the folder the member is stored
+  under, as in ~/flower_photos/daisy/photo1.jpg.
+
+  Args:
+    archive_path: Path string to a .tar, .tar.gz, .tgz or .zip file.
+
+  Returns:
+    List of (member name, label folder name, data offset, size) tuples, in the
+    order the members are stored. The offset and size may be None for members
+    listed in an index without them.
+  """
+  index_path = archive_path + '.index.csv'
+  labels = None
+  if gfile.Exists(index_path):
+    members = []
+    with gfile.GFile(index_path, 'r') as f:
+      for row in csv.reader(f):
+        if not row or row[0] == 'member':
+          continue
+        if len(row) >= 4:
+          members.append((row[0], row[1], int(row[2]), int(row[3])))
+        else:
+          members.append((row[0], row[1], None, None))
+    if (archive_path.endswith('.zip') or
+        all(offset is not None for _, _, offset, _ in members)):
+      return sorted(members, key=lambda m: -1 if m[2] is None else m[2])
+    # The index has labels but no offsets, so take those from the tar headers.
+    labels = dict((member, label) for member, label, _, _ in members)
+
+  def label_of(member):
+    if labels is not None:
+      return labels.get(member)
+    return os.path.basename(os.path.dirname(member))
+
+  extensions = ('.jpg', '.jpeg')
+  members = []
+  if archive_path.endswith('.zip'):
+    with zipfile.ZipFile(archive_path) as archive:
+      for info in archive.infolist():
+        if info.is_dir() or not info.filename.lower().endswith(extensions):
+          continue
+        if label_of(info.filename):
+          members.append((info.filename, label_of(info.filename),
+                          info.header_offset, info.file_size))
+    return sorted(members, key=lambda m: m[2])
+  with tarfile.open(archive_path, 'r:*') as archive:
+    for info in archive:
+      if not info.isfile() or not info.name.lower().endswith(extensions):
+        continue
+      if label_of(info.name):
+        members.append((info.name, label_of(info.name), info.offset_data,
+                        info.size))
+  return members
+
+
+def create_image_lists_from_archives(archive_pattern, testing_percentage,
+                                     validation_percentage):
+  """Builds the image lists from sequential tar or zip shards.
+
+  Reading a handful of large archives avoids the per-file metadata and seek
+  cost of millions of small image files. The result has the same layout as
+  create_image_lists, with an extra 'archive_members' entry per label mapping
+  each image name to where it is stored.
+
+  Args:
+    archive_pattern: Glob pattern string matching the archive shards.
+    testing_percentage: Integer percentage of the images to reserve for tests.
+    validation_percentage: Integer percentage of images reserved for validation.
+
+  Returns:
+    A dictionary containing an entry for each label, with images split into
+    training, testing, and validation sets within each label.
+  """
+  archive_paths = sorted(gfile.Glob(archive_pattern))
+  if not archive_paths:
+    print("No archives found matching '" + archive_pattern + "'")
+    return {}
+  result = {}
+  for archive_path in archive_paths:
+    print("Looking for images in '" + archive_path + "'")
+    for member, dir_name, offset, size in list_archive_members(archive_path):
+      label_name = re.sub(r'[^a-z0-9]+', ' ', dir_name.lower())
+      label_lists = result.setdefault(label_name, {
+          'dir': dir_name,
+          'training': [],
+          'testing': [],
+          'validation': [],
+          'archive_members': {},
+      })
+      base_name = os.path.basename(member)
+      if base_name in label_lists['archive_members']:
+        print('WARNING: Skipping duplicate image %s/%s in %s' %
+              (dir_name, base_name, archive_path))
+        continue
+      label_lists['archive_members'][base_name] = (archive_path, member,
+                                                   offset, size)
+      hash_name = re.sub(r'_nohash_.*$', '', dir_name + '/' + base_name)
+      label_lists[which_set(hash_name, testing_percentage,
+                            validation_percentage)].append(base_name)
+  for label_name, label_lists in result.items():
+    image_count = len(label_lists['archive_members'])
+    if image_count < 20:
+      print('WARNING: Label %s has less than 20 images, which may cause '
+            'issues.' % label_name)
+  return result
+
+
+def load_image_lists(image_dir, image_archives, testing_percentage,
+                     validation_percentage):
+  """Builds the image lists from archive shards if given, else from image_dir.
+
+  Args:
+    image_dir: String path to a folder containing subfolders of images.
+    image_archives: Glob pattern string matching archive shards, or empty.
+    testing_percentage: Integer percentage of the images to reserve for tests.
+    validation_percentage: Integer percentage of images reserved for validation.
+
+  Returns:
+    A dictionary containing an entry for each label, with images split into
+    training, testing, and validation sets within each label.
+  """
+  if image_archives:
+    return create_image_lists_from_archives(
+        image_archives, testing_percentage, validation_percentage)
+  return create_image_lists(image_dir, testing_percentage,
+                            validation_percentage) or {}
+
+
+def exclude_images(image_lists, exclude_file):
+  """Drops the images listed in exclude_file from every split.
+
+  Used to prune the near-duplicates reported by dedup.py. The remaining
+  images keep their split, since it is derived from each file name.
+
+  Args:
+    image_lists: Dictionary of training images for each label.
+    exclude_file: Path to a file with one '<label folder>/<file name>' per line.
+
+  Returns:
+    Number of images removed.
+  """
+  with tf.io.gfile.GFile(exclude_file, 'r') as f:
+    excluded = set(line.strip() for line in f if line.strip())
+  removed = 0
+  for label_lists in image_lists.values():
+    for category in ['training', 'testing', 'validation']:
+      kept = [base_name for base_name in label_lists[category]
+              if label_lists['dir'] + '/' + base_name not in excluded]
+      removed += len(label_lists[category]) - len(kept)
+      label_lists[category] = kept
+  return removed
+
+
+# Open archives, kept for the life of the process so that random access
+# during distorted training doesn't reopen them for every image.
+archive_path_2_archive = {}
+
+
+def read_archive_member(archive_path, member, offset, size):
+  """Reads one image out of a tar or zip shard.
+
+  Members of an uncompressed tar are read with a single seek and contiguous
+  read, without touching the tar headers. Zip members and compressed tars go
+  through zipfile and tarfile.
+
+  Args:
+    archive_path: Path string to the archive.
+    member: Name string of the member within the archive.
+    offset: Integer byte offset of the member data in an uncompressed tar, or
+    None.
+    size: Integer byte size of the member data, or None.
+
+  Returns:
+    The raw bytes of the member.
+  """
+  if archive_path not in archive_path_2_archive:
+    if archive_path.endswith('.zip'):
+      archive = zipfile.ZipFile(archive_path)
+    elif archive_path.endswith('.tar') and offset is not None:
+      archive = open(archive_path, 'rb', buffering=1 << 20)
+    else:
+      archive = tarfile.open(archive_path, 'r:*')
+      # Index the members once, getmember() would scan them on every call.
+      archive = (archive, dict((info.name, info) for info in archive))
+    archive_path_2_archive[archive_path] = archive
+  archive = archive_path_2_archive[archive_path]
+  if isinstance(archive, zipfile.ZipFile):
+    return archive.read(member)
+  if isinstance(archive, tuple):
+    tar, members = archive
+    return tar.extractfile(members[member]).read()
+  archive.seek(offset)
+  return archive.read(size)
+
+
+def read_image_data(image_lists, label_name, index, image_dir, category,
+                    use_transcoded=False):
+  """Returns the raw JPEG bytes of an image, from a file or an archive.
+
+  Args:
+    image_lists: Dictionary of training images for each label.
+    label_name: Label string we want to get an image for.
+    index: Int offset of the image we want. This will be moduloed by the
+    available number of images for the label, so it can be arbitrarily large.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    category: Name string of set to pull images from - training, testing, or
+    validation.
+    use_transcoded: Whether to read the reduced copy attached by
+    attach_transcoded_images, when there is one.
+
+  Returns:
+    String of raw JPEG data.
+  """
+  label_lists = image_lists[label_name]
+  category_list = label_lists[category]
+  if not category_list:
+    tf.compat.v1.logging.fatal('Label %s has no images in the category %s.',
+                               label_name, category)
+  base_name = category_list[index % len(category_list)]
+  if use_transcoded and base_name in label_lists.get('transcoded', {}):
+    return gfile.GFile(label_lists['transcoded'][base_name], 'rb').read()
+  if 'archive_members' in label_lists:
+    return read_archive_member(*label_lists['archive_members'][base_name])
+  image_path = get_image_path(image_lists, label_name, index, image_dir,
+                              category)
+  if not gfile.Exists(image_path):
+    tf.compat.v1.logging.fatal('File does not exist %s', image_path)
+  return gfile.GFile(image_path, 'rb').read()
+
+
+def get_transcode_size(random_crop, random_scale):
+  """Returns the shorter-side length that transcoded images are reduced to.
+
+  The distortion graph stretches each image to at most
+  (1 + crop%) * (1 + scale%) times the model input size before cropping, so
+  any resolution beyond that is decoded only to be thrown away.
+
+  Args:
+    random_crop: Integer percentage setting the total margin used around the
+    crop box.
+    random_scale: Integer percentage of how much to vary the scale by.
+
+  Returns:
+    Integer pixel length.
+  """
+  return int(math.ceil(max(MODEL_INPUT_WIDTH, MODEL_INPUT_HEIGHT) *
+                       (1.0 + random_crop / 100.0) *
+                       (1.0 + random_scale / 100.0) * TRANSCODE_HEADROOM))
+
+
+def get_transcoded_path(transcode_dir, source_hash):
+  """Returns where the transcoded copy of a source image with this hash lives."""
+  return os.path.join(transcode_dir, source_hash[:2], source_hash + '.jpg')
+
+
+def get_image_source_stat(image_lists, label_name, base_name, image_dir):
+  """Returns the (size, mtime) pair that identifies a source image's version.
+
+  Archive members use their own size and the archive's modification time.
+  """
+  label_lists = image_lists[label_name]
+  if 'archive_members' in label_lists:
+    archive_path, _, _, size = label_lists['archive_members'][base_name]
+    return size, os.path.getmtime(archive_path)
+  stat = os.stat(os.path.join(image_dir, label_lists['dir'], base_name))
+  return stat.st_size, stat.st_mtime
+
+
+def attach_transcoded_images(image_lists, image_dir, transcode_dir,
+                             random_crop, random_scale):
+  """Points distorted training at the reduced copies written by transcode.py.
+
+  Adds a 'transcoded' dictionary mapping base names to transcoded files to
+  each label. Images missing from the manifest, or changed since they were
+  transcoded, keep being read from the source.
+
+  Args:
+    image_lists: Dictionary of training images for each label.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    transcode_dir: Folder written by transcode.py.
+    random_crop: Integer percentage setting the total margin used around the
+    crop box.
+    random_scale: Integer percentage of how much to vary the scale by.
+
+  Returns:
+    Number of images that will be read from the transcode cache.
+  """
+  manifest_path = os.path.join(transcode_dir, TRANSCODE_MANIFEST_NAME)
+  if not gfile.Exists(manifest_path):
+    print('WARNING: No transcode manifest at %s, reading source images.' %
+          manifest_path)
+    return 0
+  with gfile.GFile(manifest_path, 'r') as f:
+    manifest = json.load(f)
+  needed_size = get_transcode_size(random_crop, random_scale)
+  if manifest['size'] < needed_size:
+    print('WARNING: Images were transcoded to %d pixels but the distortion '
+          'flags need %d, so they will be upsampled.' %
+          (manifest['size'], needed_size))
+  entries = manifest['images']
+  attached = 0
+  stale = 0
+  for label_name, label_lists in image_lists.items():
+    transcoded = {}
+    for category in ['training', 'testing', 'validation']:
+      for base_name in label_lists[category]:
+        entry = entries.get(label_lists['dir'] + '/' + base_name)
+        if entry is None:
+          continue
+        if [entry['source_size'], entry['source_mtime']] != list(
+            get_image_source_stat(image_lists, label_name, base_name,
+                                  image_dir)):
+          stale += 1
+          continue
+        transcoded[base_name] = get_transcoded_path(transcode_dir,
+                                                    entry['sha1'])
+    label_lists['transcoded'] = transcoded
+    attached += len(transcoded)
+  if stale:
+    print('WARNING: %d images changed since they were transcoded, reading '
+          'them from the source.' % stale)
+  return attached
+
+
 def get_image_path(image_lists, label_name, index, image_dir, category):
   """"Returns a path to an image for a label at the given index.
 
@@ -255,16 +617,20 @@ def get_bottleneck_path(image_lists, label_name, index, bottleneck_dir,
                         category) + '.txt'
 
 
-def create_inception_graph():
+def create_inception_graph(model_dir=None):
   """"Creates a graph from saved GraphDef file and returns a Graph object.
 
+  Args:
+    model_dir: Folder string holding classify_image_graph_def.pb. Defaults to
+    --model_dir.
+
   Returns:
     Graph holding the trained Inception network, and various tensors we'll be
     manipulating.
   """
   with tf.compat.v1.Graph().as_default() as graph:
     model_filename = os.path.join(
-        FLAGS.model_dir, 'classify_image_graph_def.pb')
+        model_dir or FLAGS.model_dir, 'classify_image_graph_def.pb')
     with gfile.GFile(model_filename, 'rb') as f:
       graph_def = tf.compat.v1.GraphDef()
       graph_def.ParseFromString(f.read())
@@ -295,13 +661,16 @@ def run_bottleneck_on_image(sess, image_data, image_data_tensor,
   return bottleneck_values
 
 
-def maybe_download_and_extract():
+def maybe_download_and_extract(model_dir=None):
   """Download and extract model tar file.
 
   If the pretrained model we're using doesn't already exist, this function
   downloads it from the TensorFlow.org website and unpacks it into a directory.
+
+  Args:
+    model_dir: Folder string to unpack the model into. Defaults to --model_dir.
   """
-  dest_directory = FLAGS.model_dir
+  dest_directory = model_dir or FLAGS.model_dir
   if not os.path.exists(dest_directory):
     os.makedirs(dest_directory)
   filename = DATA_URL.split('/')[-1]
@@ -329,8 +698,8 @@ def ensure_dir_exists(dir_name):
   Args:
     dir_name: Path string to the folder we want to create.
   """
-  if not os.path.exists(dir_name):
-    os.makedirs(dir_name)
+  # exist_ok, because several shard processes may share one bottleneck_dir.
+  os.makedirs(dir_name, exist_ok=True)
 
 
 def write_list_of_floats_to_file(list_of_floats, file_path):
@@ -372,9 +741,8 @@ def create_bottleneck_file(bottleneck_path, image_lists, label_name, index,
   print('Creating bottleneck at ' + bottleneck_path)
   image_path = get_image_path(image_lists, label_name, index,
                               image_dir, category)
-  if not gfile.Exists(image_path):
-    tf.compat.v1.logging.fatal('File does not exist %s', image_path)
-  image_data = gfile.GFile(image_path, 'rb').read()
+  image_data = read_image_data(image_lists, label_name, index, image_dir,
+                               category)
   try:
     bottleneck_values = run_bottleneck_on_image(
         sess, image_data, jpeg_data_tensor, bottleneck_tensor)
@@ -441,8 +809,33 @@ def get_or_create_bottleneck(sess, image_lists, label_name, index, image_dir,
   return bottleneck_values
 
 
+def get_shard_index(sub_dir, base_name, num_shards):
+  """Returns which shard of a sharded bottleneck extraction owns an image.
+
+  The shard is derived from a hash of the image's label folder and file name,
+  the same key its cached bottleneck file is stored under, so every machine
+  agrees on the assignment regardless of listing order or split percentages.
+
+  Args:
+    sub_dir: Name string of the label subfolder holding the image.
+    base_name: File name string of the image.
+    num_shards: Integer total number of shards.
+
+  Returns:
+    Integer shard index in [0, num_shards).
+  """
+  key = compat.as_bytes(sub_dir + '/' + base_name)
+  return int(hashlib.sha1(key).hexdigest(), 16) % num_shards
+
+
+def get_bottleneck_relative_path(image_lists, label_name, index, category):
+  """Returns a bottleneck file path relative to the bottleneck folder."""
+  return get_bottleneck_path(image_lists, label_name, index, '', category)
+
+
 def cache_bottlenecks(sess, image_lists, image_dir, bottleneck_dir,
-                      jpeg_data_tensor, bottleneck_tensor):
+                      jpeg_data_tensor, bottleneck_tensor, num_shards=1,
+                      shard_index=0):
   """Ensures all the training, testing, and validation bottlenecks are cached.
 
   Because we're likely to read the same image multiple times (if there are no
@@ -460,23 +853,73 @@ def cache_bottlenecks(sess, image_lists, image_dir, bottleneck_dir,
     bottleneck_dir: Folder string holding cached files of bottleneck values.
     jpeg_data_tensor: Input tensor for jpeg data from file.
     bottleneck_tensor: The penultimate output layer of the graph.
+    num_shards: Integer number of shards the extraction is split into.
+    shard_index: Integer index of the shard to cache. Images owned by other
+    shards are skipped.
 
   Returns:
-    Nothing.
+    List of the cached bottleneck paths, relative to bottleneck_dir.
   """
   how_many_bottlenecks = 0
+  cached_paths = []
   ensure_dir_exists(bottleneck_dir)
+  images = []
   for label_name, label_lists in image_lists.items():
     for category in ['training', 'testing', 'validation']:
       category_list = label_lists[category]
-      for index, unused_base_name in enumerate(category_list):
-        get_or_create_bottleneck(sess, image_lists, label_name, index,
-                                 image_dir, category, bottleneck_dir,
-                                 jpeg_data_tensor, bottleneck_tensor)
+      for index, base_name in enumerate(category_list):
+        if (num_shards > 1 and
+            get_shard_index(label_lists['dir'], base_name,
+                            num_shards) != shard_index):
+          continue
+        images.append((label_name, category, index))
+  if any('archive_members' in l for l in image_lists.values()):
+    # Visit archived images in the order they are stored, so extraction
+    # streams through each archive with large sequential reads.
+    def storage_order(image):
+      label_name, category, index = image
+      label_lists = image_lists[label_name]
+      archive_path, member, offset, _ = (
+          label_lists['archive_members'][label_lists[category][index]])
+      return archive_path, -1 if offset is None else offset, member
+    images.sort(key=storage_order)
+  for label_name, category, index in images:
+    get_or_create_bottleneck(sess, image_lists, label_name, index,
+                             image_dir, category, bottleneck_dir,
+                             jpeg_data_tensor, bottleneck_tensor)
+    cached_paths.append(get_bottleneck_relative_path(
+        image_lists, label_name, index, category))
+
+    how_many_bottlenecks += 1
+    if how_many_bottlenecks % 100 == 0:
+      print(str(how_many_bottlenecks) + ' bottleneck files created.')
+  return cached_paths
+
+
+def get_shard_manifest_path(bottleneck_dir, num_shards, shard_index):
+  """Returns where a bottleneck shard records the files it extracted."""
+  return os.path.join(bottleneck_dir, 'shard-%05d-of-%05d.json' %
+                      (shard_index, num_shards))
+
+
+def write_shard_manifest(bottleneck_dir, num_shards, shard_index,
+                         cached_paths):
+  """Records which bottleneck files a shard produced, for the merge step.
 
-        how_many_bottlenecks += 1
-        if how_many_bottlenecks % 100 == 0:
-          print(str(how_many_bottlenecks) + ' bottleneck files created.')
+  Args:
+    bottleneck_dir: Folder string the shard cached its bottlenecks into.
+    num_shards: Integer total number of shards.
+    shard_index: Integer index of this shard.
+    cached_paths: List of bottleneck paths relative to bottleneck_dir.
+  """
+  manifest = {
+      'num_shards': num_shards,
+      'shard_index': shard_index,
+      'files': sorted(cached_paths),
+  }
+  with gfile.GFile(get_shard_manifest_path(bottleneck_dir, num_shards,
+                                           shard_index), 'w') as f:
+    f.write(json.dumps(manifest, indent=1))
 
 
 def get_random_cached_bottlenecks(sess, image_lists, how_many, category,
@@ -545,6 +988,90 @@ def get_random_cached_bottlenecks(sess, image_lists, how_many, category,
   return bottlenecks, ground_truths, filenames
 
 
+def iter_cached_bottleneck_batches(sess, image_lists, batch_size, category,
+                                   bottleneck_dir, image_dir, jpeg_data_tensor,
+                                   bottleneck_tensor):
+  """Yields every cached bottleneck in a category, in fixed-size batches.
+
+  Unlike get_random_cached_bottlenecks with how_many=-1, this never holds more
+  than one batch in memory, so it can be used to evaluate arbitrarily large
+  sets. Images are visited in a deterministic order, label by label.
+
+  Args:
+    sess: Current TensorFlow Session.
+    image_lists: Dictionary of training images for each label.
+    batch_size: Maximum number of bottlenecks to yield at a time.
+    category: Name string of which set to pull from - training, testing, or
+    validation.
+    bottleneck_dir: Folder string holding cached files of bottleneck values.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    jpeg_data_tensor: The layer to feed jpeg image data into.
+    bottleneck_tensor: The bottleneck output layer of the CNN graph.
+
+  Yields:
+    Tuples of (float32 array of bottlenecks, int64 array of ground truth label
+    indices, list of image filenames), each holding at most batch_size rows.
+  """
+  if batch_size <= 0:
+    raise ValueError('batch_size must be positive, got %d' % batch_size)
+  bottlenecks = []
+  label_indices = []
+  filenames = []
+  for label_index, label_name in enumerate(image_lists.keys()):
+    for image_index in range(len(image_lists[label_name][category])):
+      filenames.append(get_image_path(image_lists, label_name, image_index,
+                                      image_dir, category))
+      bottlenecks.append(get_or_create_bottleneck(
+          sess, image_lists, label_name, image_index, image_dir, category,
+          bottleneck_dir, jpeg_data_tensor, bottleneck_tensor))
+      label_indices.append(label_index)
+      if len(bottlenecks) == batch_size:
+        yield (np.array(bottlenecks, dtype=np.float32),
+               np.array(label_indices, dtype=np.int64), filenames)
+        bottlenecks = []
+        label_indices = []
+        filenames = []
+  if bottlenecks:
+    yield (np.array(bottlenecks, dtype=np.float32),
+           np.array(label_indices, dtype=np.int64), filenames)
+
+
+def get_all_cached_bottlenecks(sess, image_lists, category, bottleneck_dir,
+                               image_dir, jpeg_data_tensor, bottleneck_tensor):
+  """Loads every cached bottleneck in a category as one dense matrix.
+
+  This is meant for trainers that keep the whole embedding matrix in memory,
+  so it should only be used when the category comfortably fits in RAM.
+
+  Args:
+    sess: Current TensorFlow Session.
+    image_lists: Dictionary of training images for each label.
+    category: Name string of which set to pull from - training, testing, or
+    validation.
+    bottleneck_dir: Folder string holding cached files of bottleneck values.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    jpeg_data_tensor: The layer to feed jpeg image data into.
+    bottleneck_tensor: The bottleneck output layer of the CNN graph.
+
+  Returns:
+    Float32 array of shape [N, BOTTLENECK_TENSOR_SIZE] and int64 array of the
+    N ground truth label indices.
+  """
+  bottleneck_batches = []
+  label_batches = []
+  for bottlenecks, label_indices, _ in iter_cached_bottleneck_batches(
+      sess, image_lists, 1000, category, bottleneck_dir, image_dir,
+      jpeg_data_tensor, bottleneck_tensor):
+    bottleneck_batches.append(bottlenecks)
+    label_batches.append(label_indices)
+  if not bottleneck_batches:
+    return (np.zeros([0, BOTTLENECK_TENSOR_SIZE], dtype=np.float32),
+            np.zeros([0], dtype=np.int64))
+  return np.concatenate(bottleneck_batches), np.concatenate(label_batches)
+
+
 def get_random_distorted_bottlenecks(
     sess, image_lists, how_many, category, image_dir, input_jpeg_tensor,
     distorted_image, resized_input_tensor, bottleneck_tensor):
@@ -579,11 +1106,8 @@ def get_random_distorted_bottlenecks(
     label_index = random.randrange(class_count)
     label_name = list(image_lists.keys())[label_index]
     image_index = random.randrange(MAX_NUM_IMAGES_PER_CLASS + 1)
-    image_path = get_image_path(image_lists, label_name, image_index, image_dir,
-                                category)
-    if not gfile.Exists(image_path):
-      tf.compat.v1.logging.fatal('File does not exist %s', image_path)
-    jpeg_data = gfile.GFile(image_path, 'rb').read()
+    jpeg_data = read_image_data(image_lists, label_name, image_index,
+                                image_dir, category, use_transcoded=True)
     # Note that we materialize the distorted_image_data as a numpy array before
     # sending running inference on the image. This involves 2 memory copies and
     # might be optimized in other implementations.
@@ -678,29 +1202,29 @@ def add_input_distortions(flip_left_right, random_crop, random_scale,
   margin_scale = 1.0 + (random_crop / 100.0)
   resize_scale = 1.0 + (random_scale / 100.0)
   margin_scale_value = tf.constant(margin_scale)
-  resize_scale_value = tf.random_uniform(tensor_shape.scalar(),
-                                         minval=1.0,
-                                         maxval=resize_scale)
+  resize_scale_value = tf.compat.v1.random_uniform([],
+                                                   minval=1.0,
+                                                   maxval=resize_scale)
   scale_value = tf.multiply(margin_scale_value, resize_scale_value)
   precrop_width = tf.multiply(scale_value, MODEL_INPUT_WIDTH)
   precrop_height = tf.multiply(scale_value, MODEL_INPUT_HEIGHT)
   precrop_shape = tf.stack([precrop_height, precrop_width])
   precrop_shape_as_int = tf.cast(precrop_shape, dtype=tf.int32)
-  precropped_image = tf.image.resize_bilinear(decoded_image_4d,
-                                              precrop_shape_as_int)
-  precropped_image_3d = tf.squeeze(precropped_image, squeeze_dims=[0])
-  cropped_image = tf.random_crop(precropped_image_3d,
-                                 [MODEL_INPUT_HEIGHT, MODEL_INPUT_WIDTH,
-                                  MODEL_INPUT_DEPTH])
+  precropped_image = tf.compat.v1.image.resize_bilinear(decoded_image_4d,
+                                                        precrop_shape_as_int)
+  precropped_image_3d = tf.squeeze(precropped_image, axis=[0])
+  cropped_image = tf.image.random_crop(precropped_image_3d,
+                                       [MODEL_INPUT_HEIGHT, MODEL_INPUT_WIDTH,
+                                        MODEL_INPUT_DEPTH])
   if flip_left_right:
     flipped_image = tf.image.random_flip_left_right(cropped_image)
   else:
     flipped_image = cropped_image
   brightness_min = 1.0 - (random_brightness / 100.0)
   brightness_max = 1.0 + (random_brightness / 100.0)
-  brightness_value = tf.random_uniform(tensor_shape.scalar(),
-                                       minval=brightness_min,
-                                       maxval=brightness_max)
+  brightness_value = tf.compat.v1.random_uniform([],
+                                                 minval=brightness_min,
+                                                 maxval=brightness_max)
   brightened_image = tf.multiply(flipped_image, brightness_value)
   distort_result = tf.expand_dims(brightened_image, 0, name='DistortResult')
   return jpeg_data, distort_result
@@ -806,33 +1330,271 @@ def add_evaluation_step(result_tensor, ground_truth_tensor):
   return evaluation_step, prediction
 
 
+def run_streaming_evaluation(sess, batches, bottleneck_input, result_tensor,
+                             class_count, label_names=None):
+  """Accumulates a confusion matrix over a stream of bottleneck batches.
+
+  Args:
+    sess: Current TensorFlow Session.
+    batches: Iterable of (bottlenecks, label indices, filenames) tuples, as
+    produced by iter_cached_bottleneck_batches.
+    bottleneck_input: The node we feed bottleneck values into.
+    result_tensor: The node producing class probabilities for each row.
+    class_count: Integer number of classes the result tensor scores.
+    label_names: Optional list of label strings. If given, every misclassified
+    image is printed as it is found.
+
+  Returns:
+    Integer array of shape [class_count, class_count] whose rows are ground
+    truth labels and whose columns are predicted labels.
+  """
+  confusion = np.zeros([class_count, class_count], dtype=np.int64)
+  for bottlenecks, label_indices, filenames in batches:
+    results = sess.run(result_tensor, {bottleneck_input: bottlenecks})
+    predictions = np.argmax(results, axis=1)
+    np.add.at(confusion, (label_indices, predictions), 1)
+    if label_names is not None:
+      for i in np.flatnonzero(predictions != label_indices):
+        print('%70s  %s' % (filenames[i], label_names[predictions[i]]))
+  return confusion
+
+
+def precision_recall_from_confusion(confusion):
+  """Computes per-class precision and recall from a confusion matrix.
+
+  Classes that were never predicted (or never seen) get a precision (or recall)
+  of zero rather than a division error.
+
+  Args:
+    confusion: Square array with ground truth rows and predicted columns.
+
+  Returns:
+    Tuple of (precision, recall) float arrays, one entry per class.
+  """
+  true_positives = np.diag(confusion).astype(np.float64)
+  predicted = confusion.sum(axis=0)
+  actual = confusion.sum(axis=1)
+  precision = np.divide(true_positives, predicted,
+                        out=np.zeros_like(true_positives), where=predicted > 0)
+  recall = np.divide(true_positives, actual,
+                     out=np.zeros_like(true_positives), where=actual > 0)
+  return precision, recall
+
+
+def print_evaluation_report(confusion, label_names, title='Accuracy'):
+  """Prints overall accuracy, per-class metrics and the confusion matrix.
+
+  Args:
+    confusion: Square array with ground truth rows and predicted columns.
+    label_names: List of label strings, in class index order.
+    title: Name string printed in front of the overall accuracy.
+  """
+  total = confusion.sum()
+  accuracy = float(np.trace(confusion)) / total if total else 0.0
+  print('%s = %.1f%% (N=%d)' % (title, accuracy * 100, total))
+  precision, recall = precision_recall_from_confusion(confusion)
+  print('%-20s %10s %10s %8s' % ('label', 'precision', 'recall', 'support'))
+  for i, label_name in enumerate(label_names):
+    print('%-20s %9.1f%% %9.1f%% %8d' % (label_name, precision[i] * 100,
+                                         recall[i] * 100, confusion[i].sum()))
+  print('Confusion matrix (rows = ground truth, columns = prediction):')
+  for i, label_name in enumerate(label_names):
+    print('%-20s %s' % (label_name, ' '.join('%6d' % c for c in confusion[i])))
+
+
+def save_retrained_graph(sess, graph, label_names, output_graph,
+                         output_labels, final_tensor_name):
+  """Writes out a trained graph and its labels file.
+
+  The weights are stored as constants, so the graph can be served on its own.
+
+  Args:
+    sess: Session holding the trained variable values.
+    graph: Graph holding the Inception network and the new final layer.
+    label_names: List of label strings, in class index order.
+    output_graph: Path string to write the GraphDef to.
+    output_labels: Path string to write the labels to.
+    final_tensor_name: Name string of the final classification node.
+  """
+  output_graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
+      sess, graph.as_graph_def(), [final_tensor_name])
+  with gfile.GFile(output_graph, 'wb') as f:
+    f.write(output_graph_def.SerializeToString())
+  with gfile.GFile(output_labels, 'w') as f:
+    f.write('\n'.join(label_names) + '\n')
+
+
+def export_final_layer(model_dir, layer_weights, layer_biases, label_names,
+                       output_graph, output_labels,
+                       final_tensor_name='final_result'):
+  """Exports final layer weights trained outside of main() as a full graph.
+
+  The result has the same interface as the graph written by main(): the
+  Inception input and bottleneck tensors, the bottleneck input placeholder and
+  a softmax named final_tensor_name.
+
+  Args:
+    model_dir: Folder string holding classify_image_graph_def.pb.
+    layer_weights: Array of shape [BOTTLENECK_TENSOR_SIZE, class_count].
+    layer_biases: Array of shape [class_count].
+    label_names: List of label strings, in class index order.
+    output_graph: Path string to write the GraphDef to.
+    output_labels: Path string to write the labels to.
+    final_tensor_name: Name string for the final classification node.
+  """
+  graph, bottleneck_tensor, _, _ = create_inception_graph(model_dir)
+  with graph.as_default():
+    with tf.compat.v1.name_scope('input'):
+      bottleneck_input = tf.compat.v1.placeholder_with_default(
+          bottleneck_tensor, shape=[None, BOTTLENECK_TENSOR_SIZE],
+          name='BottleneckInputPlaceholder')
+    with tf.compat.v1.name_scope('final_training_ops'):
+      with tf.compat.v1.name_scope('weights'):
+        weights = tf.compat.v1.Variable(
+            np.asarray(layer_weights, dtype=np.float32), name='final_weights')
+      with tf.compat.v1.name_scope('biases'):
+        biases = tf.compat.v1.Variable(
+            np.asarray(layer_biases, dtype=np.float32), name='final_biases')
+      with tf.compat.v1.name_scope('Wx_plus_b'):
+        logits = tf.matmul(bottleneck_input, weights) + biases
+    tf.nn.softmax(logits, name=final_tensor_name)
+    with tf.compat.v1.Session(graph=graph) as sess:
+      sess.run(tf.compat.v1.global_variables_initializer())
+      save_retrained_graph(sess, graph, label_names, output_graph,
+                           output_labels, final_tensor_name)
+
+
+def format_step_timings(step_timings, steps):
+  """Formats the average time per training step spent in each loop phase.
+
+  Args:
+    step_timings: Dictionary of phase name to total seconds spent in it.
+    steps: Integer number of steps the timings cover.
+
+  Returns:
+    A string like 'fetch 3.1ms, feed 0.4ms, run 1.2ms, summary 0.0ms'.
+  """
+  return ', '.join('%s %.1fms' % (name, seconds / steps * 1000)
+                   for name, seconds in step_timings.items())
+
+
+def get_final_layer_variables():
+  """Returns the variables of the new final layer, in a stable order."""
+  return tf.compat.v1.get_collection(
+      tf.compat.v1.GraphKeys.GLOBAL_VARIABLES, scope='final_training_ops')
+
+
+def save_training_state(checkpoint_dir, state):
+  """Writes the training loop bookkeeping next to the checkpoints.
+
+  Args:
+    checkpoint_dir: Folder string holding the final layer checkpoints.
+    state: Dictionary of JSON-serializable training loop values.
+  """
+  state_path = os.path.join(checkpoint_dir, 'training_state.json')
+  with gfile.GFile(state_path + '.tmp', 'w') as f:
+    f.write(json.dumps(state))
+  gfile.Rename(state_path + '.tmp', state_path, overwrite=True)
+
+
+def load_training_state(checkpoint_dir):
+  """Reads the training loop bookkeeping saved by save_training_state.
+
+  Args:
+    checkpoint_dir: Folder string holding the final layer checkpoints.
+
+  Returns:
+    Dictionary of training loop values, or None if nothing was saved.
+  """
+  state_path = os.path.join(checkpoint_dir, 'training_state.json')
+  if not gfile.Exists(state_path):
+    return None
+  with gfile.GFile(state_path, 'r') as f:
+    return json.loads(f.read())
+
+
 def main(_):
-  # Setup the directory we'll write summaries to for TensorBoard
-  if tf.io.gfile.exists(FLAGS.summaries_dir):
+  # Setup the directory we'll write summaries to for TensorBoard. When resuming
+  # we keep the earlier summaries so the curves continue where they left off,
+  # and shard extraction runs, which don't train, leave them alone. The same
+  # goes for the checkpoints, so a fresh run never picks up an old one.
+  resuming = bool(FLAGS.resume and FLAGS.checkpoint_dir and
+                  tf.train.latest_checkpoint(FLAGS.checkpoint_dir))
+  if (tf.io.gfile.exists(FLAGS.summaries_dir) and not resuming and
+      FLAGS.num_shards == 1):
     tf.io.gfile.rmtree(FLAGS.summaries_dir)
   tf.io.gfile.makedirs(FLAGS.summaries_dir)
+  if (FLAGS.checkpoint_dir and tf.io.gfile.exists(FLAGS.checkpoint_dir) and
+      not resuming and FLAGS.num_shards == 1):
+    tf.io.gfile.rmtree(FLAGS.checkpoint_dir)
 
   # Set up the pre-trained graph.
   maybe_download_and_extract()
   graph, bottleneck_tensor, jpeg_data_tensor, resized_image_tensor = (
       create_inception_graph())
 
-  # Look at the folder structure, and create lists of all the images.
-  image_lists = create_image_lists(FLAGS.image_dir, FLAGS.testing_percentage,
-                                   FLAGS.validation_percentage)
+  # Look at the folder structure (or the archive shards), and create lists of
+  # all the images.
+  image_lists = load_image_lists(FLAGS.image_dir, FLAGS.image_archives,
+                                 FLAGS.testing_percentage,
+                                 FLAGS.validation_percentage)
+  image_source = FLAGS.image_archives or FLAGS.image_dir
   class_count = len(image_lists.keys())
   if class_count == 0:
-    print('No valid folders of images found at ' + FLAGS.image_dir)
+    print('No valid folders of images found at ' + image_source)
     return -1
   if class_count == 1:
-    print('Only one valid folder of images found at ' + FLAGS.image_dir +
+    print('Only one valid folder of images found at ' + image_source +
           ' - multiple classes are needed for classification.')
     return -1
 
+  # In a sharded extraction this process only caches its own slice of the
+  # bottlenecks. Training waits until merge_bottlenecks.py has combined them.
+  if FLAGS.num_shards > 1:
+    if not 0 <= FLAGS.shard_index < FLAGS.num_shards:
+      print('--shard_index must be in [0, %d)' % FLAGS.num_shards)
+      return -1
+    with tf.compat.v1.Session(graph=graph) as sess:
+      cached_paths = cache_bottlenecks(
+          sess, image_lists, FLAGS.image_dir, FLAGS.bottleneck_dir,
+          jpeg_data_tensor, bottleneck_tensor, FLAGS.num_shards,
+          FLAGS.shard_index)
+    write_shard_manifest(FLAGS.bottleneck_dir, FLAGS.num_shards,
+                         FLAGS.shard_index, cached_paths)
+    print('Cached %d bottlenecks for shard %d of %d in %s' %
+          (len(cached_paths), FLAGS.shard_index, FLAGS.num_shards,
+           FLAGS.bottleneck_dir))
+    return 0
+
+  if FLAGS.exclude_file:
+    removed = exclude_images(image_lists, FLAGS.exclude_file)
+    print('Excluded %d images listed in %s' % (removed, FLAGS.exclude_file))
+
+  # The checkpoints only fit a final layer with the same classes, so refuse to
+  # resume one trained on a different set of labels.
+  label_names = list(image_lists.keys())
+  if resuming:
+    saved_state = load_training_state(FLAGS.checkpoint_dir) or {}
+    saved_labels = saved_state.get('labels')
+    if saved_labels is not None and (
+        saved_state.get('class_count') != len(label_names) or
+        saved_labels != label_names):
+      print('Cannot resume from %s: it was trained on %d classes (%s), but '
+            '%s has %d (%s). Run without --resume to start over.' %
+            (FLAGS.checkpoint_dir, len(saved_labels), ', '.join(saved_labels),
+             image_source, len(label_names), ', '.join(label_names)))
+      return -1
+
   # See if the command-line flags mean we're applying any distortions.
   do_distort_images = should_distort_images(
       FLAGS.flip_left_right, FLAGS.random_crop, FLAGS.random_scale,
       FLAGS.random_brightness)
+  if do_distort_images and FLAGS.transcode_dir:
+    attached = attach_transcoded_images(
+        image_lists, FLAGS.image_dir, FLAGS.transcode_dir, FLAGS.random_crop,
+        FLAGS.random_scale)
+    print('Reading %d images from the transcode cache in %s' %
+          (attached, FLAGS.transcode_dir))
 
   with tf.compat.v1.Session(graph=graph) as sess:
 
@@ -859,20 +1621,57 @@ def main(_):
     evaluation_step, prediction = add_evaluation_step(
         final_tensor, ground_truth_input)
 
-    # Merge all the summaries and write them out to the summaries_dir
+    # Merge all the summaries and write them out to the summaries_dir. The
+    # writers queue events and write them from a background thread, so a
+    # summary write only costs the training loop an enqueue.
     merged = tf.compat.v1.summary.merge_all()
     train_writer = tf.compat.v1.summary.FileWriter(FLAGS.summaries_dir + '/train',
-                                         sess.graph)
+                                         sess.graph, max_queue=100)
 
     validation_writer = tf.compat.v1.summary.FileWriter(
-        FLAGS.summaries_dir + '/validation')
+        FLAGS.summaries_dir + '/validation', max_queue=100)
 
     # Set up all our weights to their initial default values.
     init = tf.compat.v1.global_variables_initializer()
     sess.run(init)
 
+    # Only the final layer is trained, so that is all we need to checkpoint.
+    # The best weights seen on validation are kept in memory, and on disk under
+    # best/ so they survive a restart.
+    final_layer_variables = get_final_layer_variables()
+    state = {'step': -1, 'best_validation_accuracy': -1.0, 'best_step': -1,
+             'evals_without_improvement': 0, 'class_count': len(label_names),
+             'labels': label_names}
+    best_values = None
+    if FLAGS.checkpoint_dir:
+      best_dir = os.path.join(FLAGS.checkpoint_dir, 'best')
+      ensure_dir_exists(best_dir)
+      saver = tf.compat.v1.train.Saver(final_layer_variables, max_to_keep=3)
+      best_saver = tf.compat.v1.train.Saver(final_layer_variables,
+                                            max_to_keep=1)
+      if resuming:
+        best_checkpoint = tf.train.latest_checkpoint(best_dir)
+        if best_checkpoint:
+          best_saver.restore(sess, best_checkpoint)
+          best_values = sess.run(final_layer_variables)
+        latest_checkpoint = tf.train.latest_checkpoint(FLAGS.checkpoint_dir)
+        saver.restore(sess, latest_checkpoint)
+        state.update(load_training_state(FLAGS.checkpoint_dir) or {})
+        print('Resuming from %s after step %d' % (latest_checkpoint,
+                                                   state['step']))
+
+    # Time spent in each phase of the loop, reset at every evaluation. A run
+    # dominated by fetch is I/O-bound; one dominated by run is compute-bound.
+    step_timings = {'fetch': 0.0, 'feed': 0.0, 'run': 0.0, 'summary': 0.0}
+    timed_steps = 0
+    timed_examples = 0
+    total_training_time = 0.0
+    total_examples = 0
+
     # Run the training for as many cycles as requested on the command line.
-    for i in range(FLAGS.how_many_training_steps):
+    for i in range(state['step'] + 1, FLAGS.how_many_training_steps):
+      is_last_step = (i + 1 == FLAGS.how_many_training_steps)
+      fetch_start = time.time()
       # Get a batch of input bottleneck values, either calculated fresh every
       # time with distortions applied, or from the cache stored on disk.
       if do_distort_images:
@@ -887,26 +1686,50 @@ def main(_):
              sess, image_lists, FLAGS.train_batch_size, 'training',
              FLAGS.bottleneck_dir, FLAGS.image_dir, jpeg_data_tensor,
              bottleneck_tensor)
+      feed_start = time.time()
+      train_feed_dict = {
+          bottleneck_input: np.asarray(train_bottlenecks, dtype=np.float32),
+          ground_truth_input: np.asarray(train_ground_truth, dtype=np.float32)}
       # Feed the bottlenecks and ground truth into the graph, and run a training
-      # step. Capture training summaries for TensorBoard with the `merged` op.
-
-      train_summary, _ = sess.run(
-          [merged, train_step],
-          feed_dict={bottleneck_input: train_bottlenecks,
-                     ground_truth_input: train_ground_truth})
-      train_writer.add_summary(train_summary, i)
+      # step. Every --summary_interval steps, also capture training summaries
+      # for TensorBoard with the `merged` op, which is far from free. It runs
+      # on its own so its cost shows up under summary rather than run.
+      run_start = time.time()
+      sess.run(train_step, feed_dict=train_feed_dict)
+      summary_start = time.time()
+      if (i % FLAGS.summary_interval) == 0 or is_last_step:
+        train_summary = sess.run(merged, feed_dict=train_feed_dict)
+        train_writer.add_summary(train_summary, i)
+      step_end = time.time()
+
+      step_timings['fetch'] += feed_start - fetch_start
+      step_timings['feed'] += run_start - feed_start
+      step_timings['run'] += summary_start - run_start
+      step_timings['summary'] += step_end - summary_start
+      timed_steps += 1
+      timed_examples += len(train_bottlenecks)
+      total_training_time += step_end - fetch_start
+      total_examples += len(train_bottlenecks)
 
       # Every so often, print out how well the graph is training.
-      is_last_step = (i + 1 == FLAGS.how_many_training_steps)
       if (i % FLAGS.eval_step_interval) == 0 or is_last_step:
         train_accuracy, cross_entropy_value = sess.run(
-            [evaluation_step, cross_entropy],
-            feed_dict={bottleneck_input: train_bottlenecks,
-                       ground_truth_input: train_ground_truth})
+            [evaluation_step, cross_entropy], feed_dict=train_feed_dict)
         print('%s: Step %d: Train accuracy = %.1f%%' % (datetime.now(), i,
                                                         train_accuracy * 100))
         print('%s: Step %d: Cross entropy = %f' % (datetime.now(), i,
                                                    cross_entropy_value))
+        examples_per_sec = (timed_examples /
+                            max(sum(step_timings.values()), 1e-9))
+        print('%s: Step %d: %.1f examples/sec, per step: %s' % (
+            datetime.now(), i, examples_per_sec,
+            format_step_timings(step_timings, timed_steps)))
+        train_writer.add_summary(tf.compat.v1.Summary(value=[
+            tf.compat.v1.Summary.Value(tag='examples_per_sec',
+                                       simple_value=examples_per_sec)]), i)
+        step_timings = dict.fromkeys(step_timings, 0.0)
+        timed_steps = 0
+        timed_examples = 0
         validation_bottlenecks, validation_ground_truth, _ = (
             get_random_cached_bottlenecks(
                 sess, image_lists, FLAGS.validation_batch_size, 'validation',
@@ -923,35 +1746,92 @@ def main(_):
               (datetime.now(), i, validation_accuracy * 100,
                len(validation_bottlenecks)))
 
+        # Track the best weights so far, and count how many evaluations in a
+        # row have failed to improve on them.
+        if (validation_accuracy > state['best_validation_accuracy'] +
+            FLAGS.early_stopping_min_delta):
+          state['best_validation_accuracy'] = float(validation_accuracy)
+          state['best_step'] = i
+          state['evals_without_improvement'] = 0
+          best_values = sess.run(final_layer_variables)
+          if FLAGS.checkpoint_dir:
+            best_saver.save(sess, os.path.join(best_dir, 'model.ckpt'),
+                            global_step=i)
+        else:
+          state['evals_without_improvement'] += 1
+
+      should_stop = (FLAGS.early_stopping_patience > 0 and
+                     state['evals_without_improvement'] >=
+                     FLAGS.early_stopping_patience)
+      if FLAGS.checkpoint_dir and (
+          (i + 1) % FLAGS.checkpoint_interval == 0 or is_last_step or
+          should_stop):
+        state['step'] = i
+        saver.save(sess, os.path.join(FLAGS.checkpoint_dir, 'model.ckpt'),
+                   global_step=i)
+        save_training_state(FLAGS.checkpoint_dir, state)
+      if should_stop:
+        print('%s: Step %d: Validation accuracy has not improved for %d '
+              'evaluations, stopping early' % (datetime.now(), i,
+                                               FLAGS.early_stopping_patience))
+        break
+
+    train_writer.close()
+    validation_writer.close()
+    if total_examples:
+      print('Trained on %d examples in %.1fs (%.1f examples/sec)' %
+            (total_examples, total_training_time,
+             total_examples / max(total_training_time, 1e-9)))
+
+    # With early stopping, export the best weights rather than the last ones.
+    if FLAGS.early_stopping_patience > 0 and best_values is not None:
+      print('Restoring best weights from step %d (validation accuracy = '
+            '%.1f%%)' % (state['best_step'],
+                         state['best_validation_accuracy'] * 100))
+      for variable, value in zip(final_layer_variables, best_values):
+        variable.load(value, sess)
+
     # We've completed all our training, so run a final test evaluation on
     # some new images we haven't used before.
-    test_bottlenecks, test_ground_truth, test_filenames = (
-        get_random_cached_bottlenecks(sess, image_lists, FLAGS.test_batch_size,
-                                      'testing', FLAGS.bottleneck_dir,
-                                      FLAGS.image_dir, jpeg_data_tensor,
-                                      bottleneck_tensor))
-    test_accuracy, predictions = sess.run(
-        [evaluation_step, prediction],
-        feed_dict={bottleneck_input: test_bottlenecks,
-                   ground_truth_input: test_ground_truth})
-    print('Final test accuracy = %.1f%% (N=%d)' % (
-        test_accuracy * 100, len(test_bottlenecks)))
-
-    if FLAGS.print_misclassified_test_images:
-      print('=== MISCLASSIFIED TEST IMAGES ===')
-      for i, test_filename in enumerate(test_filenames):
-        if predictions[i] != test_ground_truth[i].argmax():
-          print('%70s  %s' % (test_filename,
-                              list(image_lists.keys())[predictions[i]]))
+    if FLAGS.test_batch_size < 0:
+      # Evaluate the whole test set in fixed-size batches, so memory use stays
+      # bounded however large the set is.
+      if FLAGS.print_misclassified_test_images:
+        print('=== MISCLASSIFIED TEST IMAGES ===')
+      confusion = run_streaming_evaluation(
+          sess,
+          iter_cached_bottleneck_batches(
+              sess, image_lists, FLAGS.eval_batch_size, 'testing',
+              FLAGS.bottleneck_dir, FLAGS.image_dir, jpeg_data_tensor,
+              bottleneck_tensor),
+          bottleneck_input, final_tensor, class_count,
+          label_names if FLAGS.print_misclassified_test_images else None)
+      print_evaluation_report(confusion, label_names, 'Final test accuracy')
+    else:
+      test_bottlenecks, test_ground_truth, test_filenames = (
+          get_random_cached_bottlenecks(sess, image_lists,
+                                        FLAGS.test_batch_size, 'testing',
+                                        FLAGS.bottleneck_dir, FLAGS.image_dir,
+                                        jpeg_data_tensor, bottleneck_tensor))
+      test_accuracy, predictions = sess.run(
+          [evaluation_step, prediction],
+          feed_dict={bottleneck_input: test_bottlenecks,
+                     ground_truth_input: test_ground_truth})
+      print('Final test accuracy = %.1f%% (N=%d)' % (
+          test_accuracy * 100, len(test_bottlenecks)))
+
+      if FLAGS.print_misclassified_test_images:
+        print('=== MISCLASSIFIED TEST IMAGES ===')
+        for i, test_filename in enumerate(test_filenames):
+          if predictions[i] != test_ground_truth[i].argmax():
+            print('%70s  %s' % (test_filename,
+                                list(image_lists.keys())[predictions[i]]))
 
     # Write out the trained graph and labels with the weights stored as
     # constants.
-    output_graph_def = tf.compat.v1.graph_util.convert_variables_to_constants(
-        sess, graph.as_graph_def(), [FLAGS.final_tensor_name])
-    with gfile.GFile(FLAGS.output_graph, 'wb') as f:
-      f.write(output_graph_def.SerializeToString())
-    with gfile.GFile(FLAGS.output_labels, 'w') as f:
-      f.write('\n'.join(image_lists.keys()) + '\n')
+    save_retrained_graph(sess, graph, list(image_lists.keys()),
+                         FLAGS.output_graph, FLAGS.output_labels,
+                         FLAGS.final_tensor_name)
 
 
 if __name__ == '__main__':
@@ -962,6 +1842,36 @@ if __name__ == '__main__':
       default='',
       help='Path to folders of labeled images.'
   )
+  parser.add_argument(
+      '--image_archives',
+      type=str,
+      default='',
+      help="""\
+      Glob pattern of tar or zip shards to read the labeled images from,
+      instead of --image_dir. Each image's label is the folder it is stored
+      under in the archive, unless a <archive>.index.csv sidecar lists
+      'member,label[,offset,size]' rows. Uncompressed .tar shards are read
+      fastest.\
+      """
+  )
+  parser.add_argument(
+      '--exclude_file',
+      type=str,
+      default='',
+      help="""\
+      File listing '<label folder>/<file name>' images to leave out of every
+      split, such as the near-duplicates written by dedup.py.\
+      """
+  )
+  parser.add_argument(
+      '--transcode_dir',
+      type=str,
+      default='',
+      help="""\
+      Folder written by transcode.py. When training with distortions, images
+      are read from its reduced-resolution copies instead of the originals.\
+      """
+  )
   parser.add_argument(
       '--output_graph',
       type=str,
@@ -1010,6 +1920,15 @@ if __name__ == '__main__':
       default=10,
       help='How often to evaluate the training results.'
   )
+  parser.add_argument(
+      '--summary_interval',
+      type=int,
+      default=10,
+      help="""\
+      How often to compute and write training summaries for TensorBoard.
+      Computing them every step noticeably slows down training.\
+      """
+  )
   parser.add_argument(
       '--train_batch_size',
       type=int,
@@ -1024,7 +1943,17 @@ if __name__ == '__main__':
       How many images to test on. This test set is only used once, to evaluate
       the final accuracy of the model after training completes.
       A value of -1 causes the entire test set to be used, which leads to more
-      stable results across runs.\
+      stable results across runs. The full set is streamed through the graph in
+      batches of --eval_batch_size.\
+      """
+  )
+  parser.add_argument(
+      '--eval_batch_size',
+      type=int,
+      default=1000,
+      help="""\
+      How many images to feed at a time when evaluating an entire set, which
+      bounds the memory used by the final test evaluation.\
       """
   )
   parser.add_argument(
@@ -1040,6 +1969,51 @@ if __name__ == '__main__':
       training sets.\
       """
   )
+  parser.add_argument(
+      '--checkpoint_dir',
+      type=str,
+      default='/tmp/retrain_checkpoints',
+      help="""\
+      Where to save checkpoints of the final layer. Its contents are deleted
+      unless --resume is given. An empty string disables checkpointing.\
+      """
+  )
+  parser.add_argument(
+      '--checkpoint_interval',
+      type=int,
+      default=100,
+      help='How many training steps to run between checkpoints.'
+  )
+  parser.add_argument(
+      '--resume',
+      default=False,
+      help="""\
+      Whether to continue training from the latest checkpoint in
+      --checkpoint_dir instead of starting from scratch. The images must have
+      the same labels the checkpoint was trained on.\
+      """,
+      action='store_true'
+  )
+  parser.add_argument(
+      '--early_stopping_patience',
+      type=int,
+      default=0,
+      help="""\
+      Stop training once validation accuracy has not improved for this many
+      evaluations in a row, and export the best weights seen. A value of 0
+      disables early stopping. Using --validation_batch_size=-1 makes the
+      plateau far less noisy.\
+      """
+  )
+  parser.add_argument(
+      '--early_stopping_min_delta',
+      type=float,
+      default=0.0,
+      help="""\
+      The smallest increase in validation accuracy that counts as an
+      improvement for early stopping.\
+      """
+  )
   parser.add_argument(
       '--print_misclassified_test_images',
       default=False,
@@ -1064,6 +2038,23 @@ if __name__ == '__main__':
       default='/tmp/bottleneck',
       help='Path to cache bottleneck layer values as files.'
   )
+  parser.add_argument(
+      '--num_shards',
+      type=int,
+      default=1,
+      help="""\
+      Split bottleneck extraction into this many disjoint, deterministic shards.
+      With more than one shard, this run only caches the bottlenecks of
+      --shard_index and skips training; combine the shards with
+      merge_bottlenecks.py and then train as usual.\
+      """
+  )
+  parser.add_argument(
+      '--shard_index',
+      type=int,
+      default=0,
+      help='Which shard of the bottleneck extraction this run computes.'
+  )
   parser.add_argument(
       '--final_tensor_name',
       type=str,
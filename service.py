@@ -4,17 +4,19 @@ Designed for continuous monitoring with camera.
 """
 import logging
 import time
-import base64
+import json
 import requests
-from typing import Optional
+from typing import Any, Dict, Optional
+from camera import open_camera
 from config import Config
+from pipeline import CapturePipeline
+from upload_queue import UploadQueue
 
 try:
-    import picamera
-    PICAMERA_AVAILABLE = True
+    from image_utils import reduce_image
 except ImportError:
-    PICAMERA_AVAILABLE = False
-    logging.warning("picamera not available. Camera functionality disabled.")
+    reduce_image = None
+    logging.warning("Pillow not available. Images are uploaded as captured.")
 
 logger = logging.getLogger(__name__)
 
@@ -26,111 +28,539 @@ class CameraService:
         self,
         ml_service_url: Optional[str] = None,
         image_path: str = "temp.png",
-        capture_interval: int = 60
+        capture_interval: int = 60,
+        inference_mode: Optional[str] = None,
+        confidence_threshold: Optional[float] = None,
+        edge_classifier: Optional[Any] = None,
+        upload_queue: Optional[UploadQueue] = None,
+        camera: Optional[Any] = None,
+        change_threshold: Optional[float] = None,
+        camera_id: Optional[str] = None,
+        session: Optional[requests.Session] = None
     ):
         """
         Initialize camera service.
         
         Args:
             ml_service_url: URL of the ML service endpoint
-            image_path: Path to save captured images
+            image_path: Default image file for send_image
             capture_interval: Interval between captures in seconds
+            inference_mode: 'remote' to upload every image, or 'local' to
+                classify on the device and upload only the result
+            confidence_threshold: In local mode, the image is uploaded too
+                when the on-device confidence is below this
+            edge_classifier: Optional classifier to use in local mode
+                (defaults to an EdgeClassifier on the configured model)
+            upload_queue: Optional spool for uploads (defaults to one at
+                Config.UPLOAD_QUEUE_PATH, if set)
+            camera: Optional camera backend, kept across capture errors
+                (defaults to the one named by Config.CAMERA_BACKEND, opened
+                on first capture and again after an error)
+            change_threshold: Fraction of a frame that must change for it to
+                be uploaded, 0 to upload every frame
+            camera_id: Id sent with every upload, to tell cameras apart
+                (defaults to Config.CAMERA_ID)
+            session: Optional HTTP session to share with other services
         """
         self.ml_service_url = ml_service_url or Config.ML_SERVICE_URL
         self.image_path = image_path
         self.capture_interval = capture_interval
-        self.camera_available = PICAMERA_AVAILABLE
+        self.camera = camera
+        self._owns_camera = camera is None
+        self.inference_mode = inference_mode or Config.INFERENCE_MODE
+        self.confidence_threshold = (
+            Config.EDGE_CONFIDENCE_THRESHOLD if confidence_threshold is None
+            else confidence_threshold
+        )
+        self.edge_classifier = edge_classifier
+        if self.inference_mode == 'local' and self.edge_classifier is None:
+            self.edge_classifier = self._load_edge_classifier()
         
-    def capture_image(self) -> bool:
+        self.camera_id = camera_id or Config.CAMERA_ID
+        # One keep-alive session, so uploads reuse the TCP/TLS connection
+        self.session = session or requests.Session()
+        self.upload_queue = upload_queue
+        if self.upload_queue is None and Config.UPLOAD_QUEUE_PATH:
+            self.upload_queue = UploadQueue(
+                Config.UPLOAD_QUEUE_PATH,
+                max_bytes=Config.UPLOAD_QUEUE_MAX_MB * 1024 * 1024,
+                retry_base=Config.UPLOAD_RETRY_BASE,
+                retry_max=Config.UPLOAD_RETRY_MAX
+            )
+        self.upload_batch_size = Config.UPLOAD_BATCH_SIZE
+        self.upload_image_size = Config.UPLOAD_IMAGE_SIZE
+        self.upload_jpeg_quality = Config.UPLOAD_JPEG_QUALITY
+        self._link_failures = 0
+        self._link_retry_at = 0.0
+        
+        if change_threshold is None:
+            change_threshold = Config.FRAME_CHANGE_THRESHOLD
+        self.change_detector = (
+            self._load_change_detector(change_threshold) if change_threshold > 0
+            else None
+        )
+        self.keepalive_interval = Config.KEEPALIVE_INTERVAL
+        self._last_sent = time.monotonic()
+        self.stats = {
+            "frames": 0,
+            "uploaded": 0,
+            "skipped": 0,
+            "keepalives": 0,
+            "bytes_uploaded": 0,
+            "bytes_skipped": 0
+        }
+
+    def _load_edge_classifier(self) -> Optional[Any]:
+        """Load the on-device model, or return None to fall back to uploads."""
+        try:
+            from edge_classifier import EdgeClassifier
+            return EdgeClassifier()
+        except Exception as e:
+            logger.error(f"On-device model unavailable, uploading images instead: {e}")
+            return None
+        
+    def _load_change_detector(self, threshold: float) -> Optional[Any]:
+        """Create the frame change detector, or return None to upload every frame."""
+        try:
+            from frame_change import FrameChangeDetector
+            return FrameChangeDetector(threshold)
+        except Exception as e:
+            logger.error(f"Frame change detection unavailable, uploading every frame: {e}")
+            return None
+        
+    def capture_image(self) -> Optional[bytes]:
         """
         Capture an image using the camera.
         
+        The camera stays open between captures, and the image is kept in
+        memory rather than written to disk.
+        
         Returns:
-            bool: True if capture successful, False otherwise
+            JPEG bytes, or None if capture failed
         """
-        if not self.camera_available:
-            logger.error("Camera not available")
-            return False
-        
         try:
-            with picamera.PiCamera() as camera:
-                logger.info("Opening camera...")
-                time.sleep(2)  # Allow camera to initialize
-                camera.capture(self.image_path)
-                logger.info(f"Image captured: {self.image_path}")
-                return True
+            if self.camera is None:
+                self.camera = open_camera()
+            image_data = self.camera.capture()
+            logger.info(f"Image captured ({len(image_data)} bytes)")
+            return image_data
         except Exception as e:
             logger.error(f"Failed to capture image: {e}")
-            return False
+            self.close_camera()
+            return None
+    
+    def close_camera(self) -> None:
+        """
+        Release the camera; the next capture opens it again.
+        
+        A camera the service opened itself is dropped and opened anew from
+        Config.CAMERA_BACKEND. One passed in is kept, since that config may
+        not describe it, and reopens itself on its next capture.
+        """
+        if self.camera is not None:
+            try:
+                self.camera.close()
+            except Exception as e:
+                logger.error(f"Failed to close camera: {e}")
+            if self._owns_camera:
+                self.camera = None
+    
+    def _post(self, endpoint: str, body: bytes, content_type: str) -> Optional[dict]:
+        """
+        POST a body to the ML service over the shared session.
+        
+        Raises:
+            requests.exceptions.RequestException: If the upload fails
+        """
+        headers = {"Content-Type": content_type}
+        if self.camera_id:
+            headers["X-Camera-Id"] = self.camera_id
+        response = self.session.post(
+            f"{self.ml_service_url}{endpoint}",
+            data=body,
+            headers=headers,
+            timeout=30
+        )
+        response.raise_for_status()
+        try:
+            return response.json()
+        except ValueError:
+            return None
+    
+    @staticmethod
+    def _is_rejected(error: requests.exceptions.HTTPError) -> bool:
+        """Whether the server refused an upload in a way retrying won't fix."""
+        status = error.response.status_code
+        return 400 <= status < 500 and status not in (408, 429)
+    
+    def _link_down(self, error: Exception) -> None:
+        """Back off from the ML service after a connection failure."""
+        self._link_failures += 1
+        delay = min(self.upload_queue.retry_max,
+                    self.upload_queue.retry_base * 2 ** (self._link_failures - 1))
+        self._link_retry_at = time.monotonic() + delay
+        logger.error(f"Failed to reach ML service, {len(self.upload_queue)} "
+                     f"uploads spooled, retrying in {delay:.0f}s: {error}")
+    
+    def _submit(self, endpoint: str, body: bytes, content_type: str) -> Optional[dict]:
+        """
+        Send an upload, spooling it to disk only if it cannot be delivered.
+        
+        After a successful send, pending uploads are drained too.
+        
+        Returns:
+            Response data for this upload, or None if it was not delivered
+        """
+        if self.upload_queue is None:
+            try:
+                return self._post(endpoint, body, content_type)
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Failed to send to ML service: {e}")
+                return None
+        
+        if time.monotonic() >= self._link_retry_at:
+            try:
+                response_data = self._post(endpoint, body, content_type)
+            except requests.exceptions.HTTPError as e:
+                if self._is_rejected(e):
+                    logger.error(f"Upload rejected ({e.response.status_code}), dropped")
+                    return None
+                logger.warning(f"Upload failed ({e.response.status_code}), spooling")
+            except requests.exceptions.RequestException as e:
+                self.upload_queue.put(endpoint, body, content_type)
+                self._link_down(e)
+                return None
+            else:
+                self._link_failures = 0
+                if len(self.upload_queue):
+                    self.drain_uploads()
+                return response_data
+        
+        self.upload_queue.put(endpoint, body, content_type)
+        return None
+    
+    def drain_uploads(self) -> Dict[int, Optional[dict]]:
+        """
+        Send pending uploads, oldest first, in batches.
+        
+        Stops at the first connection failure and waits out an exponential
+        backoff before trying the link again. Uploads the server fails on
+        are retried with their own backoff; uploads it rejects as invalid
+        are dropped.
+        
+        Returns:
+            Dictionary mapping the ids of delivered uploads to their responses
+        """
+        responses = {}
+        if self.upload_queue is None or time.monotonic() < self._link_retry_at:
+            return responses
+        
+        while True:
+            batch = self.upload_queue.due(self.upload_batch_size)
+            if not batch:
+                break
+            for upload_id, endpoint, content_type, body in batch:
+                try:
+                    responses[upload_id] = self._post(endpoint, body, content_type)
+                except requests.exceptions.HTTPError as e:
+                    if self._is_rejected(e):
+                        logger.error(f"Upload {upload_id} rejected "
+                                     f"({e.response.status_code}), dropped")
+                        self.upload_queue.remove(upload_id)
+                    else:
+                        delay = self.upload_queue.retry_later(upload_id)
+                        logger.warning(f"Upload {upload_id} failed "
+                                       f"({e.response.status_code}), "
+                                       f"retrying in {delay:.0f}s")
+                    continue
+                except requests.exceptions.RequestException as e:
+                    self._link_down(e)
+                    return responses
+                self.upload_queue.remove(upload_id)
+            self._link_failures = 0
+        
+        if responses:
+            logger.info(f"Delivered {len(responses)} spooled uploads, "
+                        f"{len(self.upload_queue)} pending")
+        return responses
     
     def send_image(self, image_path: Optional[str] = None) -> Optional[dict]:
         """
-        Send image to ML service for classification.
+        Send an image file to ML service for classification.
         
         Args:
             image_path: Path to image file (defaults to self.image_path)
             
         Returns:
-            Response data from ML service or None if failed
+            Response data from ML service, or None if failed or spooled
         """
         path = image_path or self.image_path
         
         try:
-            # Read image file
             with open(path, "rb") as image_file:
-                image_bytes = base64.b64encode(image_file.read())
-            
-            logger.info(f"Sending image to ML service: {self.ml_service_url}")
+                image_data = image_file.read()
+        except FileNotFoundError:
+            logger.error(f"Image file not found: {path}")
+            return None
+        return self.send_image_data(image_data)
+    
+    def prepare_upload(self, image_data: bytes) -> tuple[bytes, str]:
+        """
+        Downscale an image to near the model's resolution for upload.
+        
+        Args:
+            image_data: Encoded image bytes
             
-            # Send to ML service
-            response = requests.post(
-                f"{self.ml_service_url}/detect",
-                data=image_bytes,
-                timeout=30
-            )
+        Returns:
+            Tuple of (body, Content-Type); the image as captured if it
+            cannot be re-encoded
+        """
+        if reduce_image is not None:
+            try:
+                return (reduce_image(image_data, self.upload_image_size,
+                                     self.upload_jpeg_quality), "image/jpeg")
+            except Exception as e:
+                logger.error(f"Failed to downscale image, uploading as captured: {e}")
+        return image_data, "application/octet-stream"
+    
+    def send_image_data(self, image_data: bytes) -> Optional[dict]:
+        """
+        Send an encoded image to ML service for classification.
+        
+        The image is downscaled and sent as raw JPEG bytes. If the ML
+        service cannot be reached, it is spooled to disk and delivered later.
+        
+        Args:
+            image_data: Encoded image bytes
             
-            response.raise_for_status()
-            response_data = response.json()
+        Returns:
+            Response data from ML service, or None if failed or spooled
+        """
+        try:
+            return self.send_upload(*self.prepare_upload(image_data))
+        except Exception as e:
+            logger.error(f"Unexpected error sending image: {e}")
+            return None
+    
+    def send_upload(self, body: bytes, content_type: str) -> Optional[dict]:
+        """
+        Send an image already prepared by prepare_upload to ML service.
+        
+        Args:
+            body: Request body
+            content_type: Content-Type of the body
             
-            logger.info(f"Response received: {response_data}")
+        Returns:
+            Response data from ML service, or None if failed or spooled
+        """
+        try:
+            logger.info(f"Sending image to ML service: {self.ml_service_url} "
+                        f"({len(body)} bytes)")
+            self.stats["bytes_uploaded"] += len(body)
+            response_data = self._submit("/detect", body, content_type)
+            if response_data is not None:
+                logger.info(f"Response received: {response_data}")
             return response_data
             
-        except FileNotFoundError:
-            logger.error(f"Image file not found: {path}")
+        except Exception as e:
+            logger.error(f"Unexpected error sending image: {e}")
             return None
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Failed to send image to ML service: {e}")
+    
+    def send_result(self, result: dict) -> Optional[dict]:
+        """
+        Send a classification made on the device to the ML service.
+        
+        Args:
+            result: Classification result with predictions and top_prediction
+            
+        Returns:
+            Response data from ML service, or None if failed or spooled
+        """
+        try:
+            logger.info(f"Sending on-device result to ML service: {self.ml_service_url}")
+            body = json.dumps(result).encode()
+            self.stats["bytes_uploaded"] += len(body)
+            response_data = self._submit("/report", body, "application/json")
+            if response_data is not None:
+                logger.info(f"Response received: {response_data}")
+            return response_data
+            
+        except Exception as e:
+            logger.error(f"Unexpected error sending result: {e}")
             return None
+    
+    def classify_on_device(self, image_data: bytes) -> Optional[dict]:
+        """
+        Classify an image with the on-device model.
+        
+        Args:
+            image_data: Encoded image bytes
+            
+        Returns:
+            Result to send with send_result, or None if the image itself
+            should be uploaded because the model is unsure or failed
+        """
+        try:
+            results = self.edge_classifier.classify(image_data)
         except Exception as e:
-            logger.error(f"Unexpected error sending image: {e}")
+            logger.error(f"On-device classification failed, uploading image: {e}")
             return None
+        
+        top_label, top_score = max(results.items(), key=lambda x: x[1])
+        if top_score < self.confidence_threshold:
+            logger.info(f"Low on-device confidence ({top_label} {top_score:.2f}), "
+                        f"uploading image")
+            return None
+        
+        return {
+            "predictions": results,
+            "top_prediction": {
+                "label": top_label,
+                "confidence": top_score
+            },
+            "source": "edge"
+        }
     
-    def capture_and_send(self) -> Optional[dict]:
+    def classify_and_send(self, image_data: bytes) -> Optional[dict]:
         """
-        Capture image and send to ML service.
+        Classify an image on the device and send only the result.
+        
+        The image itself is uploaded when the on-device model is less
+        confident than confidence_threshold, or when it fails.
         
+        Args:
+            image_data: Encoded image bytes
+            
         Returns:
             Response data from ML service or None if failed
         """
-        if self.capture_image():
-            return self.send_image()
-        return None
+        result = self.classify_on_device(image_data)
+        if result is None:
+            return self.send_image_data(image_data)
+        return self.send_result(result)
     
-    def run_continuous(self):
-        """Run continuous capture and send loop."""
-        logger.info("Starting continuous capture service...")
-        logger.info(f"Capture interval: {self.capture_interval} seconds")
+    def send_keepalive(self) -> Optional[dict]:
+        """
+        Tell the ML service the camera is alive but its view is unchanged.
         
-        while True:
+        Keep-alives are not spooled; a later one supersedes a lost one.
+        
+        Returns:
+            Response data from ML service or None if failed
+        """
+        keepalive = {
+            "unchanged_seconds": round(time.monotonic() - self._last_sent),
+            "stats": self.stats
+        }
+        try:
+            response_data = self._post("/keepalive", json.dumps(keepalive).encode(),
+                                       "application/json")
+            logger.info(f"Keep-alive sent, {self.upload_savings():.0%} of frames skipped")
+            return response_data
+        except requests.exceptions.RequestException as e:
+            logger.error(f"Failed to send keep-alive: {e}")
+            return None
+    
+    def upload_savings(self) -> float:
+        """Get the fraction of captured frames that were not uploaded."""
+        return self.stats["skipped"] / max(self.stats["frames"], 1)
+    
+    def encode_frame(self, image_data: bytes) -> Optional[tuple]:
+        """
+        Decide what to upload for a captured frame.
+        
+        Frames that have not changed since the last upload are skipped, and
+        a keep-alive is sent instead once keepalive_interval has passed.
+        
+        Args:
+            image_data: Encoded image bytes
+            
+        Returns:
+            Upload job for upload_job: ("keepalive", None), ("result",
+            on-device result) or ("image", (body, content_type)); None if
+            there is nothing to send
+        """
+        self.stats["frames"] += 1
+        if self.change_detector is not None:
             try:
-                self.capture_and_send()
-                time.sleep(self.capture_interval)
-            except KeyboardInterrupt:
-                logger.info("Service stopped by user")
-                break
+                changed, score = self.change_detector.check(image_data)
             except Exception as e:
-                logger.error(f"Error in continuous loop: {e}")
-                time.sleep(self.capture_interval)
+                logger.error(f"Frame change detection failed: {e}")
+                changed, score = True, 1.0
+            if not changed:
+                self.stats["skipped"] += 1
+                self.stats["bytes_skipped"] += len(image_data)
+                logger.info(f"Frame unchanged (score {score:.3f}), not uploaded")
+                if time.monotonic() - self._last_sent >= self.keepalive_interval:
+                    self.stats["keepalives"] += 1
+                    self._last_sent = time.monotonic()
+                    return ("keepalive", None)
+                return None
+        
+        self.stats["uploaded"] += 1
+        self._last_sent = time.monotonic()
+        if self.edge_classifier is not None:
+            result = self.classify_on_device(image_data)
+            if result is not None:
+                return ("result", result)
+        return ("image", self.prepare_upload(image_data))
+    
+    def upload_job(self, job: tuple) -> Optional[dict]:
+        """
+        Send an upload job made by encode_frame.
+        
+        Args:
+            job: Upload job
+            
+        Returns:
+            Response data from ML service or None if failed or spooled
+        """
+        kind, payload = job
+        if kind == "keepalive":
+            return self.send_keepalive()
+        if kind == "result":
+            return self.send_result(payload)
+        return self.send_upload(*payload)
+    
+    def capture_and_send(self) -> Optional[dict]:
+        """
+        Capture image and send it, or its on-device result, to ML service.
+        
+        Returns:
+            Response data from ML service or None if failed or skipped
+        """
+        image_data = self.capture_image()
+        if image_data is None:
+            # Nothing new to send, but the backlog may be deliverable
+            self.drain_uploads()
+            return None
+        
+        job = self.encode_frame(image_data)
+        if job is None:
+            return None
+        return self.upload_job(job)
+    
+    def run_continuous(self):
+        """
+        Run continuous capture and send loop.
+        
+        Captures run at a fixed, adaptive rate, while encoding and
+        uploading overlap with the next capture.
+        """
+        logger.info("Starting continuous capture service...")
+        pipeline = CapturePipeline(self)
+        logger.info(f"Capture interval: {pipeline.schedule.interval:.0f} seconds "
+                    f"({pipeline.schedule.min_interval:.0f}-"
+                    f"{pipeline.schedule.max_interval:.0f}s adaptive)")
+        
+        pipeline.run()
+        
+        self.close_camera()
+        logger.info(f"Captured {self.stats['frames']} frames, uploaded "
+                    f"{self.stats['uploaded']}, skipped {self.stats['skipped']} "
+                    f"({self.upload_savings():.0%}, "
+                    f"{self.stats['bytes_skipped'] / 1e6:.1f} MB not sent), "
+                    f"dropped {pipeline.stats['dropped']}")
 
 
 def main():
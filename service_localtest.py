@@ -2,11 +2,15 @@
 Local test service for testing ML service and Firebase integration.
 Uses a test image file instead of camera.
 """
+import argparse
 import logging
 import base64
+import statistics
+import time
 import requests
-from firebase import Firebase
+from firebase import get_client
 from config import Config
+from image_utils import reduce_image
 
 logging.basicConfig(
     level=logging.INFO,
@@ -15,12 +19,32 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def test_ml_service(image_path: str = "testing.png") -> dict:
+def encode_test_image(image_bytes: bytes, raw: bool = True) -> tuple[bytes, dict]:
+    """
+    Encode an image the way the camera service uploads it.
+    
+    Args:
+        image_bytes: Image file contents
+        raw: Downscale to raw JPEG bytes, as the camera service does, or
+            base64-encode the file as is
+        
+    Returns:
+        Tuple of (request body, request headers)
+    """
+    if raw:
+        body = reduce_image(image_bytes, Config.UPLOAD_IMAGE_SIZE,
+                            Config.UPLOAD_JPEG_QUALITY)
+        return body, {"Content-Type": "image/jpeg"}
+    return base64.b64encode(image_bytes), {}
+
+
+def test_ml_service(image_path: str = "testing.png", raw: bool = True) -> dict:
     """
     Test ML service with a local image file.
     
     Args:
         image_path: Path to test image file
+        raw: Send downscaled raw JPEG bytes rather than base64
         
     Returns:
         Response data from ML service
@@ -28,14 +52,16 @@ def test_ml_service(image_path: str = "testing.png") -> dict:
     try:
         # Read and encode image
         with open(image_path, "rb") as image_file:
-            image_bytes = base64.b64encode(image_file.read())
+            body, headers = encode_test_image(image_file.read(), raw)
         
-        logger.info(f"Sending test image to ML service: {Config.ML_SERVICE_URL}")
+        logger.info(f"Sending test image to ML service: {Config.ML_SERVICE_URL} "
+                    f"({len(body)} bytes)")
         
         # Send to ML service
         response = requests.post(
             f"{Config.ML_SERVICE_URL}/detect",
-            data=image_bytes,
+            data=body,
+            headers=headers,
             timeout=30
         )
         
@@ -58,6 +84,48 @@ def test_ml_service(image_path: str = "testing.png") -> dict:
         raise
 
 
+def benchmark_upload(image_path: str = "testing.png", runs: int = 20) -> dict:
+    """
+    Compare base64 uploads of the file with downscaled raw JPEG uploads.
+    
+    Latency covers encoding on the client as well as the request.
+    
+    Args:
+        image_path: Path to test image file
+        runs: Requests per upload path
+        
+    Returns:
+        Dictionary mapping each path to its bytes on the wire and median
+        latency in milliseconds
+    """
+    with open(image_path, "rb") as image_file:
+        image_bytes = image_file.read()
+    
+    session = requests.Session()
+    report = {}
+    for name, raw in [("base64", False), ("raw_jpeg", True)]:
+        latencies = []
+        for _ in range(runs):
+            start = time.perf_counter()
+            body, headers = encode_test_image(image_bytes, raw)
+            response = session.post(
+                f"{Config.ML_SERVICE_URL}/detect",
+                data=body,
+                headers=headers,
+                timeout=30
+            )
+            response.raise_for_status()
+            latencies.append((time.perf_counter() - start) * 1000)
+        report[name] = {
+            "bytes": len(body),
+            "median_ms": statistics.median(latencies),
+            "top_prediction": response.json()["top_prediction"]
+        }
+        logger.info(f"{name}: {len(body)} bytes, "
+                    f"{report[name]['median_ms']:.0f} ms median")
+    return report
+
+
 def test_firebase_push(result: dict) -> bool:
     """
     Test Firebase push functionality.
@@ -69,12 +137,8 @@ def test_firebase_push(result: dict) -> bool:
         bool: True if push successful, False otherwise
     """
     try:
-        db = Firebase()
-        if db.authenticate():
-            return db.push(result)
-        else:
-            logger.error("Firebase authentication failed")
-            return False
+        # The shared client signs in once and reuses its token
+        return get_client().push(result)
     except Exception as e:
         logger.error(f"Firebase push failed: {e}")
         return False
@@ -82,9 +146,21 @@ def test_firebase_push(result: dict) -> bool:
 
 def main():
     """Main test function."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--image', default='testing.png',
+                        help='Test image to send.')
+    parser.add_argument('--benchmark', type=int, default=0,
+                        help='Compare upload paths over this many requests '
+                             'each instead of running the tests.')
+    args = parser.parse_args()
+    
+    if args.benchmark:
+        benchmark_upload(args.image, args.benchmark)
+        return
+    
     try:
         # Test ML service
-        result = test_ml_service()
+        result = test_ml_service(args.image)
         
         # Test Firebase push
         if test_firebase_push(result):
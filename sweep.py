@@ -0,0 +1,379 @@
+"""
+Hyperparameter sweep for the retrained final layer.
+
+Loads the bottleneck cache once and trains one softmax head per
+(learning rate, batch size) pair. All heads are stacked into a single graph
+and updated together in one `sess.run` per step, so the sweep costs about as
+much as one ordinary `retrain.py` run. The best head on the validation set is
+exported in the usual `retrained_graph.pb`/labels format.
+
+Example:
+    python sweep.py \
+        --image_dir=training_dataset \
+        --bottleneck_dir=tf_files/bottlenecks \
+        --model_dir=inception \
+        --learning_rates=0.001,0.01,0.1 \
+        --train_batch_sizes=50,100,500
+"""
+import argparse
+import csv
+import itertools
+import logging
+import sys
+from typing import Dict, List, Sequence, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+import retrain
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+def load_cached_splits(
+    image_dir: str,
+    bottleneck_dir: str,
+    model_dir: str,
+    testing_percentage: int,
+    validation_percentage: int,
+    image_archives: str = ''
+) -> Tuple[List[str], Dict[str, Tuple[np.ndarray, np.ndarray]]]:
+    """
+    Load the training and validation bottlenecks into memory.
+
+    Inception is loaded once, and only used for images whose bottleneck is
+    not cached yet.
+
+    Args:
+        image_dir: Root folder of the class-named image subfolders
+        bottleneck_dir: Folder holding cached bottleneck files
+        model_dir: Folder holding the Inception model
+        testing_percentage: Percentage of images reserved for tests
+        validation_percentage: Percentage of images reserved for validation
+        image_archives: Optional glob of tar/zip shards to read instead of
+            image_dir
+
+    Returns:
+        Tuple of (label names, dict of category to (bottlenecks, labels))
+    """
+    image_lists = retrain.load_image_lists(
+        image_dir, image_archives, testing_percentage, validation_percentage)
+    if len(image_lists) < 2:
+        raise ValueError(
+            f"Need at least two classes of images in {image_archives or image_dir}")
+
+    retrain.maybe_download_and_extract(model_dir)
+    graph, bottleneck_tensor, jpeg_data_tensor, _ = (
+        retrain.create_inception_graph(model_dir))
+    splits = {}
+    with tf.compat.v1.Session(graph=graph) as sess:
+        for category in ('training', 'validation'):
+            splits[category] = retrain.get_all_cached_bottlenecks(
+                sess, image_lists, category, bottleneck_dir, image_dir,
+                jpeg_data_tensor, bottleneck_tensor)
+            logger.info(f"Loaded {len(splits[category][1])} {category} bottlenecks")
+    return list(image_lists.keys()), splits
+
+
+def sample_batch_indices(
+    rng: np.random.RandomState,
+    class_offsets: np.ndarray,
+    class_counts: np.ndarray,
+    batch_size: int
+) -> np.ndarray:
+    """
+    Sample a training batch the same way retrain.py does.
+
+    A label is picked uniformly at random, then an image uniformly within
+    that label, so every class is equally represented on average.
+
+    Args:
+        rng: Random state to draw from
+        class_offsets: Row of the first image of each class in the matrix
+        class_counts: Number of images in each class
+        batch_size: Number of indices to draw
+
+    Returns:
+        Array of row indices into the training matrix
+    """
+    labels = rng.randint(len(class_counts), size=batch_size)
+    within = rng.randint(retrain.MAX_NUM_IMAGES_PER_CLASS + 1, size=batch_size)
+    return class_offsets[labels] + within % class_counts[labels]
+
+
+def build_sweep_graph(
+    train_bottlenecks: np.ndarray,
+    train_labels: np.ndarray,
+    validation_bottlenecks: np.ndarray,
+    validation_labels: np.ndarray,
+    class_count: int,
+    learning_rates: Sequence[float]
+) -> Tuple[tf.compat.v1.Graph, Dict[str, tf.Tensor]]:
+    """
+    Build one graph that trains a stack of independent softmax heads.
+
+    Each head has its own weights, learning rate and (padded) batch. Their
+    losses are summed, which leaves every head's gradient untouched, and each
+    head takes a plain gradient descent step like retrain.py's optimizer.
+
+    Args:
+        train_bottlenecks: Training matrix of shape [N, 2048]
+        train_labels: Training label indices of shape [N]
+        validation_bottlenecks: Validation matrix of shape [M, 2048]
+        validation_labels: Validation label indices of shape [M]
+        class_count: Number of output classes
+        learning_rates: One learning rate per head
+
+    Returns:
+        Tuple of (graph, dict of named tensors and ops)
+    """
+    head_count = len(learning_rates)
+    graph = tf.compat.v1.Graph()
+    with graph.as_default():
+        # The cached data lives in the graph, so each step only feeds indices.
+        train_input = tf.compat.v1.placeholder(
+            tf.float32, train_bottlenecks.shape, name='train_input')
+        validation_input = tf.compat.v1.placeholder(
+            tf.float32, validation_bottlenecks.shape, name='validation_input')
+        train_matrix = tf.compat.v1.Variable(train_input, trainable=False)
+        validation_matrix = tf.compat.v1.Variable(
+            validation_input, trainable=False)
+        train_targets = tf.constant(train_labels, dtype=tf.int64)
+        validation_targets = tf.constant(validation_labels, dtype=tf.int64)
+
+        batch_indices = tf.compat.v1.placeholder(
+            tf.int64, [head_count, None], name='batch_indices')
+        batch_mask = tf.compat.v1.placeholder(
+            tf.float32, [head_count, None], name='batch_mask')
+
+        weights = tf.compat.v1.Variable(tf.compat.v1.truncated_normal(
+            [head_count, retrain.BOTTLENECK_TENSOR_SIZE, class_count],
+            stddev=0.001), name='final_weights')
+        biases = tf.compat.v1.Variable(
+            tf.zeros([head_count, class_count]), name='final_biases')
+        rates = tf.constant(learning_rates, dtype=tf.float32)
+
+        inputs = tf.gather(train_matrix, batch_indices)
+        logits = tf.einsum('kbd,kdc->kbc', inputs, weights) + biases[:, None, :]
+        cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(
+            labels=tf.gather(train_targets, batch_indices), logits=logits)
+        head_losses = (tf.reduce_sum(cross_entropy * batch_mask, axis=1) /
+                       tf.reduce_sum(batch_mask, axis=1))
+        weight_gradient, bias_gradient = tf.gradients(
+            tf.reduce_sum(head_losses), [weights, biases])
+        train_step = tf.group(
+            weights.assign_sub(rates[:, None, None] * weight_gradient),
+            biases.assign_sub(rates[:, None] * bias_gradient))
+
+        validation_logits = (
+            tf.einsum('nd,kdc->knc', validation_matrix, weights) +
+            biases[:, None, :])
+        validation_accuracy = tf.reduce_mean(tf.cast(tf.equal(
+            tf.argmax(validation_logits, axis=2), validation_targets[None, :]),
+            tf.float32), axis=1)
+        validation_cross_entropy = tf.reduce_mean(
+            tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=tf.tile(validation_targets[None, :], [head_count, 1]),
+                logits=validation_logits), axis=1)
+
+        tensors = {
+            'train_input': train_input,
+            'validation_input': validation_input,
+            'batch_indices': batch_indices,
+            'batch_mask': batch_mask,
+            'weights': weights,
+            'biases': biases,
+            'train_step': train_step,
+            'head_losses': head_losses,
+            'validation_accuracy': validation_accuracy,
+            'validation_cross_entropy': validation_cross_entropy,
+            'init': tf.compat.v1.global_variables_initializer(),
+        }
+    return graph, tensors
+
+
+def run_sweep(
+    splits: Dict[str, Tuple[np.ndarray, np.ndarray]],
+    class_count: int,
+    configs: List[Tuple[float, int]],
+    how_many_training_steps: int,
+    eval_step_interval: int,
+    seed: int = 0
+) -> Tuple[List[dict], np.ndarray, np.ndarray]:
+    """
+    Train one head per (learning rate, batch size) config, all at once.
+
+    Args:
+        splits: Dict of category to (bottlenecks, labels)
+        class_count: Number of output classes
+        configs: List of (learning_rate, train_batch_size) pairs
+        how_many_training_steps: Number of steps every head takes
+        eval_step_interval: How often to log the current leader
+        seed: Seed for batch sampling
+
+    Returns:
+        Tuple of (per-head result rows, weights of shape [K, 2048, C],
+        biases of shape [K, C])
+    """
+    train_bottlenecks, train_labels = splits['training']
+    validation_bottlenecks, validation_labels = splits['validation']
+    if len(validation_labels) == 0:
+        raise ValueError("The validation split is empty, nothing to rank by")
+    class_counts = np.bincount(train_labels, minlength=class_count)
+    if not class_counts.all():
+        raise ValueError("Every class needs at least one training image")
+    class_offsets = np.concatenate([[0], np.cumsum(class_counts)[:-1]])
+
+    learning_rates = [rate for rate, _ in configs]
+    batch_sizes = [batch_size for _, batch_size in configs]
+    max_batch_size = max(batch_sizes)
+    # Heads with smaller batches are padded to the largest one and masked out.
+    mask = np.zeros([len(configs), max_batch_size], dtype=np.float32)
+    for k, batch_size in enumerate(batch_sizes):
+        mask[k, :batch_size] = 1.0
+
+    rng = np.random.RandomState(seed)
+    graph, t = build_sweep_graph(
+        train_bottlenecks, train_labels, validation_bottlenecks,
+        validation_labels, class_count, learning_rates)
+    best_accuracy = np.full(len(configs), -1.0)
+    best_step = np.zeros(len(configs), dtype=np.int64)
+    with tf.compat.v1.Session(graph=graph) as sess:
+        sess.run(t['init'], {t['train_input']: train_bottlenecks,
+                             t['validation_input']: validation_bottlenecks})
+        for i in range(how_many_training_steps):
+            indices = np.zeros([len(configs), max_batch_size], dtype=np.int64)
+            for k, batch_size in enumerate(batch_sizes):
+                indices[k, :batch_size] = sample_batch_indices(
+                    rng, class_offsets, class_counts, batch_size)
+            sess.run(t['train_step'], {t['batch_indices']: indices,
+                                       t['batch_mask']: mask})
+            is_last_step = (i + 1 == how_many_training_steps)
+            if i % eval_step_interval == 0 or is_last_step:
+                accuracy = sess.run(t['validation_accuracy'])
+                improved = accuracy > best_accuracy
+                best_accuracy[improved] = accuracy[improved]
+                best_step[improved] = i
+                leader = int(np.argmax(accuracy))
+                logger.info(
+                    f"Step {i}: best validation accuracy {accuracy[leader]:.1%} "
+                    f"(learning_rate={configs[leader][0]}, "
+                    f"train_batch_size={configs[leader][1]})")
+        accuracy, cross_entropy, weights, biases = sess.run([
+            t['validation_accuracy'], t['validation_cross_entropy'],
+            t['weights'], t['biases']])
+
+    results = []
+    for k, (learning_rate, batch_size) in enumerate(configs):
+        results.append({
+            'head': k,
+            'learning_rate': learning_rate,
+            'train_batch_size': batch_size,
+            'validation_accuracy': float(accuracy[k]),
+            'validation_cross_entropy': float(cross_entropy[k]),
+            'best_validation_accuracy': float(best_accuracy[k]),
+            'best_step': int(best_step[k]),
+        })
+    # Rank by final accuracy, breaking ties with the lower cross entropy.
+    results.sort(key=lambda r: (-r['validation_accuracy'],
+                                r['validation_cross_entropy']))
+    return results, weights, biases
+
+
+def print_results(results: List[dict]) -> None:
+    """Print the ranked results table."""
+    print(f"{'rank':>4}  {'learning_rate':>13}  {'batch':>6}  "
+          f"{'val_acc':>8}  {'val_xent':>9}  {'best_acc':>8}  {'best_step':>9}")
+    for rank, r in enumerate(results, 1):
+        print(f"{rank:>4}  {r['learning_rate']:>13g}  {r['train_batch_size']:>6}  "
+              f"{r['validation_accuracy']:>8.1%}  "
+              f"{r['validation_cross_entropy']:>9.4f}  "
+              f"{r['best_validation_accuracy']:>8.1%}  {r['best_step']:>9}")
+
+
+def write_results(results: List[dict], path: str) -> None:
+    """Write the ranked results table as CSV."""
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=['rank'] + list(results[0]))
+        writer.writeheader()
+        for rank, r in enumerate(results, 1):
+            writer.writerow(dict(r, rank=rank))
+
+
+def parse_list(value: str, cast) -> list:
+    """Parse a comma-separated command-line list."""
+    return [cast(item) for item in value.split(',') if item.strip()]
+
+
+def main():
+    """Main entry point for command-line usage."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--image_dir', default='',
+                        help='Path to folders of labeled images.')
+    parser.add_argument('--image_archives', default='',
+                        help='Glob of tar/zip shards to read instead of --image_dir.')
+    parser.add_argument('--bottleneck_dir', default='tf_files/bottlenecks',
+                        help='Path to cached bottleneck values.')
+    parser.add_argument('--model_dir', default='inception',
+                        help='Path to classify_image_graph_def.pb.')
+    parser.add_argument('--learning_rates', default='0.001,0.003,0.01,0.03,0.1',
+                        help='Comma-separated learning rates to try.')
+    parser.add_argument('--train_batch_sizes', default='50,100,500',
+                        help='Comma-separated training batch sizes to try.')
+    parser.add_argument('--how_many_training_steps', type=int, default=4000,
+                        help='How many training steps every head takes.')
+    parser.add_argument('--eval_step_interval', type=int, default=100,
+                        help='How often to log the current leader.')
+    parser.add_argument('--testing_percentage', type=int, default=10,
+                        help='What percentage of images to use as a test set.')
+    parser.add_argument('--validation_percentage', type=int, default=10,
+                        help='What percentage of images to use as a validation set.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for batch sampling.')
+    parser.add_argument('--results_file', default='',
+                        help='Optional CSV file to write the ranked table to.')
+    parser.add_argument('--output_graph', default='tf_files/retrained_graph.pb',
+                        help='Where to save the best head\'s graph.')
+    parser.add_argument('--output_labels', default='tf_files/retrained_labels.txt',
+                        help='Where to save the best head\'s labels.')
+    parser.add_argument('--final_tensor_name', default='final_result',
+                        help='Name of the output classification layer.')
+    args = parser.parse_args()
+
+    configs = list(itertools.product(
+        parse_list(args.learning_rates, float),
+        parse_list(args.train_batch_sizes, int)))
+    if not configs:
+        logger.error("Nothing to sweep")
+        sys.exit(1)
+
+    label_names, splits = load_cached_splits(
+        args.image_dir, args.bottleneck_dir, args.model_dir,
+        args.testing_percentage, args.validation_percentage,
+        args.image_archives)
+    logger.info(f"Training {len(configs)} heads for "
+                f"{args.how_many_training_steps} steps")
+    results, weights, biases = run_sweep(
+        splits, len(label_names), configs, args.how_many_training_steps,
+        args.eval_step_interval, args.seed)
+
+    print_results(results)
+    if args.results_file:
+        write_results(results, args.results_file)
+
+    best = results[0]
+    retrain.export_final_layer(
+        args.model_dir, weights[best['head']], biases[best['head']],
+        label_names, args.output_graph, args.output_labels,
+        args.final_tensor_name)
+    logger.info(
+        f"Exported best head (learning_rate={best['learning_rate']}, "
+        f"train_batch_size={best['train_batch_size']}) to {args.output_graph}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+One-time transcode of the training images for distortion training.
+
+Training with distortions decodes every sampled image at full size before
+cropping it down to 299x299, which is slow for 12 MP photos. This writes a
+copy of each image whose shorter side is just above the largest pre-crop
+size the distortion flags need, as a compact JPEG. Copies are keyed by the
+SHA-1 of the source bytes, so duplicate sources share one file. Images
+are processed in parallel, and unchanged images are skipped on later runs.
+`retrain.py --transcode_dir` then reads the copies in place of the originals.
+
+Example:
+    python transcode.py \
+        --image_dir=training_dataset \
+        --transcode_dir=tf_files/transcoded \
+        --random_crop=10 --random_scale=10
+"""
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import time
+from typing import Optional, Tuple
+
+import retrain
+from image_utils import reduce_image
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+# Write the manifest every this many images, so an interrupted run resumes.
+MANIFEST_SAVE_INTERVAL = 5000
+
+
+def transcode_one(task: tuple) -> Tuple[str, Optional[dict], int, int]:
+    """
+    Transcode one source image into the cache.
+
+    Args:
+        task: Tuple of (image key, source file path or archive member tuple,
+            (size, mtime) of the source, transcode folder, target size,
+            JPEG quality, whether to overwrite an existing copy)
+
+    Returns:
+        Tuple of (image key, manifest entry or None on failure, source bytes,
+        transcoded bytes)
+    """
+    key, source, source_stat, transcode_dir, size, quality, overwrite = task
+    try:
+        if isinstance(source, tuple):
+            data = retrain.read_archive_member(*source)
+        else:
+            with open(source, 'rb') as f:
+                data = f.read()
+        source_hash = hashlib.sha1(data).hexdigest()
+        path = retrain.get_transcoded_path(transcode_dir, source_hash)
+        if overwrite or not os.path.exists(path):
+            reduced = reduce_image(data, size, quality)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(temp_path, 'wb') as f:
+                f.write(reduced)
+            os.replace(temp_path, path)
+        entry = {'sha1': source_hash,
+                 'source_size': source_stat[0],
+                 'source_mtime': source_stat[1]}
+        return key, entry, len(data), os.path.getsize(path)
+    except Exception as e:
+        logger.error(f"Failed to transcode {key}: {e}")
+        return key, None, 0, 0
+
+
+def write_manifest(transcode_dir: str, manifest: dict) -> None:
+    """Write the manifest atomically."""
+    path = os.path.join(transcode_dir, retrain.TRANSCODE_MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(path + '.tmp', path)
+
+
+def transcode_dataset(
+    image_dir: str,
+    transcode_dir: str,
+    size: int,
+    quality: int = 90,
+    num_workers: int = 0,
+    image_archives: str = '',
+    testing_percentage: int = 10,
+    validation_percentage: int = 10
+) -> dict:
+    """
+    Transcode every image of a dataset into the cache folder.
+
+    Args:
+        image_dir: Root folder of the class-named image subfolders
+        transcode_dir: Folder to write the copies and manifest to
+        size: Target length of the shorter side
+        quality: JPEG quality of the copies
+        num_workers: Number of worker processes, 0 for one per CPU
+        image_archives: Optional glob of tar/zip shards to read instead of
+            image_dir
+        testing_percentage: Test split percentage, used to list the dataset
+        validation_percentage: Validation split percentage, used to list the
+            dataset
+
+    Returns:
+        Dict of run statistics
+    """
+    os.makedirs(transcode_dir, exist_ok=True)
+    manifest_path = os.path.join(transcode_dir, retrain.TRANSCODE_MANIFEST_NAME)
+    manifest = {'size': size, 'quality': quality, 'images': {}}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        # Copies made at another size or quality are redone in place.
+        if previous['size'] == size and previous['quality'] == quality:
+            manifest = previous
+    overwrite = not manifest['images']
+    entries = manifest['images']
+
+    image_lists = retrain.load_image_lists(
+        image_dir, image_archives, testing_percentage, validation_percentage)
+    tasks = []
+    skipped = 0
+    for label_name, label_lists in image_lists.items():
+        for category in ['training', 'testing', 'validation']:
+            for base_name in label_lists[category]:
+                key = label_lists['dir'] + '/' + base_name
+                source_stat = retrain.get_image_source_stat(
+                    image_lists, label_name, base_name, image_dir)
+                entry = entries.get(key)
+                if entry and [entry['source_size'], entry['source_mtime']] == list(
+                        source_stat):
+                    skipped += 1
+                    continue
+                if 'archive_members' in label_lists:
+                    source = label_lists['archive_members'][base_name]
+                else:
+                    source = os.path.join(image_dir, label_lists['dir'], base_name)
+                tasks.append((key, source, source_stat, transcode_dir, size,
+                              quality, overwrite))
+    # Archive members are read fastest in storage order.
+    tasks.sort(key=lambda task: task[1] if isinstance(task[1], str)
+               else (task[1][0], task[1][2]))
+
+    start = time.perf_counter()
+    stats = {'transcoded': 0, 'skipped': skipped, 'failed': 0,
+             'source_bytes': 0, 'transcoded_bytes': 0}
+    with multiprocessing.Pool(num_workers or os.cpu_count()) as pool:
+        for key, entry, source_bytes, transcoded_bytes in pool.imap_unordered(
+                transcode_one, tasks, chunksize=16):
+            if entry is None:
+                stats['failed'] += 1
+                continue
+            entries[key] = entry
+            stats['transcoded'] += 1
+            stats['source_bytes'] += source_bytes
+            stats['transcoded_bytes'] += transcoded_bytes
+            if stats['transcoded'] % MANIFEST_SAVE_INTERVAL == 0:
+                write_manifest(transcode_dir, manifest)
+                logger.info(f"Transcoded {stats['transcoded']} of {len(tasks)} images")
+    write_manifest(transcode_dir, manifest)
+    stats['seconds'] = time.perf_counter() - start
+    return stats
+
+
+def main():
+    """Main entry point for command-line usage."""
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--image_dir', default='',
+                        help='Path to folders of labeled images.')
+    parser.add_argument('--image_archives', default='',
+                        help='Glob of tar/zip shards to read instead of --image_dir.')
+    parser.add_argument('--transcode_dir', default='tf_files/transcoded',
+                        help='Folder to write the transcoded images to.')
+    parser.add_argument('--random_crop', type=int, default=0,
+                        help='Largest --random_crop the copies will be trained with.')
+    parser.add_argument('--random_scale', type=int, default=0,
+                        help='Largest --random_scale the copies will be trained with.')
+    parser.add_argument('--size', type=int, default=0,
+                        help='Shorter-side length to reduce to, overriding the '
+                             'size derived from the crop and scale.')
+    parser.add_argument('--quality', type=int, default=90,
+                        help='JPEG quality of the copies.')
+    parser.add_argument('--num_workers', type=int, default=0,
+                        help='Worker processes, 0 for one per CPU.')
+    parser.add_argument('--testing_percentage', type=int, default=10,
+                        help='What percentage of images to use as a test set.')
+    parser.add_argument('--validation_percentage', type=int, default=10,
+                        help='What percentage of images to use as a validation set.')
+    args = parser.parse_args()
+
+    size = args.size or retrain.get_transcode_size(args.random_crop,
+                                                   args.random_scale)
+    stats = transcode_dataset(
+        args.image_dir, args.transcode_dir, size,
+        quality=args.quality,
+        num_workers=args.num_workers,
+        image_archives=args.image_archives,
+        testing_percentage=args.testing_percentage,
+        validation_percentage=args.validation_percentage)
+    ratio = stats['transcoded_bytes'] / max(stats['source_bytes'], 1)
+    logger.info(
+        f"Transcoded {stats['transcoded']} images to {size}px in "
+        f"{stats['seconds']:.1f}s ({stats['skipped']} unchanged, "
+        f"{stats['failed']} failed, {ratio:.0%} of the source bytes)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,210 @@
+"""
+Disk-backed store-and-forward queue for camera uploads.
+
+Fresh captures are sent straight from memory; only an upload that cannot
+be delivered is written to a SQLite spool, so it survives an uplink outage
+or a reboot. Spooled uploads are retried with exponential backoff. The spool is held to a byte budget: when a new upload
+would exceed it, the oldest uploads are evicted first.
+"""
+import logging
+import os
+import random
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Evict this many of the oldest uploads per query when over budget.
+EVICTION_BATCH = 64
+
+
+class UploadQueue:
+    """
+    Persistent FIFO of pending uploads, stored in SQLite.
+
+    Each upload is an endpoint path, a request body and its content type.
+    Uploads stay in the queue until remove() is called for them.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = 256 * 1024 * 1024,
+        retry_base: float = 5.0,
+        retry_max: float = 600.0
+    ):
+        """
+        Open, or create, a queue.
+
+        Args:
+            path: Path to the SQLite database file
+            max_bytes: Budget for the bodies of pending uploads
+            retry_base: Delay in seconds before the first retry
+            retry_max: Upper bound on the retry delay in seconds
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.evicted = 0
+        self._lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # FULL auto-vacuum gives the pages of sent uploads back to the
+        # filesystem; it only takes effect on a new database.
+        self._db.execute("PRAGMA auto_vacuum = FULL")
+        self._db.execute("PRAGMA journal_mode = WAL")
+        self._db.execute("PRAGMA synchronous = NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS uploads ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " endpoint TEXT NOT NULL,"
+            " content_type TEXT NOT NULL,"
+            " body BLOB NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " attempts INTEGER NOT NULL DEFAULT 0,"
+            " next_attempt REAL NOT NULL)"
+        )
+        self._db.execute(
+            "CREATE INDEX IF NOT EXISTS uploads_next_attempt"
+            " ON uploads (next_attempt)"
+        )
+        self._db.commit()
+        self._count, self._bytes = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM uploads"
+        ).fetchone()
+
+    def __len__(self) -> int:
+        return self._count
+
+    @property
+    def pending_bytes(self) -> int:
+        """Total size of the bodies of pending uploads."""
+        return self._bytes
+
+    def put(self, endpoint: str, body: bytes, content_type: str) -> Optional[int]:
+        """
+        Add an upload to the queue, evicting the oldest ones if needed.
+
+        Args:
+            endpoint: Endpoint path, such as "/detect"
+            body: Request body
+            content_type: Content-Type of the body
+
+        Returns:
+            Id of the queued upload, or None if it is larger than the budget
+        """
+        size = len(body)
+        if size > self.max_bytes:
+            logger.error(f"Upload of {size} bytes exceeds the queue budget, dropped")
+            return None
+
+        with self._lock:
+            while self._bytes + size > self.max_bytes:
+                self._evict_oldest(self._bytes + size - self.max_bytes)
+            now = time.time()
+            cursor = self._db.execute(
+                "INSERT INTO uploads (endpoint, content_type, body, size, created,"
+                " next_attempt) VALUES (?, ?, ?, ?, ?, ?)",
+                (endpoint, content_type, sqlite3.Binary(body), size, now, now)
+            )
+            self._db.commit()
+            self._count += 1
+            self._bytes += size
+            return cursor.lastrowid
+
+    def _evict_oldest(self, needed: int) -> None:
+        """Delete the oldest uploads until at least needed bytes are freed."""
+        rows = self._db.execute(
+            "SELECT id, size FROM uploads ORDER BY id LIMIT ?", (EVICTION_BATCH,)
+        ).fetchall()
+        freed = 0
+        ids = []
+        for upload_id, size in rows:
+            if freed >= needed:
+                break
+            ids.append(upload_id)
+            freed += size
+        self._db.executemany("DELETE FROM uploads WHERE id = ?", [(i,) for i in ids])
+        self._count -= len(ids)
+        self._bytes -= freed
+        self.evicted += len(ids)
+        logger.warning(f"Upload queue over budget, evicted {len(ids)} oldest uploads")
+
+    def due(self, limit: int) -> List[Tuple[int, str, str, bytes]]:
+        """
+        Get the oldest uploads whose retry time has come.
+
+        Args:
+            limit: Maximum number of uploads to return
+
+        Returns:
+            List of (id, endpoint, content_type, body), oldest first
+        """
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, endpoint, content_type, body FROM uploads"
+                " WHERE next_attempt <= ? ORDER BY id LIMIT ?",
+                (time.time(), limit)
+            ).fetchall()
+        return [(i, endpoint, content_type, bytes(body))
+                for i, endpoint, content_type, body in rows]
+
+    def remove(self, upload_id: int) -> None:
+        """Delete an upload, once sent or rejected by the server."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT size FROM uploads WHERE id = ?", (upload_id,)
+            ).fetchone()
+            if row is None:
+                return
+            self._db.execute("DELETE FROM uploads WHERE id = ?", (upload_id,))
+            self._db.commit()
+            self._count -= 1
+            self._bytes -= row[0]
+
+    def retry_later(self, upload_id: int) -> float:
+        """
+        Schedule another attempt for an upload after exponential backoff.
+
+        Args:
+            upload_id: Id of the upload that failed
+
+        Returns:
+            Delay in seconds until the next attempt
+        """
+        with self._lock:
+            row = self._db.execute(
+                "SELECT attempts FROM uploads WHERE id = ?", (upload_id,)
+            ).fetchone()
+            if row is None:
+                return 0.0
+            attempts = row[0] + 1
+            # Jitter keeps a fleet of cameras from retrying in lockstep.
+            delay = min(self.retry_max, self.retry_base * 2 ** (attempts - 1))
+            delay *= random.uniform(0.5, 1.0)
+            self._db.execute(
+                "UPDATE uploads SET attempts = ?, next_attempt = ? WHERE id = ?",
+                (attempts, time.time() + delay, upload_id)
+            )
+            self._db.commit()
+            return delay
+
+    def stats(self) -> Dict[str, int]:
+        """Get the number and size of pending uploads and the evictions so far."""
+        return {
+            "pending": self._count,
+            "pending_bytes": self._bytes,
+            "evicted": self.evicted
+        }
+
+    def close(self) -> None:
+        """Close the database."""
+        with self._lock:
+            self._db.close()
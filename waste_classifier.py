@@ -3,7 +3,7 @@ Waste Classification Module using TensorFlow.
 Provides image classification for waste types.
 """
 import logging
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Tuple
 import tensorflow as tf
 import numpy as np
 from config import Config
@@ -36,6 +36,7 @@ class WasteClassifier:
         self.labels: Optional[list] = None
         self.input_operation: Optional[tf.Tensor] = None
         self.output_operation: Optional[tf.Tensor] = None
+        self.embedding_operation: Optional[tf.Tensor] = None
         
         self._load_model()
 
@@ -71,6 +72,11 @@ class WasteClassifier:
             self.sess = tf.compat.v1.Session(graph=self.graph)
             self.input_operation = self.graph.get_tensor_by_name('DecodeJpeg/contents:0')
             self.output_operation = self.graph.get_tensor_by_name('final_result:0')
+            # Compact models distilled from Inception have no pool_3 layer.
+            try:
+                self.embedding_operation = self.graph.get_tensor_by_name('pool_3/_reshape:0')
+            except KeyError:
+                self.embedding_operation = None
             
             logger.info(f"Model loaded successfully with {len(self.labels)} labels")
             
@@ -78,6 +84,26 @@ class WasteClassifier:
             logger.error(f"Failed to load model: {e}")
             raise
 
+    def _check_input(self, image_data: bytes) -> None:
+        """Raise if the model is not loaded or the image data is empty."""
+        if not self.sess:
+            raise RuntimeError("Model not loaded. Cannot classify image.")
+        
+        if not image_data:
+            raise ValueError("Image data is empty")
+
+    def _format_predictions(self, predictions: np.ndarray) -> Dict[str, float]:
+        """Map a softmax row to label names, highest confidence first."""
+        top_indices = np.argsort(predictions)[::-1]
+        
+        results = {}
+        for i in top_indices:
+            if i < len(self.labels):
+                human_string = self.labels[i]
+                score = float(predictions[i])
+                results[human_string] = score
+        return results
+
     def classify(self, image_data: bytes) -> Dict[str, float]:
         """
         Classify an image and return predictions.
@@ -92,11 +118,7 @@ class WasteClassifier:
             RuntimeError: If model is not loaded
             ValueError: If image_data is invalid
         """
-        if not self.sess:
-            raise RuntimeError("Model not loaded. Cannot classify image.")
-        
-        if not image_data:
-            raise ValueError("Image data is empty")
+        self._check_input(image_data)
         
         try:
             # Run inference
@@ -105,15 +127,7 @@ class WasteClassifier:
                 {self.input_operation: image_data}
             )
             
-            # Get top predictions
-            top_indices = np.argsort(predictions[0])[::-1]
-            
-            results = {}
-            for i in top_indices:
-                if i < len(self.labels):
-                    human_string = self.labels[i]
-                    score = float(predictions[0][i])
-                    results[human_string] = score
+            results = self._format_predictions(predictions[0])
             
             logger.debug(f"Classification completed. Top prediction: {max(results.items(), key=lambda x: x[1])}")
             return results
@@ -122,6 +136,69 @@ class WasteClassifier:
             logger.error(f"Error during classification: {e}")
             raise
 
+    def classify_with_embedding(
+        self,
+        image_data: bytes
+    ) -> Tuple[Dict[str, float], np.ndarray]:
+        """
+        Classify an image and return its pool_3 embedding in the same pass.
+        
+        Args:
+            image_data: Image data as bytes
+            
+        Returns:
+            Tuple of (dictionary mapping label names to confidence scores,
+            float32 embedding vector of size 2048, or None if the model has
+            no pool_3 layer)
+            
+        Raises:
+            RuntimeError: If model is not loaded
+            ValueError: If image_data is invalid
+        """
+        self._check_input(image_data)
+        if self.embedding_operation is None:
+            return self.classify(image_data), None
+        
+        try:
+            predictions, embedding = self.sess.run(
+                [self.output_operation, self.embedding_operation],
+                {self.input_operation: image_data}
+            )
+            return self._format_predictions(predictions[0]), embedding[0]
+            
+        except Exception as e:
+            logger.error(f"Error during classification: {e}")
+            raise
+
+    def embed(self, image_data: bytes) -> np.ndarray:
+        """
+        Compute the pool_3 embedding of an image without classifying it.
+        
+        Args:
+            image_data: Image data as bytes
+            
+        Returns:
+            Float32 embedding vector of size 2048
+            
+        Raises:
+            RuntimeError: If model is not loaded or has no pool_3 layer
+            ValueError: If image_data is invalid
+        """
+        self._check_input(image_data)
+        if self.embedding_operation is None:
+            raise RuntimeError("Model has no pool_3 layer. Cannot compute embedding.")
+        
+        try:
+            embedding = self.sess.run(
+                self.embedding_operation,
+                {self.input_operation: image_data}
+            )
+            return embedding[0]
+            
+        except Exception as e:
+            logger.error(f"Error computing embedding: {e}")
+            raise
+
     def get_top_prediction(self, image_data: bytes) -> tuple[str, float]:
         """
         Get the top prediction for an image.
@@ -0,0 +1,359 @@
+"""
+Cache of wind and ocean-current conditions for drift prediction.
+
+Conditions change slowly over space and time, so requests are snapped to a
+grid cell and an hour: every report in the same cell within the same hour
+shares one lookup, whichever user asked first. An entry expires after the
+provider's update cadence. When several requests miss on the same cell at
+once, one of them fetches it and the others wait for its result. Missing
+cells are fetched from the provider in batches.
+
+Conditions are returned as speeds in m/s and directions in degrees the
+flow heads towards, as drift.predict_drift expects.
+
+Example:
+    python weather_cache.py --fixture=fixtures/weather.json --reports=5000
+"""
+import argparse
+import json
+import logging
+import math
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import requests
+
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+# Kinds of conditions, and the fields drift.predict_drift takes them as.
+KINDS = {
+    "wind": ("wind_speed", "wind_direction"),
+    "current": ("current_velocity", "current_direction")
+}
+
+Cell = Tuple[float, float]
+
+
+class OpenMeteoProvider:
+    """Conditions from the Open-Meteo forecast and marine APIs."""
+
+    FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+    MARINE_URL = "https://marine-api.open-meteo.com/v1/marine"
+    # Locations per request; Open-Meteo takes comma-separated lists.
+    BATCH_SIZE = 100
+    # Seconds between updates of the "current" values of each API.
+    cadence = {"wind": 900, "current": 3600}
+
+    def __init__(self, session: Optional[requests.Session] = None,
+                 timeout: float = 10.0):
+        """
+        Initialize the provider.
+
+        Args:
+            session: Optional HTTP session, for pooled connections
+            timeout: Request timeout in seconds
+        """
+        self.session = session or requests.Session()
+        self.timeout = timeout
+
+    def fetch(self, kind: str, cells: Sequence[Cell]) -> List[Tuple[float, float]]:
+        """
+        Fetch the conditions at some locations.
+
+        Args:
+            kind: 'wind' or 'current'
+            cells: (lat, lng) of each location
+
+        Returns:
+            (speed in m/s, direction towards in degrees) per location
+        """
+        values = []
+        for i in range(0, len(cells), self.BATCH_SIZE):
+            values.extend(self._fetch_batch(kind, cells[i:i + self.BATCH_SIZE]))
+        return values
+
+    def _fetch_batch(self, kind: str, cells: Sequence[Cell]) -> List[Tuple[float, float]]:
+        params = {
+            "latitude": ",".join(f"{lat:g}" for lat, _ in cells),
+            "longitude": ",".join(f"{lng:g}" for _, lng in cells)
+        }
+        if kind == "wind":
+            url = self.FORECAST_URL
+            params["current"] = "wind_speed_10m,wind_direction_10m"
+        else:
+            url = self.MARINE_URL
+            params["current"] = "ocean_current_velocity,ocean_current_direction"
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        data = response.json()
+        if isinstance(data, dict):
+            data = [data]
+
+        values = []
+        for location in data:
+            current = location.get("current") or {}
+            if kind == "wind":
+                # Speeds come in km/h; the direction is where the wind
+                # comes from, so it is turned around.
+                speed = (current.get("wind_speed_10m") or 0) / 3.6
+                direction = ((current.get("wind_direction_10m") or 0) + 180) % 360
+            else:
+                # Land cells have no current.
+                speed = (current.get("ocean_current_velocity") or 0) / 3.6
+                direction = current.get("ocean_current_direction") or 0
+            values.append((float(speed), float(direction)))
+        return values
+
+
+class FixtureProvider:
+    """
+    Conditions from a fixture, for tests and offline development.
+
+    The fixture maps each kind to a "default" [speed, direction] and
+    optionally "cells", a mapping of "lat,lng" cell centers to values:
+
+        {"wind": {"default": [5.0, 90], "cells": {"12.875,74.875": [8.0, 45]}},
+         "current": {"default": [0.2, 180]}}
+    """
+
+    cadence = {"wind": 900, "current": 3600}
+
+    def __init__(self, fixture: Dict[str, Any], delay: float = 0.0):
+        """
+        Initialize the provider.
+
+        Args:
+            fixture: Fixture dictionary as described above
+            delay: Seconds each fetch takes, to simulate the network
+        """
+        self.fixture = fixture
+        self.delay = delay
+        self.fetches = 0
+        self.cadence = {**self.cadence, **fixture.get("cadence", {})}
+
+    @classmethod
+    def load(cls, path: str, delay: float = 0.0) -> 'FixtureProvider':
+        """Load a fixture from a JSON file."""
+        with open(path) as f:
+            return cls(json.load(f), delay=delay)
+
+    def fetch(self, kind: str, cells: Sequence[Cell]) -> List[Tuple[float, float]]:
+        """
+        Look up the conditions at some locations.
+
+        Args:
+            kind: 'wind' or 'current'
+            cells: (lat, lng) of each location
+
+        Returns:
+            (speed in m/s, direction towards in degrees) per location
+        """
+        self.fetches += 1
+        if self.delay:
+            time.sleep(self.delay)
+        entry = self.fixture.get(kind, {})
+        overrides = entry.get("cells", {})
+        default = entry.get("default", [0.0, 0.0])
+        return [tuple(map(float, overrides.get(f"{lat:g},{lng:g}", default)))
+                for lat, lng in cells]
+
+
+def open_provider(name: Optional[str] = None, session: Optional[requests.Session] = None):
+    """
+    Create the configured conditions provider.
+
+    Args:
+        name: 'open-meteo' or 'fixture' (defaults to Config.WEATHER_PROVIDER)
+        session: Optional HTTP session for Open-Meteo
+
+    Returns:
+        Provider with a fetch(kind, cells) method and a cadence per kind
+
+    Raises:
+        ValueError: If the provider is unknown
+    """
+    name = name or Config.WEATHER_PROVIDER
+    if name == 'open-meteo':
+        return OpenMeteoProvider(session=session)
+    if name == 'fixture':
+        return FixtureProvider.load(Config.WEATHER_FIXTURE)
+    raise ValueError(f"Unknown weather provider: {name}")
+
+
+class WeatherCache:
+    """Conditions per grid cell and hour, fetched once and shared."""
+
+    def __init__(self, provider, grid: float = 0.25, max_entries: int = 100000):
+        """
+        Initialize the cache.
+
+        Args:
+            provider: Provider to fetch conditions from
+            grid: Size of a grid cell in degrees
+            max_entries: Entries kept before the oldest are evicted
+        """
+        self.provider = provider
+        self.grid = grid
+        self.max_entries = max_entries
+        # (kind, cell lat, cell lng, hour) -> (expiry, value)
+        self._entries: Dict[tuple, Tuple[float, Tuple[float, float]]] = {}
+        self._inflight: Dict[tuple, Future] = {}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "waits": 0, "fetches": 0, "errors": 0}
+
+    def snap(self, lat: float, lng: float) -> Cell:
+        """Get the center of the grid cell a location falls in."""
+        lat = min(max(lat, -90.0), 90.0 - 1e-9)
+        lng = (lng + 180.0) % 360.0 - 180.0
+        return (round((math.floor(lat / self.grid) + 0.5) * self.grid, 6),
+                round((math.floor(lng / self.grid) + 0.5) * self.grid, 6))
+
+    def get_many(self, kind: str, locations: Sequence[Cell]) -> List[Tuple[float, float]]:
+        """
+        Get the conditions at many locations, fetching each missing cell once.
+
+        Args:
+            kind: 'wind' or 'current'
+            locations: (lat, lng) of each location
+
+        Returns:
+            (speed in m/s, direction towards in degrees) per location
+
+        Raises:
+            Exception: Whatever the provider raised for a cell it failed on
+        """
+        if kind not in KINDS:
+            raise ValueError(f"kind must be one of {', '.join(KINDS)}")
+        now = time.time()
+        hour = int(now // 3600)
+        keys = [(kind,) + self.snap(lat, lng) + (hour,) for lat, lng in locations]
+
+        found: Dict[tuple, Tuple[float, float]] = {}
+        waiting: Dict[tuple, Future] = {}
+        mine: Dict[tuple, Future] = {}
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                entry = self._entries.get(key)
+                if entry is not None and entry[0] > now:
+                    found[key] = entry[1]
+                    self.stats["hits"] += 1
+                elif key in self._inflight:
+                    waiting[key] = self._inflight[key]
+                    self.stats["waits"] += 1
+                else:
+                    mine[key] = self._inflight[key] = Future()
+                    self.stats["misses"] += 1
+
+        if mine:
+            self._fetch(kind, mine, now)
+            for key, future in mine.items():
+                found[key] = future.result()
+        for key, future in waiting.items():
+            found[key] = future.result()
+        return [found[key] for key in keys]
+
+    def _fetch(self, kind: str, futures: Dict[tuple, Future], now: float) -> None:
+        """Fetch the cells this caller claimed and settle their futures."""
+        cells = [key[1:3] for key in futures]
+        try:
+            self.stats["fetches"] += 1
+            values = self.provider.fetch(kind, cells)
+            if len(values) != len(cells):
+                raise ValueError(f"Provider returned {len(values)} values "
+                                 f"for {len(cells)} cells")
+        except Exception as e:
+            self.stats["errors"] += 1
+            logger.error(f"Failed to fetch {kind} for {len(cells)} cells: {e}")
+            with self._lock:
+                for key, future in futures.items():
+                    del self._inflight[key]
+                    future.set_exception(e)
+            return
+
+        expiry = now + self.provider.cadence[kind]
+        with self._lock:
+            for (key, future), value in zip(futures.items(), values):
+                self._entries[key] = (expiry, value)
+                del self._inflight[key]
+                future.set_result(value)
+            if len(self._entries) > self.max_entries:
+                self._evict(now)
+
+    def _evict(self, now: float) -> None:
+        """Drop expired entries, then the oldest ones, down to max_entries."""
+        for key in [k for k, (expiry, _) in self._entries.items() if expiry <= now]:
+            del self._entries[key]
+        excess = len(self._entries) - self.max_entries
+        for key in list(self._entries)[:max(excess, 0)]:
+            del self._entries[key]
+
+    def conditions(self, lat, lng) -> Dict[str, np.ndarray]:
+        """
+        Get wind and current conditions at many locations.
+
+        Args:
+            lat: Latitudes in degrees
+            lng: Longitudes in degrees
+
+        Returns:
+            Dictionary of arrays keyed by the drift.predict_drift argument
+            names: wind_speed, wind_direction, current_velocity and
+            current_direction
+        """
+        locations = list(zip(np.atleast_1d(lat).tolist(), np.atleast_1d(lng).tolist()))
+        columns = {}
+        for kind, (speed_field, direction_field) in KINDS.items():
+            values = np.asarray(self.get_many(kind, locations), dtype=np.float64)
+            values = values.reshape(-1, 2)
+            columns[speed_field] = values[:, 0]
+            columns[direction_field] = values[:, 1]
+        return columns
+
+
+def main():
+    """Show how many fetches the cache saves for clustered reports."""
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    )
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--fixture', default='',
+                        help='Fixture JSON; Open-Meteo is used if not given.')
+    parser.add_argument('--reports', type=int, default=5000,
+                        help='Number of report locations.')
+    parser.add_argument('--clients', type=int, default=8,
+                        help='Concurrent clients asking for the same reports.')
+    parser.add_argument('--grid', type=float, default=Config.WEATHER_GRID,
+                        help='Grid cell size in degrees.')
+    args = parser.parse_args()
+
+    provider = (FixtureProvider.load(args.fixture, delay=0.2) if args.fixture
+                else OpenMeteoProvider())
+    cache = WeatherCache(provider, grid=args.grid)
+    rng = np.random.RandomState(0)
+    # Reports cluster along a few stretches of coast.
+    centers = rng.uniform([-40, -180], [40, 180], size=(20, 2))
+    points = centers[rng.randint(len(centers), size=args.reports)]
+    points += rng.normal(scale=0.5, size=points.shape)
+
+    start = time.perf_counter()
+    clients = [threading.Thread(target=cache.conditions, args=(points[:, 0], points[:, 1]))
+               for _ in range(args.clients)]
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    seconds = time.perf_counter() - start
+    lookups = args.reports * args.clients * len(KINDS)
+    logger.info(f"{lookups} lookups by {args.clients} clients took {seconds:.2f}s and "
+                f"{cache.stats['fetches']} provider requests for "
+                f"{cache.stats['misses']} cells ({cache.stats})")
+
+
+if __name__ == '__main__':
+    main()